@@ -0,0 +1,148 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from config import ADAPTIVE_WINDOW_SIZE, ADAPTIVE_MIN_SAMPLES, ADAPTIVE_FAILURE_THRESHOLD, \
+    ADAPTIVE_RECOVERY_SUCCESSES, ADAPTIVE_MIN_CONCURRENCY, ADAPTIVE_MAX_CONCURRENCY, ADAPTIVE_MAX_DELAY_FACTOR, \
+    ADAPTIVE_DELAY_STEP, CAPTCHA_DETECTED_DELAY, DEFAULT_MARKETPLACE
+from logger import Logger
+from metrics import Metrics
+from utils import sleep_randomly
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_BLOCKED = 'blocked'
+OUTCOME_ERROR = 'error'
+
+
+class BlockPageDetected(Exception):
+    pass
+
+
+def classify_error(error: Exception) -> str:
+    if isinstance(error, BlockPageDetected):
+        return OUTCOME_BLOCKED
+    if isinstance(error, PlaywrightTimeoutError):
+        return OUTCOME_TIMEOUT
+    return OUTCOME_ERROR
+
+
+class AdaptiveController:
+    """
+    AIMD controller for one scraping stage. Concurrency is halved and the delay between requests doubled when the
+    failure rate of the sliding window rises, and both recover one step at a time after a streak of successes.
+    """
+
+    def __init__(self, stage: str, base_delay: float):
+        self.stage = stage
+        self.base_delay = base_delay
+        self.delay = base_delay
+        self.concurrency_limit = ADAPTIVE_MIN_CONCURRENCY
+        self.max_concurrency = ADAPTIVE_MAX_CONCURRENCY
+        self.outcomes = deque(maxlen=ADAPTIVE_WINDOW_SIZE)
+        self.active = 0
+        self.healthy_streak = 0
+        self.next_request_at = 0.0
+        self._condition = asyncio.Condition()
+        self._pace_lock = asyncio.Lock()
+        self.publish_metrics()
+
+    def failure_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        failures = sum(1 for outcome in self.outcomes if outcome != OUTCOME_SUCCESS)
+        return failures / len(self.outcomes)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the stage's concurrency slots."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.concurrency_limit)
+            self.active += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.active -= 1
+                self._condition.notify_all()
+
+    async def pace(self):
+        """Wait until the stage is allowed to start its next request."""
+        async with self._pace_lock:
+            wait = self.next_request_at - time.monotonic()
+            if wait > 0:
+                await sleep_randomly(wait, 0, f"Pacing '{self.stage}' requests")
+            self.next_request_at = time.monotonic() + max(self.delay + random.uniform(-1, 1), 0)
+
+    async def record(self, outcome: str):
+        self.outcomes.append(outcome)
+        Metrics().increment(f'{self.stage}.outcomes.{outcome}')
+
+        if outcome == OUTCOME_BLOCKED:
+            await self._back_off(cooldown=CAPTCHA_DETECTED_DELAY)
+        elif len(self.outcomes) >= ADAPTIVE_MIN_SAMPLES and self.failure_rate() >= ADAPTIVE_FAILURE_THRESHOLD:
+            await self._back_off()
+        elif outcome == OUTCOME_SUCCESS:
+            self.healthy_streak += 1
+            if self.healthy_streak >= ADAPTIVE_RECOVERY_SUCCESSES:
+                await self._recover()
+        else:
+            self.healthy_streak = 0
+
+        self.publish_metrics()
+
+    async def _back_off(self, cooldown: float = 0):
+        self.concurrency_limit = max(ADAPTIVE_MIN_CONCURRENCY, self.concurrency_limit // 2)
+        self.delay = min(self.base_delay * ADAPTIVE_MAX_DELAY_FACTOR, max(self.delay, 1) * 2)
+        self.outcomes.clear()
+        self.healthy_streak = 0
+        if cooldown:
+            self.next_request_at = max(self.next_request_at, time.monotonic() + cooldown)
+        Metrics().increment(f'{self.stage}.back_offs')
+        Logger.warn(
+            f"Backing off '{self.stage}': concurrency {self.concurrency_limit}, delay {self.delay:.2f}s, "
+            f"cooldown {cooldown}s")
+
+    async def _recover(self):
+        self.healthy_streak = 0
+        self.delay = max(self.base_delay, self.delay - self.base_delay * ADAPTIVE_DELAY_STEP)
+        async with self._condition:
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1)
+            self._condition.notify_all()
+        Logger.info(f"Recovering '{self.stage}': concurrency {self.concurrency_limit}, delay {self.delay:.2f}s")
+
+    def set_max_concurrency(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = min(self.concurrency_limit, max_concurrency)
+        self.publish_metrics()
+
+    def publish_metrics(self):
+        metrics = Metrics()
+        metrics.set_gauge(f'{self.stage}.concurrency_limit', self.concurrency_limit)
+        metrics.set_gauge(f'{self.stage}.request_delay', round(self.delay, 2))
+        metrics.set_gauge(f'{self.stage}.failure_rate', round(self.failure_rate(), 2))
+
+
+_controllers: dict[str, AdaptiveController] = {}
+_max_concurrency = ADAPTIVE_MAX_CONCURRENCY
+
+
+def get_controller(stage: str, base_delay: float, marketplace_id: str = DEFAULT_MARKETPLACE) -> AdaptiveController:
+    """One controller per marketplace and stage, so a marketplace that is backing off does not slow down the others."""
+    key = f"{marketplace_id}.{stage}"
+    if key not in _controllers:
+        _controllers[key] = AdaptiveController(key, base_delay)
+        _controllers[key].set_max_concurrency(_max_concurrency)
+    return _controllers[key]
+
+
+def set_max_concurrency(max_concurrency: int = None):
+    """Cap the concurrency of every stage, such as for one scheduled slice. None restores ADAPTIVE_MAX_CONCURRENCY."""
+    global _max_concurrency
+    _max_concurrency = max_concurrency or ADAPTIVE_MAX_CONCURRENCY
+    for controller in _controllers.values():
+        controller.set_max_concurrency(_max_concurrency)
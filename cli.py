@@ -0,0 +1,183 @@
+"""
+Command line entry point for running the scraper without the Discord bot.
+
+    python -m cli run
+    python -m cli run --stages search --search-terms "lego" "air fryer"
+    python -m cli run --stages details,process --promotions-file promotions.jsonl
+    python -m cli run --marketplace uk de fr
+    python -m cli reextract --run-id 20240101-010000
+    python -m cli export --format parquet --since 2024-01-01 --min-sales 500
+
+Heavy modules (Playwright, Motor, the scraper itself) are imported inside the commands that need them.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime
+
+from config import DEFAULT_MARKETPLACE
+from marketplace import MARKETPLACES
+from models import Stage
+
+PIPELINE_STAGES = Stage.SCRAPING + [Stage.PROCESS]
+
+
+def parse_stages(value: str) -> list[str]:
+    stages = [stage.strip() for stage in value.split(',') if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in PIPELINE_STAGES]
+    if unknown_stages:
+        raise argparse.ArgumentTypeError(f"Unknown stages: {', '.join(unknown_stages)}")
+    return [stage for stage in PIPELINE_STAGES if stage in stages]
+
+
+def read_lines(path: str) -> list[str]:
+    with open(path, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def seed_spool(spool, items):
+    """Fill a stage's spool from an input file so the following stages read it as if the stage had run."""
+    spool.reset()
+    for item in items:
+        spool.append(item)
+    spool.mark_complete()
+
+
+def seed_inputs(args, run_id: str):
+    from models import ProductLink, PromoCode, Promotion, ProductDetails
+    from spool import product_links_spool, promo_codes_spool, promotions_spool, product_details_spool
+
+    if args.links_file:
+        seed_spool(product_links_spool(run_id), (ProductLink(link) for link in read_lines(args.links_file)))
+    if args.codes_file:
+        seed_spool(promo_codes_spool(run_id), (PromoCode(code) for code in read_lines(args.codes_file)))
+    if args.promotions_file:
+        seed_spool(promotions_spool(run_id),
+                   (Promotion.from_dict(json.loads(line)) for line in read_lines(args.promotions_file)))
+    if args.details_file:
+        seed_spool(product_details_spool(run_id),
+                   (ProductDetails.from_dict(json.loads(line)) for line in read_lines(args.details_file)))
+
+
+async def run_command(args):
+    from har_manager import HarManager
+    from logger import Logger
+    from marketplace import get_marketplace
+    from profiling import StageProfiler
+    from run_budget import RunBudget
+    from scraper import startScraper, start_marketplace_scrapers, get_run_id
+    from spool import get_spool_path
+
+    marketplaces = [get_marketplace(marketplace_id) for marketplace_id in args.marketplace]
+    has_input_files = args.links_file or args.codes_file or args.promotions_file or args.details_file
+    if has_input_files and len(marketplaces) > 1:
+        raise SystemExit('Input files can only be used with a single marketplace')
+    run_id = args.run_id or time.strftime('%Y%m%d-%H%M%S')
+    run_ids = {marketplace.id: get_run_id(marketplace, run_id) for marketplace in marketplaces}
+    seed_inputs(args, run_ids[marketplaces[0].id])
+
+    if args.har:
+        HarManager().configure(args.har, args.har_recording)
+    if args.profile:
+        StageProfiler().set_enabled(True)
+
+    search_terms = list(args.search_terms or [])
+    if args.search_file:
+        search_terms += read_lines(args.search_file)
+
+    processed_by_marketplace = await start_marketplace_scrapers(
+        lambda marketplace, budget: startScraper(run_id=run_ids[marketplace.id], budget=budget, stages=args.stages,
+                                                 search_terms=search_terms or None, marketplace=marketplace),
+        RunBudget(args.budget), marketplaces)
+
+    for marketplace_id, processed_data in processed_by_marketplace.items():
+        for stage in args.stages:
+            if stage != Stage.PROCESS:
+                Logger.info(f"Stage '{stage}' results: {get_spool_path(run_ids[marketplace_id], stage)}")
+        if Stage.PROCESS in args.stages:
+            Logger.info(f"{marketplace_id}: new: {len(processed_data.upserted)}, "
+                        f"changed: {len(processed_data.changed)}, up to date: {processed_data.up_to_date_count}, "
+                        f"below threshold: {processed_data.below_threshold_count}")
+
+
+async def reextract_command(args):
+    from logger import Logger
+    from reextract import reextract_run
+
+    processed_data = await reextract_run(args.run_id, workers=args.workers, process=not args.no_process)
+    if processed_data is not None:
+        Logger.info(f"New: {len(processed_data.upserted)}, changed: {len(processed_data.changed)}, "
+                    f"up to date: {processed_data.up_to_date_count}, "
+                    f"below threshold: {processed_data.below_threshold_count}")
+
+
+async def export_command(args):
+    from export import export_products, get_export_path
+
+    path = args.output or get_export_path(args.format)
+    await export_products(path, args.format, promo_code=args.promo_code, since=args.since, until=args.until,
+                          min_sales=args.min_sales, marketplace_id=args.marketplace)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m cli', description='Amazon promotion scraper')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the full pipeline or selected stages')
+    run_parser.add_argument('--stages', type=parse_stages, default=PIPELINE_STAGES,
+                            help=f"Comma separated stages to run: {','.join(PIPELINE_STAGES)}")
+    run_parser.add_argument('--run-id', help='Run id, reuse one to resume a run or read its earlier stage results')
+    run_parser.add_argument('--marketplace', nargs='+', choices=list(MARKETPLACES), default=[DEFAULT_MARKETPLACE],
+                            help='Marketplaces to scrape, several run at the same time')
+    run_parser.add_argument('--budget', type=float, help='Wall-clock budget in seconds')
+    run_parser.add_argument('--search-terms', nargs='+', help='Search terms to use instead of the saved ones')
+    run_parser.add_argument('--search-file', help='File with one search term per line')
+    run_parser.add_argument('--links-file', help='File with one product link per line, input of the codes stage')
+    run_parser.add_argument('--codes-file', help='File with one promo code per line, input of the promos stage')
+    run_parser.add_argument('--promotions-file', help='JSONL file of promotions, input of the details stage')
+    run_parser.add_argument('--details-file', help='JSONL file of product details, input of the process stage')
+    run_parser.add_argument('--har', choices=['record', 'replay'], help='Record or replay network traffic')
+    run_parser.add_argument('--har-recording', help='Recording to replay, defaults to the latest')
+    run_parser.add_argument('--profile', action='store_true', help='Profile each stage')
+    run_parser.set_defaults(handler=run_command)
+
+    reextract_parser = subparsers.add_parser('reextract', help='Re-run product extraction over archived pages')
+    reextract_parser.add_argument('--run-id', required=True, help='Run whose archived pages are re-extracted')
+    reextract_parser.add_argument('--workers', type=int, help='Worker processes, defaults to the number of CPU cores')
+    reextract_parser.add_argument('--no-process', action='store_true',
+                                  help='Only write the extracted products to a spool, without updating the database')
+    reextract_parser.set_defaults(handler=reextract_command)
+
+    export_parser = subparsers.add_parser('export', help='Export stored products to a file')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl', 'parquet'], default='csv',
+                               help='Output format, parquet needs pyarrow')
+    export_parser.add_argument('--output', help='Output file, defaults to a timestamped file in the exports directory')
+    export_parser.add_argument('--promo-code', help='Only products of this promo code')
+    export_parser.add_argument('--marketplace', choices=list(MARKETPLACES), help='Only products of this marketplace')
+    export_parser.add_argument('--since', type=datetime.fromisoformat, help='Only products updated on or after, ISO date')
+    export_parser.add_argument('--until', type=datetime.fromisoformat, help='Only products updated before, ISO date')
+    export_parser.add_argument('--min-sales', type=int, help='Only products with at least this many monthly sales')
+    export_parser.set_defaults(handler=export_command)
+
+    return parser
+
+
+async def run_handler(args):
+    """Run a command, then close the database client if the command opened one."""
+    try:
+        await args.handler(args)
+    finally:
+        # Only commands that used the database have imported it
+        if 'db' in sys.modules:
+            sys.modules['db'].close_database_connection()
+
+
+def main():
+    args = build_parser().parse_args()
+    asyncio.run(run_handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,115 @@ LIMITING_RESULTS = 50
 
 # Do not change the following values
 POST_CODE = 'TQ1 3RW'
-DISCORD_MESSAGE_DELAY = 5
 MAX_SHOW_MORE_CLICKS = 4
 SCRAPING_URL_BATCH_SIZE = 10
 CRON_JOB_INTERVAL = 60 * 60 * 12  # 12 hours
 DAYS_TO_EXPIRE_OLD_PRODUCTS = 7
+
+# Distributed job queue
+JOB_LEASE_SECONDS = 10 * 60
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_INTERVAL = 15
+JOB_HEARTBEAT_INTERVAL = 60
+
+# Adaptive concurrency
+ADAPTIVE_WINDOW_SIZE = 20
+ADAPTIVE_MIN_SAMPLES = 5
+ADAPTIVE_FAILURE_THRESHOLD = 0.25
+ADAPTIVE_RECOVERY_SUCCESSES = 10
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 3
+ADAPTIVE_MAX_DELAY_FACTOR = 8
+ADAPTIVE_DELAY_STEP = 0.1
+
+# Run budget
+RUN_TIME_BUDGET = 5 * 60 * 60  # 5 hours
+RUN_BUDGET_RESERVE = 5 * 60  # kept for processing and notifications
+RUN_STATS_HISTORY = 10
+SEARCH_YIELD_SMOOTHING = 0.3
+
+# Stage spools
+SPOOL_DIRECTORY = 'spool'
+SPOOL_BUFFER_SIZE = 100
+SPOOL_RETENTION_DAYS = 3
+SPOOL_STORE_CACHE_KB = 2048  # memory each spool's SQLite key store may use before reading from disk
+PROCESS_CHUNK_SIZE = 100
+PRODUCT_TOUCH_INTERVAL = 24 * 60 * 60
+
+# Discord notifications
+DISCORD_SEND_MAX_ATTEMPTS = 3
+DISCORD_SEND_RETRY_DELAY = 5
+
+# Price history
+PRICE_HISTORY_MONTHS = 6
+PRICE_HISTORY_SAMPLES_SHOWN = 10
+
+# Settings persistence
+DATA_MANAGER_SAVE_DELAY = 2
+DATA_MANAGER_CACHE_TTL = 60
+
+# Mongo connection pool
+MONGO_MAX_POOL_SIZE = 20
+MONGO_MIN_POOL_SIZE = 1
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 10000
+MONGO_CONNECT_TIMEOUT_MS = 10000
+MONGO_SOCKET_TIMEOUT_MS = 60000
+
+# Profiling
+PROFILE_DIRECTORY = 'profiles'
+PROFILE_TOP_N = 20
+
+# Network recording
+HAR_DIRECTORY = 'har'
+HAR_REPLAY_SKIP_DELAYS = True
+
+# Page archive
+ARCHIVE_DIRECTORY = 'archive'
+ARCHIVE_PAGES = True
+ARCHIVE_RETENTION_DAYS = 30
+REEXTRACT_CHUNK_SIZE = 50
+
+# Product details cache
+PRODUCT_DETAILS_CACHE_TTL = 12 * 60 * 60
+
+# Search result pre-filter
+SEARCH_PREFILTER_ENABLED = True
+SEARCH_PREFILTER_DROP_UNKNOWN_SALES = False  # drop results without a "bought in past month" figure
+SEARCH_PREFILTER_REQUIRE_BADGE = False  # drop results without a deal, coupon or promotion badge
+
+# Product export
+EXPORT_BATCH_SIZE = 1000
+EXPORT_DIRECTORY = 'exports'
+EXPORT_DISCORD_MAX_BYTES = 25 * 1024 * 1024
+
+# Notification ranking
+NOTIFICATION_TOP_K = 20
+NOTIFICATION_DIGEST_MAX_LENGTH = 2000  # longer digests are sent as an attachment
+RANKING_DEFAULT_DISCOUNT = 0.1
+
+# Rolling scheduler
+SCHEDULER_SLICE_MINUTES = 30
+SCHEDULER_SLICE_BUDGET = 25 * 60
+SCHEDULER_SLICE_SEARCHES = 4
+SCHEDULER_SLICE_PROMOS = 10
+SCHEDULER_SLICE_MAX_CONCURRENCY = 2
+SCHEDULER_SEARCH_INTERVAL = 24 * 60 * 60
+SCHEDULER_PROMO_REVISIT_INTERVAL = 6 * 60 * 60
+SCHEDULER_PROMO_MAX_AGE = 3 * 24 * 60 * 60  # promo codes not found again by a search within this are dropped
+SCHEDULER_RETRY_DELAY = 60 * 60
+
+# Search term yield
+SCHEDULER_PRIORITIZE_BY_YIELD = True
+SCHEDULER_YIELD_MIN_PAGE_LOADS = 50  # terms with fewer page loads keep the base interval
+SCHEDULER_MAX_INTERVAL_FACTOR = 7  # the lowest yielding terms are visited at most this many times less often
+SEARCH_STATS_SHOWN = 25
+
+# Marketplaces
+DEFAULT_MARKETPLACE = 'uk'  # documents saved before marketplaces existed belong to this one
+ENABLED_MARKETPLACES = ['uk']  # run concurrently, overridden by the comma separated MARKETPLACES env variable
+
+# Promotion snapshots
+PROMO_SNAPSHOT_ENABLED = True
+PROMO_SNAPSHOT_PRODUCT_TTL = 2 * 24 * 60 * 60  # known products are sent to the details stage again after this
+PROMO_SNAPSHOT_RECHECK_RATE = 0.1  # share of known products detailed again on each visit
+PROMO_SNAPSHOT_MAX_AGE = 14 * 24 * 60 * 60  # snapshots of promotions not seen for this long are deleted
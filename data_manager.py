@@ -1,6 +1,84 @@
+import asyncio
 import json
+import os
+import tempfile
+import time
+
+from config import DATA_MANAGER_SAVE_DELAY, DATA_MANAGER_CACHE_TTL, NOTIFICATION_TOP_K
 from logger import Logger
 
+SETTINGS_DOCUMENT_ID = 'settings'
+
+
+class FileSettingsStore:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        with open(self.filename, 'r') as file:
+            return json.load(file)
+
+    def write(self, data):
+        """Write to a temporary file in the same directory, fsync it and rename it over the old file."""
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        file_descriptor, temp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(self.filename)}.', suffix='.tmp',
+                                                      dir=directory)
+        try:
+            with os.fdopen(file_descriptor, 'w') as file:
+                json.dump(data, file, indent=2)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.filename)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        if hasattr(os, 'O_DIRECTORY'):
+            directory_descriptor = os.open(directory, os.O_DIRECTORY)
+            try:
+                os.fsync(directory_descriptor)
+            finally:
+                os.close(directory_descriptor)
+
+
+class MongoSettingsStore:
+    """Settings shared by every bot instance through one document. Changes are applied as atomic operators."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def load(self):
+        return await self.collection.find_one({"_id": SETTINGS_DOCUMENT_ID})
+
+    async def seed(self, data):
+        await self.collection.update_one(
+            {"_id": SETTINGS_DOCUMENT_ID},
+            {"$setOnInsert": data},
+            upsert=True
+        )
+
+    async def apply(self, channel_changes, monthly_sales_cutoff, top_k_changes=None, marketplace_changes=None):
+        added = [channel_id for channel_id, is_added in channel_changes.items() if is_added]
+        removed = [channel_id for channel_id, is_added in channel_changes.items() if not is_added]
+
+        # $addToSet and $pull on the same field cannot share one update
+        updates = []
+        if added:
+            updates.append({"$addToSet": {"channels": {"$each": added}}})
+        if removed:
+            updates.append({"$pull": {"channels": {"$in": removed}}})
+        settings = {f"channel_top_k.{channel_id}": top_k for channel_id, top_k in (top_k_changes or {}).items()}
+        settings.update({f"channel_marketplaces.{channel_id}": marketplace_ids
+                         for channel_id, marketplace_ids in (marketplace_changes or {}).items()})
+        if monthly_sales_cutoff is not None:
+            settings["monthly_sales_cutoff"] = monthly_sales_cutoff
+        if settings:
+            updates.append({"$set": settings})
+
+        for update in updates:
+            await self.collection.update_one({"_id": SETTINGS_DOCUMENT_ID}, update, upsert=True)
+
 
 class DataManager:
     _instance = None
@@ -9,49 +87,142 @@ class DataManager:
         if cls._instance is None:
             cls._instance = super(DataManager, cls).__new__(cls)
             cls._instance.filename = 'database.json'
+            cls._instance.file_store = FileSettingsStore(cls._instance.filename)
+            cls._instance.mongo_store = None
             cls._instance.data = cls._instance.init()
+            cls._instance.loaded_at = time.time()
+            cls._instance.pending_channels = {}
+            cls._instance.pending_cutoff = None
+            cls._instance.pending_top_k = {}
+            cls._instance.pending_marketplaces = {}
+            cls._instance.save_task = None
         return cls._instance
 
     def init(self):
         Logger.info("Initializing DataManager")
         try:
-            with open(self.filename, 'r') as file:
-                data = json.load(file)
-                data = {
-                    'channels': set(data.get('channels', [])),
-                    'monthly_sales_cutoff': data.get('monthly_sales_cutoff', 100)
-                }
-                Logger.debug('DataManager initialized with data:', data)
-                return data
+            data = self.file_store.load()
+            data = {
+                'channels': set(data.get('channels', [])),
+                'monthly_sales_cutoff': data.get('monthly_sales_cutoff', 100),
+                'channel_top_k': data.get('channel_top_k', {}),
+                'channel_marketplaces': data.get('channel_marketplaces', {})
+            }
+            Logger.debug('DataManager initialized with data:', data)
+            return data
         except FileNotFoundError:
             Logger.warn(f"Database file {self.filename} not found. Initializing with empty data.")
-            return {'channels': set(), 'monthly_sales_cutoff': 100}
+            return {'channels': set(), 'monthly_sales_cutoff': 100, 'channel_top_k': {}, 'channel_marketplaces': {}}
         except json.JSONDecodeError as error:
             Logger.error('Error initializing DataManager:', error)
             raise
 
+    async def use_mongo(self, collection):
+        """Keep settings in Mongo instead of the local file. Existing file settings seed an empty collection."""
+        Logger.info("Using Mongo for DataManager settings")
+        self.mongo_store = MongoSettingsStore(collection)
+        await self.mongo_store.seed({
+            'channels': list(self.data['channels']),
+            'monthly_sales_cutoff': self.data['monthly_sales_cutoff'],
+            'channel_top_k': self.data['channel_top_k'],
+            'channel_marketplaces': self.data['channel_marketplaces']
+        })
+        await self.refresh(force=True)
+
+    async def refresh(self, force=False):
+        """Reload settings written by other bot instances once the read cache is older than its TTL."""
+        if self.mongo_store is None or (not force and time.time() - self.loaded_at < DATA_MANAGER_CACHE_TTL):
+            return
+        if self.pending_channels or self.pending_cutoff is not None or self.pending_top_k or self.pending_marketplaces:
+            await self.flush()
+
+        doc = await self.mongo_store.load() or {}
+        self.data = {
+            'channels': set(doc.get('channels', [])),
+            'monthly_sales_cutoff': doc.get('monthly_sales_cutoff', 100),
+            'channel_top_k': doc.get('channel_top_k', {}),
+            'channel_marketplaces': doc.get('channel_marketplaces', {})
+        }
+        self.loaded_at = time.time()
+
     def save(self):
-        Logger.info("Saving data to file")
+        """Schedule a write. Changes made within DATA_MANAGER_SAVE_DELAY of each other are merged into one write."""
         try:
-            with open(self.filename, 'w') as file:
-                json.dump({
-                    'channels': list(self.data['channels']),
-                    'monthly_sales_cutoff': self.data['monthly_sales_cutoff']
-                }, file, indent=2)
-        except IOError as error:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write_to_file()
+            return
+
+        if self.save_task is None or self.save_task.done():
+            self.save_task = loop.create_task(self.save_later())
+
+    async def save_later(self):
+        await asyncio.sleep(DATA_MANAGER_SAVE_DELAY)
+        self.save_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write pending changes now."""
+        if self.save_task is not None and self.save_task is not asyncio.current_task():
+            self.save_task.cancel()
+            self.save_task = None
+
+        # Copied on the event loop, so commands changing the settings during the write cannot tear it
+        channel_changes, monthly_sales_cutoff = dict(self.pending_channels), self.pending_cutoff
+        top_k_changes, marketplace_changes = dict(self.pending_top_k), dict(self.pending_marketplaces)
+        try:
+            if self.mongo_store is not None:
+                Logger.info("Saving data to Mongo")
+                await self.mongo_store.apply(channel_changes, monthly_sales_cutoff, top_k_changes,
+                                             marketplace_changes)
+            else:
+                Logger.info("Saving data to file")
+                await asyncio.to_thread(self.file_store.write, self.get_file_data())
+        except Exception as error:
             Logger.error('Error saving data:', error)
             raise
+        self.clear_pending(channel_changes, monthly_sales_cutoff, top_k_changes, marketplace_changes)
+
+    def clear_pending(self, channel_changes, monthly_sales_cutoff, top_k_changes, marketplace_changes):
+        """Forget the written changes. Changes made again while writing stay pending for the next write."""
+        for channel_id, is_added in channel_changes.items():
+            if self.pending_channels.get(channel_id) == is_added:
+                del self.pending_channels[channel_id]
+        if self.pending_cutoff == monthly_sales_cutoff:
+            self.pending_cutoff = None
+        for channel_id, top_k in top_k_changes.items():
+            if self.pending_top_k.get(channel_id) == top_k:
+                del self.pending_top_k[channel_id]
+        for channel_id, marketplace_ids in marketplace_changes.items():
+            if self.pending_marketplaces.get(channel_id) == marketplace_ids:
+                del self.pending_marketplaces[channel_id]
+
+    def get_file_data(self) -> dict:
+        return {
+            'channels': list(self.data['channels']),
+            'monthly_sales_cutoff': self.data['monthly_sales_cutoff'],
+            'channel_top_k': dict(self.data['channel_top_k']),
+            'channel_marketplaces': dict(self.data['channel_marketplaces'])
+        }
+
+    def write_to_file(self):
+        Logger.info("Saving data to file")
+        self.file_store.write(self.get_file_data())
+        self.pending_channels, self.pending_cutoff, self.pending_top_k = {}, None, {}
+        self.pending_marketplaces = {}
 
     def add_notification_channel(self, channel_id):
         """Add a channel ID for notifications."""
         Logger.info(f"Adding notification channel: {channel_id}")
         self.data['channels'].add(channel_id)
+        self.pending_channels[channel_id] = True
         self.save()
 
     def remove_notification_channel(self, channel_id):
         """Remove a channel ID from notifications."""
         Logger.info(f"Removing notification channel: {channel_id}")
         self.data['channels'].discard(channel_id)
+        self.pending_channels[channel_id] = False
         self.save()
 
     def get_notification_channels(self):
@@ -62,8 +233,32 @@ class DataManager:
         """Set the minimum monthly sales cutoff."""
         Logger.info(f"Setting monthly sales cutoff: {cutoff}")
         self.data['monthly_sales_cutoff'] = cutoff
+        self.pending_cutoff = cutoff
         self.save()
 
     def get_monthly_sales_cutoff(self):
         """Get the minimum monthly sales cutoff."""
         return self.data['monthly_sales_cutoff']
+
+    def set_channel_top_k(self, channel_id, top_k):
+        """Set how many deals a channel gets as full embeds. The rest go into its digest."""
+        Logger.info(f"Setting top deals for channel {channel_id}: {top_k}")
+        # JSON and Mongo field names are strings
+        self.data['channel_top_k'][str(channel_id)] = top_k
+        self.pending_top_k[str(channel_id)] = top_k
+        self.save()
+
+    def get_channel_top_k(self, channel_id):
+        """Get how many deals a channel gets as full embeds."""
+        return self.data['channel_top_k'].get(str(channel_id), NOTIFICATION_TOP_K)
+
+    def set_channel_marketplaces(self, channel_id, marketplace_ids):
+        """Set which marketplaces' deals a channel gets. An empty list means every marketplace."""
+        Logger.info(f"Setting marketplaces for channel {channel_id}: {marketplace_ids}")
+        self.data['channel_marketplaces'][str(channel_id)] = list(marketplace_ids)
+        self.pending_marketplaces[str(channel_id)] = list(marketplace_ids)
+        self.save()
+
+    def get_channel_marketplaces(self, channel_id):
+        """Get the marketplaces whose deals a channel gets, an empty list for every marketplace."""
+        return self.data['channel_marketplaces'].get(str(channel_id), [])
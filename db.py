@@ -1,12 +1,21 @@
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, monitoring
 import os
+import time
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from typing import Iterable
 
-from config import DAYS_TO_EXPIRE_OLD_PRODUCTS
+from config import DAYS_TO_EXPIRE_OLD_PRODUCTS, RUN_STATS_HISTORY, SEARCH_YIELD_SMOOTHING, PROCESS_CHUNK_SIZE, \
+    DEFAULT_MARKETPLACE, PRODUCT_TOUCH_INTERVAL, PRICE_HISTORY_MONTHS, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, \
+    MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, PROMO_SNAPSHOT_MAX_AGE
 from data_manager import DataManager
+from extraction import get_asin_from_url
 from logger import Logger
+from metrics import Metrics
 from models import ProductDetails, ProcessedProductDetails
+from utils import chunked, parse_price
 
 load_dotenv()
 
@@ -14,32 +23,104 @@ client = None
 db = None
 collection = None
 products_collection = None
+jobs_collection = None
+runs_collection = None
+history_collection = None
+schedule_collection = None
+promo_snapshots_collection = None
 data_manager = DataManager()
+connect_lock = asyncio.Lock()
+
+
+class CommandLatencyListener(monitoring.CommandListener):
+    """Records the latency of every Mongo command in a histogram named db.<collection>.<command>."""
+
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        collection_name = event.command.get(event.command_name)
+        self.collections[event.request_id] = collection_name if isinstance(collection_name, str) else 'admin'
+
+    def succeeded(self, event):
+        collection_name = self.collections.pop(event.request_id, 'unknown')
+        Metrics().observe(f"db.{collection_name}.{event.command_name}", event.duration_micros / 1_000_000)
+
+    def failed(self, event):
+        collection_name = self.collections.pop(event.request_id, 'unknown')
+        Metrics().observe(f"db.{collection_name}.{event.command_name}", event.duration_micros / 1_000_000)
+        Metrics().increment(f"db.{collection_name}.{event.command_name}.failures")
 
 
 async def connect_to_database():
-    global client, db, collection, products_collection
-    try:
-        Logger.info('Connecting to the database')
-        client = AsyncIOMotorClient(os.getenv('MONGO_URI'), serverSelectionTimeoutMS=10000)
-        await client.server_info()
-        db = client['PromoBot']
-        collection = db['Searches']
-        products_collection = db['Products']
-        Logger.info("Successfully connected to the database")
-    except Exception as e:
-        raise ConnectionError(f"Failed to connect to the database: {str(e)}")
-
-
-async def add_search(search_text):
+    """Connect once per process. Later calls reuse the same client and its connection pool."""
+    global client, db, collection, products_collection, jobs_collection, runs_collection, history_collection, \
+        schedule_collection, promo_snapshots_collection
+    async with connect_lock:
+        if client is not None:
+            return
+
+        try:
+            Logger.info('Connecting to the database')
+            new_client = AsyncIOMotorClient(
+                os.getenv('MONGO_URI'),
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                retryWrites=True,
+                retryReads=True,
+                event_listeners=[CommandLatencyListener()]
+            )
+            await new_client.server_info()
+            db = new_client['PromoBot']
+            collection = db['Searches']
+            products_collection = db['Products']
+            jobs_collection = db['Jobs']
+            runs_collection = db['Runs']
+            history_collection = db['ProductHistory']
+            schedule_collection = db['Schedule']
+            promo_snapshots_collection = db['PromoSnapshots']
+            await history_collection.create_index([("asin", 1), ("month", 1)])
+            await products_collection.create_index([("promotion_code", 1)])
+            await products_collection.create_index([("last_updated", 1)])
+            if os.getenv('SETTINGS_BACKEND', 'file').lower() == 'mongo':
+                await data_manager.use_mongo(db['Settings'])
+            await jobs_collection.create_index([("stage", 1), ("status", 1), ("lease_expiry", 1)])
+            await jobs_collection.create_index([("run_id", 1), ("stage", 1), ("status", 1)])
+            await schedule_collection.create_index([("kind", 1), ("marketplace", 1), ("next_due", 1)])
+            await promo_snapshots_collection.create_index("last_seen", expireAfterSeconds=PROMO_SNAPSHOT_MAX_AGE)
+            client = new_client
+            Logger.info("Successfully connected to the database")
+        except Exception as e:
+            raise ConnectionError(f"Failed to connect to the database: {str(e)}")
+
+
+def close_database_connection():
+    global client
+    if client is not None:
+        client.close()
+        client = None
+        Logger.info('Closed the database connection')
+
+
+def get_marketplace_query(marketplace_id: str) -> dict:
+    """Match a marketplace's documents. Documents saved before there were marketplaces belong to the default one."""
+    if marketplace_id == DEFAULT_MARKETPLACE:
+        return {"marketplace": {"$in": [marketplace_id, None]}}
+    return {"marketplace": marketplace_id}
+
+
+async def add_search(search_text, marketplace_id: str = DEFAULT_MARKETPLACE):
     Logger.info(f"Adding search term: {search_text}")
-    await collection.insert_one({"text": search_text})
+    await collection.insert_one({"text": search_text, "marketplace": marketplace_id})
     Logger.info(f"Added search term: {search_text}")
 
 
-async def remove_search(search_text):
+async def remove_search(search_text, marketplace_id: str = DEFAULT_MARKETPLACE):
     Logger.info(f"Removing search term: {search_text}")
-    result = await collection.delete_one({"text": search_text})
+    result = await collection.delete_one({"text": search_text, **get_marketplace_query(marketplace_id)})
     is_deleted = result.deleted_count > 0
     if is_deleted:
         Logger.info(f"Removed search term: {search_text}")
@@ -48,68 +129,292 @@ async def remove_search(search_text):
     return is_deleted
 
 
-async def get_all_searches():
-    cursor = collection.find()
+async def get_all_searches(marketplace_id: str = DEFAULT_MARKETPLACE):
+    cursor = collection.find(get_marketplace_query(marketplace_id))
+    searches = [doc['text'] async for doc in cursor]
+    Logger.info(f"Found {len(searches)} search terms")
+    return searches
+
+
+async def get_all_searches_by_yield(marketplace_id: str = DEFAULT_MARKETPLACE):
+    cursor = collection.find(get_marketplace_query(marketplace_id)).sort("yield_score", -1)
     searches = [doc['text'] async for doc in cursor]
     Logger.info(f"Found {len(searches)} search terms")
     return searches
 
 
-async def upsert_product(product_details: ProductDetails):
+async def update_search_yields(links_by_term: dict[str, list[str]], marketplace_id: str = DEFAULT_MARKETPLACE):
+    """Fold this run's product link counts into each term's moving average yield."""
+    if not links_by_term:
+        return
+
+    operations = []
+    for search_text, product_links in links_by_term.items():
+        links_found = len(product_links)
+        operations.append(UpdateOne(
+            {"text": search_text, **get_marketplace_query(marketplace_id)},
+            [{"$set": {"yield_score": {"$add": [
+                {"$multiply": [{"$ifNull": ["$yield_score", links_found]}, 1 - SEARCH_YIELD_SMOOTHING]},
+                links_found * SEARCH_YIELD_SMOOTHING
+            ]}}}]
+        ))
+    await collection.bulk_write(operations, ordered=False)
+    Logger.info(f"Updated yield for {len(operations)} search terms")
+
+
+async def update_search_term_stats(stats_by_term: dict[str, dict], marketplace_id: str = DEFAULT_MARKETPLACE):
+    """Add one run's per term counters to each term's totals."""
+    if not stats_by_term:
+        return
+
     current_time = datetime.utcnow()
-    product_id = product_details.id
+    operations = [
+        UpdateOne(
+            {"text": search_text, **get_marketplace_query(marketplace_id)},
+            {
+                "$inc": {f"stats.{field}": value for field, value in term_stats.items()},
+                "$set": {"stats.last_run": current_time}
+            }
+        )
+        for search_text, term_stats in stats_by_term.items()
+    ]
+    await collection.bulk_write(operations, ordered=False)
+    Logger.info(f"Updated stats for {len(operations)} search terms")
+
+
+async def get_search_term_stats(marketplace_id: str = DEFAULT_MARKETPLACE) -> list[dict]:
+    cursor = collection.find(get_marketplace_query(marketplace_id), {"text": 1, "stats": 1})
+    return [doc async for doc in cursor]
+
+
+async def get_promo_code_sales_scores(promo_codes: list[str],
+                                      marketplace_id: str = DEFAULT_MARKETPLACE) -> dict[str, float]:
+    """Best monthly sales seen per promo code in a marketplace. Codes never seen before get the average score."""
+    scores = {}
+    cursor = products_collection.aggregate([
+        {"$match": {"promotion_code": {"$in": list(promo_codes)}, **get_marketplace_query(marketplace_id)}},
+        {"$group": {"_id": "$promotion_code", "max_sales": {"$max": "$product_sales"}}}
+    ])
+    async for doc in cursor:
+        scores[doc['_id']] = doc['max_sales']
+
+    default_score = sum(scores.values()) / len(scores) if scores else 0
+    return {promo_code: scores.get(promo_code, default_score) for promo_code in promo_codes}
+
+
+async def save_run_stats(run_stats: dict):
+    await runs_collection.insert_one(run_stats)
+    Logger.info("Saved run stats", run_stats)
+
+
+async def get_recent_run_stats(limit: int = RUN_STATS_HISTORY, marketplace_id: str = DEFAULT_MARKETPLACE) -> list[dict]:
+    cursor = runs_collection.find(get_marketplace_query(marketplace_id)).sort("started_at", -1).limit(limit)
+    return [doc async for doc in cursor]
+
 
-    update_data = {
+def get_products_cursor(query: dict, projection: dict, batch_size: int):
+    """Cursor over Products fetching batch_size documents per round trip, for reading the collection in a stream."""
+    return products_collection.find(query, projection).batch_size(batch_size)
+
+
+def get_product_document(product_details: ProductDetails, current_time: datetime) -> dict:
+    return {
         "last_updated": current_time,
+        "last_seen": current_time,
         "product_image_url": product_details.product_image_url,
         "product_title": product_details.product_title,
         "product_url": product_details.product_url,
         "product_asin": product_details.product_asin,
         "product_price": product_details.product_price,
+        "product_price_value": parse_price(product_details.product_price),
         "product_sales": product_details.product_sales,
         "promotion_code": product_details.promotion_code,
-        "promotion_title": product_details.promotion_title
+        "promotion_title": product_details.promotion_title,
+        "marketplace": product_details.marketplace,
+        "content_hash": product_details.get_content_hash()
     }
 
-    result = await products_collection.update_one(
-        {"_id": product_id},
-        {"$set": update_data},
+
+def is_meaningful_change(doc: dict, product: ProductDetails) -> bool:
+    return doc.get('product_price') != product.product_price or \
+        doc.get('product_sales') != product.product_sales or \
+        doc.get('promotion_title') != product.promotion_title
+
+
+def get_history_bucket_id(asin: str, month: str, marketplace_id: str = DEFAULT_MARKETPLACE) -> str:
+    # The same ASIN has its own prices in each marketplace. Buckets of the default one keep their original ids.
+    if marketplace_id == DEFAULT_MARKETPLACE:
+        return f"{asin}/{month}"
+    return f"{marketplace_id}/{asin}/{month}"
+
+
+async def record_product_history(product_list: list[ProductDetails], current_time: datetime, recorded_asins: set):
+    """Append one price and sales sample per ASIN and run to that ASIN's bucket for the current month."""
+    month = current_time.strftime('%Y-%m')
+    operations = []
+    for product in product_list:
+        asin = product.product_asin
+        if not asin or (product.marketplace, asin) in recorded_asins:
+            continue
+        recorded_asins.add((product.marketplace, asin))
+
+        price = parse_price(product.product_price)
+        update = {
+            "$setOnInsert": {"asin": asin, "month": month, "marketplace": product.marketplace},
+            "$push": {"samples": {
+                "time": current_time,
+                "price": price,
+                "sales": product.product_sales,
+                "promotion_code": product.promotion_code
+            }},
+            "$inc": {"count": 1},
+            "$set": {"last_sample_at": current_time}
+        }
+        if price is not None:
+            update["$min"] = {"min_price": price}
+            update["$max"] = {"max_price": price}
+        bucket_id = get_history_bucket_id(asin, month, product.marketplace)
+        operations.append(UpdateOne({"_id": bucket_id}, update, upsert=True))
+
+    if operations:
+        await history_collection.bulk_write(operations, ordered=False)
+
+
+async def get_product_history(asin: str, months: int = PRICE_HISTORY_MONTHS,
+                              marketplace_id: str = DEFAULT_MARKETPLACE) -> list[dict]:
+    """Monthly history buckets of an ASIN in a marketplace, oldest first, read through the (asin, month) index."""
+    first_month = (datetime.utcnow().replace(day=1) - timedelta(days=31 * (months - 1))).strftime('%Y-%m')
+    cursor = history_collection.find(
+        {"asin": asin, "month": {"$gte": first_month}, **get_marketplace_query(marketplace_id)},
+        {"_id": 0, "month": 1, "count": 1, "min_price": 1, "max_price": 1, "samples": 1}
+    ).sort("month", 1)
+    history = [doc async for doc in cursor]
+    Logger.info(f"Found {len(history)} history buckets for ASIN: {asin}")
+    return history
+
+
+def get_promo_snapshot_id(promo_code: str, marketplace_id: str) -> str:
+    return f"{marketplace_id}/{promo_code}"
+
+
+async def get_promo_snapshot(promo_code: str, marketplace_id: str = DEFAULT_MARKETPLACE) -> dict | None:
+    return await promo_snapshots_collection.find_one({"_id": get_promo_snapshot_id(promo_code, marketplace_id)})
+
+
+async def update_promo_snapshot(promo_code: str, marketplace_id: str, listed_in_full: bool):
+    """Record a visit of a promotion and whether its unfiltered listing was loaded in full."""
+    current_time = datetime.utcnow()
+    await promo_snapshots_collection.update_one(
+        {"_id": get_promo_snapshot_id(promo_code, marketplace_id)},
+        {
+            "$setOnInsert": {"promo_code": promo_code, "marketplace": marketplace_id, "asins": {}},
+            "$set": {"last_seen": current_time, "listed_in_full": listed_in_full}
+        },
         upsert=True
     )
 
-    Logger.info(f"Upserted product: {product_id}")
-    return result.upserted_id is not None
 
+async def record_promo_snapshot_products(product_list: list[ProductDetails], current_time: datetime):
+    """
+    Mark each stored product as known in its promotion's snapshot, so revisits of the promotion only send new
+    products to the details stage. Keyed by the ASIN of the listing link, which is what revisits compare against.
+    """
+    asins_by_snapshot = {}
+    for product in product_list:
+        asin = get_asin_from_url(product.product_url) or product.product_asin
+        if asin:
+            asins_by_snapshot.setdefault((product.promotion_code, product.marketplace), set()).add(asin)
+
+    operations = [
+        UpdateOne(
+            {"_id": get_promo_snapshot_id(promo_code, marketplace_id)},
+            {
+                "$setOnInsert": {"promo_code": promo_code, "marketplace": marketplace_id},
+                "$set": {f"asins.{asin}": current_time for asin in asins},
+                "$max": {"last_seen": current_time}
+            },
+            upsert=True
+        )
+        for (promo_code, marketplace_id), asins in asins_by_snapshot.items()
+    ]
+    if operations:
+        await promo_snapshots_collection.bulk_write(operations, ordered=False)
 
-async def process_products(product_list: list[ProductDetails]) -> ProcessedProductDetails:
-    cutoff_date = datetime.utcnow() - timedelta(days=DAYS_TO_EXPIRE_OLD_PRODUCTS)
+
+async def process_products(product_list: Iterable[ProductDetails]) -> ProcessedProductDetails:
+    """
+    Process products in chunks so any iterable, including a stage spool, can be fed without loading it whole.
+    Products whose content hash is unchanged only get last_seen touched, at most once per PRODUCT_TOUCH_INTERVAL.
+    last_updated only moves when a product is written, so a product unchanged for DAYS_TO_EXPIRE_OLD_PRODUCTS still
+    expires and is announced again.
+    """
+    start_time = time.time()
+    database_time_before = Metrics().get_histogram_total('db.')
+    await data_manager.refresh()
+    current_time = datetime.utcnow()
+    cutoff_date = current_time - timedelta(days=DAYS_TO_EXPIRE_OLD_PRODUCTS)
+    touch_cutoff_date = current_time - timedelta(seconds=PRODUCT_TOUCH_INTERVAL)
     cutoff_sales = data_manager.get_monthly_sales_cutoff()
     processed_product_details = ProcessedProductDetails()
+    total_products = 0
+    total_writes = 0
+    recorded_asins = set()
 
-    for product in product_list:
-        product_id = product.id
-        doc = await products_collection.find_one(
-            {
-                "_id": product_id,
-                "last_updated": {"$gte": cutoff_date}
-            }
+    for chunk in chunked(product_list, PROCESS_CHUNK_SIZE):
+        total_products += len(chunk)
+        cursor = products_collection.find(
+            {"_id": {"$in": [product.id for product in chunk]}},
+            {"last_updated": 1, "last_seen": 1, "content_hash": 1, "product_price": 1, "product_sales": 1,
+             "promotion_title": 1}
         )
+        existing_docs = {doc['_id']: doc async for doc in cursor}
+        operations = []
+        await record_product_history(chunk, current_time, recorded_asins)
+        stored_products = []
 
-        if doc is None:
-            if product.product_sales >= cutoff_sales:
-                upserted = await upsert_product(product)
-                if upserted:
-                    processed_product_details.upserted.append(product)
-                else:
-                    Logger.warn(f"Failed to upsert product: {product_id}")
-            else:
-                processed_product_details.below_threshold.append(product)
+        for product in chunk:
+            product_id = product.id
+            doc = existing_docs.get(product_id)
+            content_hash = product.get_content_hash()
+            is_fresh = doc is not None and doc['last_updated'] >= cutoff_date
+
+            if is_fresh and doc.get('content_hash') == content_hash:
+                processed_product_details.up_to_date_count += 1
+                stored_products.append(product)
+                if doc.get('last_seen', doc['last_updated']) < touch_cutoff_date:
+                    operations.append(UpdateOne({"_id": product_id}, {"$set": {"last_seen": current_time}}))
+                    doc['last_seen'] = current_time
+                continue
+
+            if product.product_sales < cutoff_sales:
+                processed_product_details.below_threshold_count += 1
                 Logger.warn(f"Product sales below threshold: {product_id}")
-        else:
-            processed_product_details.up_to_date.append(product)
+                continue
 
-    Logger.info(f"Processed {len(product_list)} products")
+            document = get_product_document(product, current_time)
+            operations.append(UpdateOne({"_id": product_id}, {"$set": document}, upsert=True))
+            stored_products.append(product)
+            if not is_fresh:
+                processed_product_details.upserted.append(product)
+            elif is_meaningful_change(doc, product):
+                processed_product_details.changed.append(product)
+            else:
+                processed_product_details.up_to_date_count += 1
+            existing_docs[product_id] = document
+
+        if operations:
+            await products_collection.bulk_write(operations, ordered=False)
+            total_writes += len(operations)
+        # Only after they are stored, and never below the sales cutoff, so products that failed are detailed again
+        await record_promo_snapshot_products(stored_products, current_time)
+
+    Logger.info(f"Processed {total_products} products with {total_writes} writes")
     Logger.info(f"Upserted {len(processed_product_details.upserted)} products")
-    Logger.info(f"Found {len(processed_product_details.up_to_date)} up-to-date products")
-    Logger.info(f"Found {len(processed_product_details.below_threshold)} below threshold products")
+    Logger.info(f"Found {len(processed_product_details.changed)} changed products")
+    Logger.info(f"Found {processed_product_details.up_to_date_count} up-to-date products")
+    Logger.info(f"Found {processed_product_details.below_threshold_count} below threshold products")
+
+    total_time = time.time() - start_time
+    database_time = Metrics().get_histogram_total('db.') - database_time_before
+    Logger.info(f"Processed products in {total_time:.2f} seconds, {database_time:.2f} seconds of it in the database")
     return processed_product_details
@@ -1,77 +1,196 @@
 import asyncio
 import datetime
+import io
+import os
+import time
+
 import discord
 
-from math import ceil
 from discord import app_commands
 from discord.ext import tasks
 
-from config import DISCORD_MESSAGE_DELAY
+from config import RUN_TIME_BUDGET, DISCORD_SEND_MAX_ATTEMPTS, DISCORD_SEND_RETRY_DELAY, PRICE_HISTORY_SAMPLES_SHOWN, \
+    EXPORT_DISCORD_MAX_BYTES, NOTIFICATION_DIGEST_MAX_LENGTH, SCHEDULER_SLICE_MINUTES, SCHEDULER_SLICE_BUDGET, \
+    SEARCH_STATS_SHOWN, DEFAULT_MARKETPLACE
 from data_manager import DataManager
-from db import add_search, remove_search, get_all_searches
+from db import add_search, remove_search, get_all_searches, get_product_history, get_search_term_stats, \
+    close_database_connection
+from distributed import run_coordinator
+from export import export_products, get_export_path, AVAILABLE_EXPORT_FORMATS
 
 from logger import Logger
+from marketplace import MARKETPLACES, Marketplace, get_marketplace
+from metrics import Metrics
 from models import ProductDetails, ProcessedProductDetails
-from scraper import startScraper
-from utils import get_current_time
+from profiling import StageProfiler
+from ranking import top_deals, score_deal
+from run_budget import RunBudget
+from run_manager import RunManager, RUN_FULL, RUN_SLICE
+from scheduler import run_slices
+from term_stats import get_cost_per_deal
+from scraper import startScraper, start_marketplace_scrapers
+from utils import get_current_time, sleep_randomly, format_duration
 
 data_manager = DataManager()
+run_manager = RunManager()
+DISTRIBUTED_MODE = os.getenv('DISTRIBUTED_MODE', 'false').lower() == 'true'
+MARKETPLACE_CHOICES = [app_commands.Choice(name=marketplace.name, value=marketplace.id)
+                       for marketplace in MARKETPLACES.values()]
+EXPORT_FORMAT_CHOICES = [app_commands.Choice(name=export_format, value=export_format)
+                         for export_format in AVAILABLE_EXPORT_FORMATS]
 
 
-async def send_promo_notification_to_discord(channel, processed_data: ProcessedProductDetails):
-    products = processed_data.upserted
-    total_products = len(processed_data.upserted) + len(processed_data.up_to_date) + len(processed_data.below_threshold)
-
-    Logger.info(f'Sending promo notification to Discord. Channel: {channel.id}, Total Products: {total_products}')
+def create_product_embed(product: ProductDetails, is_changed: bool = False):
+    marketplace = get_marketplace(product.marketplace)
+    promotion_url = marketplace.get_promotion_url(product.promotion_code)
 
+    embed = discord.Embed(
+        title=product.product_title,
+        url=product.product_url,
+        color=discord.Color.orange() if is_changed else discord.Color.green()
+    ).set_thumbnail(url=product.product_image_url)
+
+    embed.add_field(name="Price", value=product.product_price or 'N/A', inline=True)
+    embed.add_field(name="Sales This Month", value=f"{product.product_sales}+ this month" or 'N/A',
+                    inline=True)
+    embed.add_field(name="Promotion", value=f"[{product.promotion_title}]({promotion_url})",
+                    inline=True)
+    embed.set_footer(text=marketplace.name)
+
+    return embed
+
+
+def get_notification_candidates(processed_data: ProcessedProductDetails) -> list[tuple[ProductDetails, bool]]:
+    """New and changed products, each with whether it changed."""
+    return [(product, False) for product in processed_data.upserted] + \
+        [(product, True) for product in processed_data.changed]
+
+
+def build_digest(digest_items: list[tuple[ProductDetails, bool]]) -> str:
+    lines = [
+        f"- {product.product_title[:80]} | {product.product_price or 'N/A'} | {product.product_sales}+ sales | "
+        f"{product.promotion_title}{' (changed)' if is_changed else ''} | <{product.product_url}>"
+        for product, is_changed in digest_items
+    ]
+    return '\n'.join(lines)
+
+
+def get_digest_message(digest: str, digest_count: int, marketplace_name: str) -> dict:
+    """Message arguments for a digest, sent as text if it fits in one message and as an attachment otherwise."""
+    header = f"**Digest: {digest_count} more {marketplace_name} deals**"
+    if len(header) + len(digest) + 1 <= NOTIFICATION_DIGEST_MAX_LENGTH:
+        return {'content': f"{header}\n{digest}"}
+    return {'content': header, 'file': discord.File(io.BytesIO(digest.encode('utf-8')), filename='digest.txt')}
+
+
+def build_promo_notification(processed_data: ProcessedProductDetails, top_embeds: list[discord.Embed],
+                             digest_items: list[tuple[ProductDetails, bool]], marketplace: Marketplace):
+    """
+    Build the summary, the embed chunks of the top deals and the digest of the others, with its item count.
+    Channels with the same number of top deals share one notification.
+    """
     content = (
         f"@here\n\n"
-        f"We've just completed a scan for product promotions. Here's what we found:\n\n"
+        f"We've just completed a scan for product promotions on **{marketplace.name}**. Here's what we found:\n\n"
         f"**Summary:**\n"
-        f"- Total products scanned: **{total_products}**\n"
+        f"- Total products scanned: **{processed_data.get_total_count()}**\n"
         f"- New eligible products: **{len(processed_data.upserted)}**\n"
-        f"- Up-to-date products: **{len(processed_data.up_to_date)}**\n"
-        f"- Products below threshold: **{len(processed_data.below_threshold)}**\n\n"
+        f"- Changed products: **{len(processed_data.changed)}**\n"
+        f"- Up-to-date products: **{processed_data.up_to_date_count}**\n"
+        f"- Products below threshold: **{processed_data.below_threshold_count}**\n\n"
         f"Scan completed at: **{get_current_time()}**\n\n"
     )
-
-    await channel.send(content=content)
-
-    def create_product_embed(product: ProductDetails):
-        promotion_url = f'https://www.amazon.co.uk/promotion/psp/{product.promotion_code}'
-
-        embed = discord.Embed(
-            title=product.product_title,
-            url=product.product_url,
-            color=discord.Color.green()
-        ).set_thumbnail(url=product.product_image_url)
-
-        embed.add_field(name="Price", value=product.product_price or 'N/A', inline=True)
-        embed.add_field(name="Sales This Month", value=f"{product.product_sales}+ this month" or 'N/A',
-                        inline=True)
-        embed.add_field(name="Promotion", value=f"[{product.promotion_title}]({promotion_url})",
-                        inline=True)
-
-        return embed
-
-    all_embeds = [create_product_embed(product) for product in products]
+    if top_embeds:
+        content += f"Top **{len(top_embeds)}** deals below"
+        content += f", **{len(digest_items)}** more in the digest.\n" if digest_items else ".\n"
 
     chunk_size = 10
-    total_chunks = ceil(len(all_embeds) / chunk_size)
+    embed_chunks = [top_embeds[i:i + chunk_size] for i in range(0, len(top_embeds), chunk_size)]
+    digest = (build_digest(digest_items), len(digest_items), marketplace.name) if digest_items else None
+    return content, embed_chunks, digest
 
-    for i in range(total_chunks):
-        embed_chunk = all_embeds[i * chunk_size: (i + 1) * chunk_size]
 
+async def send_with_retry(channel, description: str, **kwargs) -> bool:
+    for attempt in range(DISCORD_SEND_MAX_ATTEMPTS):
         try:
-            await channel.send(embeds=embed_chunk)
-            Logger.info(f"Promo notification sent successfully (Chunk {i + 1} of {total_chunks})")
-        except Exception as error:
-            Logger.error(f"Error sending promo notification (Chunk {i + 1} of {total_chunks})", error)
-
-        if i < total_chunks - 1:
-            await asyncio.sleep(DISCORD_MESSAGE_DELAY)
+            await channel.send(**kwargs)
+            Logger.info(f"{description} sent successfully to channel {channel.id}")
+            return True
+        except discord.HTTPException as error:
+            # discord.py only rewinds attachments on its own retries
+            if kwargs.get('file') is not None:
+                kwargs['file'].reset()
+            Logger.error(f"Error sending {description} to channel {channel.id} on attempt {attempt + 1}", error)
+            if attempt < DISCORD_SEND_MAX_ATTEMPTS - 1:
+                await sleep_randomly(DISCORD_SEND_RETRY_DELAY * 2 ** attempt, 0.5, 'Retrying Discord message')
+    return False
+
+
+async def send_promo_notification_to_discord(channel, content: str, embed_chunks: list[list[discord.Embed]],
+                                             digest: tuple[str, int, str] = None) -> bool:
+    """
+    Send one channel its notification. There is no fixed delay between chunks, discord.py already waits on the
+    rate limit bucket of each route and on the global limit before sending.
+    """
+    Logger.info(f'Sending promo notification to Discord. Channel: {channel.id}, Chunks: {len(embed_chunks)}')
+
+    delivered = await send_with_retry(channel, 'Promo summary', content=content)
+    for i, embed_chunk in enumerate(embed_chunks):
+        chunk_delivered = await send_with_retry(
+            channel, f"Promo notification (Chunk {i + 1} of {len(embed_chunks)})", embeds=embed_chunk)
+        delivered = delivered and chunk_delivered
+    if digest is not None:
+        # Built per channel, an attachment cannot be shared between concurrent sends
+        delivered = await send_with_retry(channel, 'Promo digest', **get_digest_message(*digest)) and delivered
+
+    Logger.info(f'Finished sending promo notification to Discord. Channel: {channel.id}')
+    return delivered
+
+
+async def notify_channels(processed_data: ProcessedProductDetails, marketplace: Marketplace = None):
+    """
+    Post one marketplace's results. Each marketplace's run is notified on its own, to the channels that get its deals.
+    """
+    start_time = time.time()
+    marketplace = marketplace or get_marketplace()
+    await data_manager.refresh()
+
+    channels = []
+    for channel_id in data_manager.get_notification_channels():
+        channel_marketplaces = data_manager.get_channel_marketplaces(channel_id)
+        if channel_marketplaces and marketplace.id not in channel_marketplaces:
+            continue
+        channel = client.get_channel(channel_id)
+        if channel:
+            channels.append(channel)
+        else:
+            Logger.warn(f"Channel with ID {channel_id} not found")
+
+    # Ranked once for the largest K, every channel takes a prefix of the same ranking
+    candidates = get_notification_candidates(processed_data)
+    top_k_by_channel = {channel.id: data_manager.get_channel_top_k(channel.id) for channel in channels}
+    ranked = top_deals(candidates, max(top_k_by_channel.values(), default=0), key=lambda item: score_deal(item[0]))
+    ranked_ids = {id(item) for item in ranked}
+    unranked = [item for item in candidates if id(item) not in ranked_ids]
+    ranked_embeds = [create_product_embed(product, is_changed) for product, is_changed in ranked]
+
+    notifications = {}
+    for top_k in set(top_k_by_channel.values()):
+        notifications[top_k] = build_promo_notification(processed_data, ranked_embeds[:top_k],
+                                                        ranked[top_k:] + unranked, marketplace)
+
+    results = await asyncio.gather(
+        *[send_promo_notification_to_discord(channel, *notifications[top_k_by_channel[channel.id]])
+          for channel in channels],
+        return_exceptions=True
+    )
+    delivered_count = sum(1 for result in results if result is True)
 
-    Logger.info('Finished sending promo notification to Discord')
+    delivery_time = time.time() - start_time
+    Metrics().set_gauge('notifications.delivery_seconds', round(delivery_time, 2))
+    Metrics().set_gauge('notifications.channels_delivered', delivered_count)
+    Logger.info(f"Delivered {marketplace.id} notifications to {delivered_count}/{len(channels)} channels "
+                f"in {delivery_time:.2f} seconds")
 
 
 async def on_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
@@ -97,11 +216,18 @@ class AmazonSearchBot(discord.Client):
     async def setup_hook(self):
         await self.tree.sync()
         self.tree.on_error = on_command_error
-        self.amazon_cron.start()
+        # Distributed runs are coordinated as one nightly batch, local ones run as rolling slices
+        if DISTRIBUTED_MODE:
+            self.amazon_cron.start()
+        else:
+            self.scheduler_slice.start()
 
     async def close(self):
         self.amazon_cron.cancel()
+        self.scheduler_slice.cancel()
+        await data_manager.flush()
         await super().close()
+        close_database_connection()
 
     @tasks.loop(time=datetime.time(hour=1, minute=0, tzinfo=datetime.timezone.utc))
     async def amazon_cron(self):
@@ -111,6 +237,14 @@ class AmazonSearchBot(discord.Client):
     async def before_amazon_cron(self):
         await self.wait_until_ready()
 
+    @tasks.loop(minutes=SCHEDULER_SLICE_MINUTES)
+    async def scheduler_slice(self):
+        await run_scheduled_slice()
+
+    @scheduler_slice.before_loop
+    async def before_scheduler_slice(self):
+        await self.wait_until_ready()
+
 
 client = AmazonSearchBot()
 
@@ -121,20 +255,24 @@ async def on_ready():
 
 
 @client.tree.command(name='ap_add_amazon_search', description='Add a new Amazon product search term')
-async def add_amazon_search(interaction: discord.Interaction, search_term: str):
+@app_commands.choices(marketplace=MARKETPLACE_CHOICES)
+async def add_amazon_search(interaction: discord.Interaction, search_term: str, marketplace: str = DEFAULT_MARKETPLACE):
     Logger.info('Adding search term Command invoked')
     await interaction.response.defer()
-    await add_search(search_term)
-    embed = discord.Embed(title="Success", description=f"Added: {search_term}", color=discord.Color.green())
+    await add_search(search_term, marketplace)
+    embed = discord.Embed(title="Success", description=f"Added: {search_term} ({get_marketplace(marketplace).name})",
+                          color=discord.Color.green())
     await interaction.followup.send(embed=embed)
     Logger.info('Added search term Command completed')
 
 
 @client.tree.command(name='ap_remove_amazon_search', description='Remove an existing Amazon product search term')
-async def remove_amazon_search(interaction: discord.Interaction, search_term: str):
+@app_commands.choices(marketplace=MARKETPLACE_CHOICES)
+async def remove_amazon_search(interaction: discord.Interaction, search_term: str,
+                               marketplace: str = DEFAULT_MARKETPLACE):
     Logger.info('Removing search term Command invoked')
     await interaction.response.defer()
-    removed = await remove_search(search_term)
+    removed = await remove_search(search_term, marketplace)
     if removed:
         embed = discord.Embed(title="Success", description=f"Removed: {search_term}", color=discord.Color.green())
     else:
@@ -145,17 +283,55 @@ async def remove_amazon_search(interaction: discord.Interaction, search_term: st
 
 
 @client.tree.command(name='ap_list_amazon_searches', description='List all saved Amazon product search terms')
-async def list_amazon_searches(interaction: discord.Interaction):
+@app_commands.choices(marketplace=MARKETPLACE_CHOICES)
+async def list_amazon_searches(interaction: discord.Interaction, marketplace: str = DEFAULT_MARKETPLACE):
     Logger.info('Listing search terms Command invoked')
     await interaction.response.defer()
-    searches = await get_all_searches()
+    searches = await get_all_searches(marketplace)
     search_list = '\n'.join(searches) if searches else "No search terms found."
-    embed = discord.Embed(title="Amazon Search Terms", description=search_list, color=discord.Color.blue())
+    embed = discord.Embed(title=f"{get_marketplace(marketplace).name} Search Terms", description=search_list,
+                          color=discord.Color.blue())
     embed.set_footer(text=f"Total search terms: {len(searches)}")
     await interaction.followup.send(embed=embed)
     Logger.info('Listing search terms Command completed')
 
 
+@client.tree.command(name="ap_search_stats", description="Show page loads spent per deal found for each search term")
+@app_commands.choices(marketplace=MARKETPLACE_CHOICES)
+async def search_stats(interaction: discord.Interaction, marketplace: str = DEFAULT_MARKETPLACE):
+    Logger.info("Search stats Command invoked")
+    await interaction.response.defer()
+    docs = await get_search_term_stats(marketplace)
+
+    def sort_key(doc):
+        cost_per_deal = get_cost_per_deal(doc.get('stats'))
+        # Terms that found deals first, cheapest first, then the terms that only cost page loads, costliest first
+        if cost_per_deal is not None:
+            return 0, cost_per_deal
+        return 1, -doc.get('stats', {}).get('page_loads', 0)
+
+    lines = []
+    for doc in sorted(docs, key=sort_key)[:SEARCH_STATS_SHOWN]:
+        term_stats = doc.get('stats', {})
+        cost_per_deal = get_cost_per_deal(term_stats)
+        cost = f"{cost_per_deal:.1f} loads/deal" if cost_per_deal is not None else "no deals"
+        lines.append(
+            f"**{doc['text']}**: {cost} | {term_stats.get('deals', 0):.1f} deals, "
+            f"{term_stats.get('page_loads', 0):.0f} page loads, {term_stats.get('links', 0)} links, "
+            f"{term_stats.get('promo_codes', 0)} promo codes"
+        )
+
+    embed = discord.Embed(
+        title=f"📊 Search Term Yield: {get_marketplace(marketplace).name}",
+        description='\n'.join(lines)[:4096] or "No search term stats recorded yet.",
+        color=discord.Color.blue()
+    )
+    if len(docs) > SEARCH_STATS_SHOWN:
+        embed.set_footer(text=f"Showing {SEARCH_STATS_SHOWN} of {len(docs)} search terms")
+    await interaction.followup.send(embed=embed)
+    Logger.info('Search stats Command completed')
+
+
 @client.tree.command(name="ap_add_notification_channel", description="Add a channel for stock notifications")
 @app_commands.checks.has_permissions(administrator=True)
 async def add_notification_channel(interaction: discord.Interaction):
@@ -187,6 +363,7 @@ async def remove_notification_channel(interaction: discord.Interaction):
 @client.tree.command(name="ap_list_notification_channels", description="List all channels set for stock notifications")
 @app_commands.checks.has_permissions(administrator=True)
 async def list_notification_channels(interaction: discord.Interaction):
+    await data_manager.refresh()
     channels = data_manager.get_notification_channels()
     channel_list = "\n".join([f"<#{channel_id}>" for channel_id in channels]) if channels else "No channels set."
 
@@ -217,6 +394,7 @@ async def set_monthly_sales_cutoff(interaction: discord.Interaction, cutoff: int
 @client.tree.command(name="ap_get_monthly_sales_cutoff",
                      description="Get the current minimum monthly sales cutoff for notifications")
 async def get_monthly_sales_cutoff(interaction: discord.Interaction):
+    await data_manager.refresh()
     cutoff = data_manager.get_monthly_sales_cutoff()
     Logger.info(f"Getting monthly sales cutoff: {cutoff}")
 
@@ -228,33 +406,249 @@ async def get_monthly_sales_cutoff(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 
+@client.tree.command(name="ap_set_top_deals",
+                     description="Set how many deals this channel gets in full, the rest go into a digest")
+@app_commands.checks.has_permissions(administrator=True)
+async def set_top_deals(interaction: discord.Interaction, top_k: app_commands.Range[int, 0, 100]):
+    Logger.info(f"Setting top deals for channel {interaction.channel_id}: {top_k}")
+    data_manager.set_channel_top_k(interaction.channel_id, top_k)
+
+    embed = discord.Embed(
+        title="✅ Top Deals Set",
+        description=f"This channel will get the top {top_k} deals of each scan in full and the rest in a digest.",
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed)
+
+
+@client.tree.command(name="ap_set_channel_marketplaces",
+                     description="Set which marketplaces' deals this channel gets, all of them when left empty")
+@app_commands.checks.has_permissions(administrator=True)
+async def set_channel_marketplaces(interaction: discord.Interaction, marketplaces: str = ''):
+    marketplace_ids = [marketplace_id.strip().lower() for marketplace_id in marketplaces.split(',')
+                       if marketplace_id.strip()]
+    unknown_ids = [marketplace_id for marketplace_id in marketplace_ids if marketplace_id not in MARKETPLACES]
+    if unknown_ids:
+        embed = discord.Embed(
+            title="Unknown Marketplaces",
+            description=f"Unknown: {', '.join(unknown_ids)}. Choose from: {', '.join(MARKETPLACES)}",
+            color=discord.Color.orange()
+        )
+        await interaction.response.send_message(embed=embed)
+        return
+
+    Logger.info(f"Setting marketplaces for channel {interaction.channel_id}: {marketplace_ids}")
+    data_manager.set_channel_marketplaces(interaction.channel_id, marketplace_ids)
+    names = ', '.join(get_marketplace(marketplace_id).name for marketplace_id in marketplace_ids)
+    embed = discord.Embed(
+        title="✅ Channel Marketplaces Set",
+        description=f"This channel will get deals from {names or 'every marketplace'}.",
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed)
+
+
+@client.tree.command(name="ap_price_history", description="Show the price and sales trend of a product")
+@app_commands.choices(marketplace=MARKETPLACE_CHOICES)
+async def price_history(interaction: discord.Interaction, asin: str, marketplace: str = DEFAULT_MARKETPLACE):
+    Logger.info(f"Price history Command invoked for ASIN: {asin}")
+    await interaction.response.defer()
+    history = await get_product_history(asin, marketplace_id=marketplace)
+
+    if not history:
+        embed = discord.Embed(title="Not Found", description=f"No history found for ASIN: {asin}",
+                              color=discord.Color.orange())
+        await interaction.followup.send(embed=embed)
+        return
+
+    def format_price(price):
+        return f"{price:.2f}" if price is not None else 'N/A'
+
+    embed = discord.Embed(title=f"📈 Price & Sales History: {asin} ({get_marketplace(marketplace).name})",
+                          color=discord.Color.blue())
+    for bucket in history:
+        latest_sample = bucket['samples'][-1]
+        embed.add_field(
+            name=bucket['month'],
+            value=(f"Price: {format_price(bucket.get('min_price'))} - {format_price(bucket.get('max_price'))}\n"
+                   f"Latest sales: {latest_sample['sales']}+\n"
+                   f"Samples: {bucket['count']}"),
+            inline=True
+        )
+
+    recent_samples = [sample for bucket in history for sample in bucket['samples']][-PRICE_HISTORY_SAMPLES_SHOWN:]
+    trend = '\n'.join(
+        f"{sample['time'].strftime('%d %b %Y')}: {format_price(sample['price'])} / {sample['sales']}+ sales"
+        for sample in recent_samples
+    )
+    embed.add_field(name="Recent Samples", value=trend, inline=False)
+    await interaction.followup.send(embed=embed)
+    Logger.info('Price history Command completed')
+
+
+@client.tree.command(name="ap_set_profiling", description="Turn profiling of scraper runs on or off")
+@app_commands.checks.has_permissions(administrator=True)
+async def set_profiling(interaction: discord.Interaction, enabled: bool):
+    Logger.info(f"Setting profiling: {enabled}")
+    StageProfiler().set_enabled(enabled)
+
+    embed = discord.Embed(
+        title="✅ Profiling Updated",
+        description=f"Profiling of scraper runs is now {'on' if enabled else 'off'}. It applies from the next run.",
+        color=discord.Color.green()
+    )
+    await interaction.response.send_message(embed=embed)
+
+
 @client.tree.command(name="ap_run_scraper", description="Manually run the Amazon promotion scraper")
 @app_commands.checks.has_permissions(administrator=True)
 async def run_scraper(interaction: discord.Interaction):
     Logger.info("Manual scraper run initiated")
-    embed = discord.Embed(
-        title="Manually Triggered Bot",
-        color=discord.Color.blue()
-    )
+    if run_manager.is_running_other_kind(RUN_FULL):
+        embed = discord.Embed(
+            title="Run Queued",
+            description=f"A {run_manager.kind} is in progress. A full run will start once it finishes.",
+            color=discord.Color.orange()
+        )
+    elif run_manager.is_running():
+        embed = discord.Embed(
+            title="Run Already In Progress",
+            description="Joined the active run. Use `/ap_run_status` to follow its progress.",
+            color=discord.Color.orange()
+        )
+    else:
+        embed = discord.Embed(
+            title="Manually Triggered Bot",
+            color=discord.Color.blue()
+        )
+    await interaction.response.send_message(embed=embed)
+    await run_amazon_cron(trigger=f"manual ({interaction.user})")
+
+
+@client.tree.command(name="ap_run_status", description="Show the progress of the active scraper run")
+async def run_status(interaction: discord.Interaction):
+    status = run_manager.get_status()
+    if status is None:
+        embed = discord.Embed(title="No Active Run", description="The scraper is not running.",
+                              color=discord.Color.blue())
+        await interaction.response.send_message(embed=embed)
+        return
+
+    def format_stage(progress: dict) -> str:
+        if progress['stage'] is None:
+            return "Between stages"
+        return f"{progress['stage']} ({progress['items_done']}/{progress['items_total']})"
+
+    # A run of several marketplaces reports the progress of each of their runs
+    children = status['children']
+    if children:
+        stage = '\n'.join(f"{name}: {format_stage(progress)}" for name, progress in children.items())
+        finished_stages = '\n'.join(f"{name}: {', '.join(progress['finished_stages']) or 'None'}"
+                                    for name, progress in children.items())
+        child_etas = [progress['eta_seconds'] for progress in children.values()]
+        eta_seconds = max(child_etas) if None not in child_etas else None
+    else:
+        stage = format_stage(status)
+        finished_stages = ', '.join(status['finished_stages']) or 'None'
+        eta_seconds = status['eta_seconds']
+    eta = format_duration(eta_seconds) if eta_seconds is not None else "Unknown"
+
+    embed = discord.Embed(title="🔄 Scraper Run Status", color=discord.Color.blue())
+    embed.add_field(name="Triggered By", value=status['trigger'], inline=True)
+    embed.add_field(name="Stage", value=stage, inline=True)
+    embed.add_field(name="Finished Stages", value=finished_stages, inline=True)
+    embed.add_field(name="Elapsed", value=format_duration(status['elapsed_seconds']), inline=True)
+    embed.add_field(name="ETA", value=eta, inline=True)
+    if status['cancelled']:
+        embed.set_footer(text="Cancelling, finishing in-progress pages")
     await interaction.response.send_message(embed=embed)
-    await run_amazon_cron()
 
 
-async def run_amazon_cron():
+@client.tree.command(name="ap_cancel_run", description="Cancel the active scraper run, keeping partial results")
+@app_commands.checks.has_permissions(administrator=True)
+async def cancel_run(interaction: discord.Interaction):
+    Logger.info("Cancel run Command invoked")
+    if run_manager.cancel():
+        embed = discord.Embed(
+            title="✅ Run Cancelling",
+            description="In-progress pages will finish and partial results will be processed and posted.",
+            color=discord.Color.green()
+        )
+    else:
+        embed = discord.Embed(title="No Active Run", description="The scraper is not running.",
+                              color=discord.Color.orange())
+    await interaction.response.send_message(embed=embed)
+
+
+@client.tree.command(name="ap_export_products", description="Export stored products as a file attachment")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.choices(marketplace=MARKETPLACE_CHOICES, export_format=EXPORT_FORMAT_CHOICES)
+async def export_products_command(interaction: discord.Interaction, export_format: str = 'csv', promo_code: str = None,
+                                  days: int = None, min_sales: int = None, marketplace: str = None):
+    Logger.info(f"Export products Command invoked: {export_format}")
+    await interaction.response.defer()
+
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=days) if days else None
+    path = get_export_path(export_format)
     try:
-        Logger.info("Starting daily Amazon promotion check")
+        exported_count = await export_products(path, export_format, promo_code=promo_code, since=since,
+                                               min_sales=min_sales, marketplace_id=marketplace)
+        if os.path.getsize(path) > EXPORT_DISCORD_MAX_BYTES:
+            embed = discord.Embed(
+                title="Export Too Large",
+                description=f"The export of {exported_count} products is too large to attach. "
+                            f"Narrow the filters or use `python -m cli export`.",
+                color=discord.Color.orange()
+            )
+            await interaction.followup.send(embed=embed)
+            return
+
+        embed = discord.Embed(title="📦 Products Export", description=f"Exported {exported_count} products.",
+                              color=discord.Color.green())
+        await interaction.followup.send(embed=embed, file=discord.File(path))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    Logger.info('Export products Command completed')
 
-        processed_data = await startScraper()
 
-        channel_ids = data_manager.get_notification_channels()
+async def run_marketplace(marketplace: Marketplace, budget: RunBudget) -> ProcessedProductDetails:
+    if DISTRIBUTED_MODE:
+        return await run_coordinator(marketplace=marketplace, budget=budget)
+    return await startScraper(budget=budget, marketplace=marketplace)
 
-        for channel_id in channel_ids:
-            channel = client.get_channel(channel_id)
-            if channel:
-                await send_promo_notification_to_discord(channel, processed_data)
-            else:
-                Logger.warn(f"Channel with ID {channel_id} not found")
 
-        Logger.info("Daily Amazon promotion check completed.")
+async def execute_amazon_run(budget: RunBudget):
+    Logger.info("Starting daily Amazon promotion check")
+
+    processed_by_marketplace = await start_marketplace_scrapers(run_marketplace, budget)
+    for marketplace_id, processed_data in processed_by_marketplace.items():
+        await notify_channels(processed_data, get_marketplace(marketplace_id))
+
+    Logger.info("Daily Amazon promotion check completed.")
+
+
+async def run_amazon_cron(trigger: str = 'schedule'):
+    try:
+        await run_manager.run(trigger, execute_amazon_run, budget_seconds=RUN_TIME_BUDGET, kind=RUN_FULL)
     except Exception as e:
         Logger.critical("An error occurred in daily Amazon promotion check", e)
+
+
+async def execute_scheduled_slice(budget: RunBudget):
+    processed_by_marketplace = await run_slices(budget)
+    # Posted per slice and marketplace, but only when the marketplace's slice found something
+    for marketplace_id, processed_data in processed_by_marketplace.items():
+        if processed_data.upserted or processed_data.changed:
+            await notify_channels(processed_data, get_marketplace(marketplace_id))
+
+
+async def run_scheduled_slice():
+    if run_manager.is_running():
+        Logger.info("Skipping scheduled slice, a run is already active")
+        return
+    try:
+        await run_manager.run('scheduled slice', execute_scheduled_slice, budget_seconds=SCHEDULER_SLICE_BUDGET,
+                              kind=RUN_SLICE)
+    except Exception as e:
+        Logger.critical("An error occurred in a scheduled slice", e)
@@ -0,0 +1,258 @@
+import asyncio
+import socket
+import sys
+import uuid
+import os
+
+
+from adaptive import get_controller, classify_error, OUTCOME_SUCCESS
+from config import JOB_POLL_INTERVAL, JOB_HEARTBEAT_INTERVAL, LIMITING_RESULTS, DELAY_BETWEEN_SEARCHES, \
+    DELAY_BETWEEN_LINKS
+from db import connect_to_database, close_database_connection, get_all_searches, process_products, \
+    get_recent_run_stats, update_search_yields, update_search_term_stats
+from har_manager import HarManager
+from job_queue import enqueue_jobs, claim_job, extend_lease, complete_job, fail_job, fail_exhausted_jobs, \
+    fail_pending_jobs, get_stage_progress, iter_stage_results, JOB_PENDING, JOB_LEASED, JOB_DONE, JOB_FAILED
+from logger import Logger
+from marketplace import Marketplace, get_marketplace
+from models import Stage, PromoCode, Promotion, ProductDetails, ProcessedProductDetails
+from page_archive import PageArchive
+from run_budget import RunBudget
+from scraper import scraping_promo_products_from_search, scrape_promo_codes_from_product_url, \
+    scrape_links_from_promo_code, scrape_product_details_from_url, get_run_id, start_marketplace_scrapers
+from term_stats import SearchTermStats, get_term_stats
+from utils import sleep_randomly, open_browser
+
+# Search jobs are paced by scrape_search_terms with the same controller, so the worker leaves them alone
+STAGE_DELAYS = {
+    Stage.CODES: DELAY_BETWEEN_LINKS,
+    Stage.PROMOS: DELAY_BETWEEN_SEARCHES,
+    Stage.DETAILS: DELAY_BETWEEN_LINKS,
+}
+
+
+async def handle_search_job(payload: dict) -> dict:
+    product_links = await scraping_promo_products_from_search(payload['search_term'],
+                                                              get_marketplace(payload.get('marketplace')))
+    return {"search_term": payload['search_term'], "product_links": product_links}
+
+
+async def handle_codes_job(payload: dict) -> dict:
+    marketplace = get_marketplace(payload.get('marketplace'))
+    async with open_browser(marketplace) as (browser, page):
+        promo_codes = await scrape_promo_codes_from_product_url(page, payload['product_url'])
+    if payload.get('search_terms'):
+        get_term_stats(marketplace.id).share(payload['search_terms'], 'page_loads')
+    return {"promo_codes": list(promo_codes), "search_terms": payload.get('search_terms', [])}
+
+
+async def handle_promos_job(payload: dict) -> dict:
+    promotions, keyword_searches, listing_clicks = await scrape_links_from_promo_code(
+        payload['promo_code'], payload.get('search_terms'), get_marketplace(payload.get('marketplace')))
+    return {"promotions": [promotion.to_dict() for promotion in promotions], "keyword_searches": keyword_searches,
+            "listing_clicks": listing_clicks}
+
+
+async def handle_details_job(payload: dict) -> dict:
+    async with open_browser(get_marketplace(payload.get('marketplace'))) as (browser, page):
+        product_details = await scrape_product_details_from_url(page, Promotion.from_dict(payload))
+    return {"product_details": product_details.to_dict()}
+
+
+JOB_HANDLERS = {
+    Stage.SEARCH: handle_search_job,
+    Stage.CODES: handle_codes_job,
+    Stage.PROMOS: handle_promos_job,
+    Stage.DETAILS: handle_details_job,
+}
+
+
+async def keep_lease_alive(job_id: str, worker_id: str):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        if not await extend_lease(job_id, worker_id):
+            Logger.warn(f"Could not extend lease for job: {job_id}")
+            return
+
+
+async def run_job(job: dict, worker_id: str) -> str:
+    stage = job['stage']
+    Logger.info(f"Worker {worker_id} running {stage} job: {job['key']} (attempt {job['attempts']})")
+    heartbeat = asyncio.create_task(keep_lease_alive(job['_id'], worker_id))
+    marketplace = get_marketplace(job['payload'].get('marketplace'))
+    HarManager().set_stage(stage)
+    PageArchive().start_run(job['run_id'], marketplace.id)
+    # Jobs run one at a time, so the worker's counters hold only this job's search term stats
+    term_stats = get_term_stats(marketplace.id)
+    term_stats.start_run()
+    try:
+        result = await JOB_HANDLERS[stage](job['payload'])
+        await complete_job(job['_id'], worker_id, {**result, "term_stats": term_stats.take()})
+        return OUTCOME_SUCCESS
+    except Exception as e:
+        Logger.error(f"Error running {stage} job: {job['key']}", e)
+        await fail_job(job, worker_id, str(e))
+        return classify_error(e)
+    finally:
+        heartbeat.cancel()
+
+
+async def run_worker(worker_id: str = None, stages: list[str] = None):
+    """Claim and run jobs until cancelled. Several workers can run on different machines."""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    stages = stages or Stage.SCRAPING
+    Logger.info(f"Starting worker {worker_id} for stages: {stages}")
+    HarManager().start_run(worker_id)
+
+    while True:
+        job = await claim_job(worker_id, stages)
+        if job is None:
+            await sleep_randomly(JOB_POLL_INTERVAL, 1, 'No jobs available')
+            continue
+
+        if job['stage'] not in STAGE_DELAYS:
+            await run_job(job, worker_id)
+            continue
+        marketplace = get_marketplace(job['payload'].get('marketplace'))
+        controller = get_controller(job['stage'], STAGE_DELAYS[job['stage']], marketplace.id)
+        await controller.pace()
+        await controller.record(await run_job(job, worker_id))
+
+
+async def wait_for_stage(run_id: str, stage: str, budget: RunBudget) -> dict[str, int]:
+    """
+    Wait until no job of the stage is pending or leased. Once the run is cancelled or the stage's time budget is used
+    up, the jobs not yet started are failed and only the running ones are waited for.
+    """
+    abandoned = False
+    while True:
+        await fail_exhausted_jobs(run_id)
+        progress = await get_stage_progress(run_id, stage)
+        budget.advance(progress[JOB_DONE] + progress[JOB_FAILED] - budget.stage_items_done)
+        Logger.info(f"Run {run_id} stage '{stage}' progress", progress)
+        if progress[JOB_PENDING] == 0 and progress[JOB_LEASED] == 0:
+            return progress
+        if not abandoned and budget.is_exhausted():
+            reason = 'Run cancelled' if budget.cancelled else 'Stage time budget used up'
+            await fail_pending_jobs(run_id, stage, reason)
+            abandoned = True
+            continue
+        await sleep_randomly(JOB_POLL_INTERVAL, 1, f"Waiting for stage '{stage}' to finish")
+
+
+async def run_stage(run_id: str, stage: str, jobs: dict[str, dict], budget: RunBudget):
+    """Enqueue a stage's jobs and wait for them. Nothing is enqueued once the run is cancelled."""
+    if budget.cancelled:
+        Logger.warn(f"Run {run_id} is cancelled, skipping stage '{stage}'")
+        return
+    await enqueue_jobs(run_id, stage, jobs)
+    budget.start_stage(stage, len(jobs))
+    await wait_for_stage(run_id, stage, budget)
+    budget.end_stage()
+
+
+def add_job_term_stats(term_stats: SearchTermStats, result: dict):
+    """Add the search term stats a worker recorded for a job to the run's."""
+    for search_term, stats in result.get('term_stats', {}).items():
+        for field, amount in stats.items():
+            term_stats.add(search_term, field, amount)
+
+
+async def run_coordinator(run_id: str = None, marketplace: Marketplace = None,
+                          budget: RunBudget = None) -> ProcessedProductDetails:
+    """
+    Drive one marketplace's run through the job queue, advancing to the next stage once every job of a stage has
+    finished. Every job carries its marketplace, so one pool of workers serves the runs of all marketplaces. The
+    budget splits its time between the stages as in a local run, and cancelling it stops the run.
+    """
+    marketplace = marketplace or get_marketplace()
+    run_id = run_id or get_run_id(marketplace)
+    budget = budget or RunBudget()
+    budget.set_history(await get_recent_run_stats(marketplace_id=marketplace.id))
+    # Kept apart from the process-wide counters, which a worker in the same process resets for every job
+    term_stats = SearchTermStats()
+    Logger.info(f"Starting distributed run: {run_id}")
+
+    search_items = await get_all_searches(marketplace.id)
+    await run_stage(run_id, Stage.SEARCH, {
+        search: {"search_term": search, "marketplace": marketplace.id} for search in search_items
+    }, budget)
+
+    # Search terms are carried through to the promos stage so each promo code is only searched with its own terms
+    terms_by_link = {}
+    links_by_term = {}
+    async for result in iter_stage_results(run_id, Stage.SEARCH):
+        add_job_term_stats(term_stats, result)
+        links_by_term[result['search_term']] = result['product_links'][:LIMITING_RESULTS]
+        for link in result['product_links'][:LIMITING_RESULTS]:
+            terms_by_link.setdefault(link, set()).add(result.get('search_term'))
+    await update_search_yields(links_by_term, marketplace.id)
+    Logger.info(f"Run {run_id} found {len(terms_by_link)} product links")
+
+    await run_stage(run_id, Stage.CODES, {
+        link: {"product_url": link, "search_terms": sorted(term for term in search_terms if term),
+               "marketplace": marketplace.id}
+        for link, search_terms in terms_by_link.items()
+    }, budget)
+
+    terms_by_code = {}
+    async for result in iter_stage_results(run_id, Stage.CODES):
+        add_job_term_stats(term_stats, result)
+        for code in result['promo_codes']:
+            terms_by_code.setdefault(code, set()).update(result.get('search_terms', []))
+    for search_terms in terms_by_code.values():
+        for search_term in search_terms:
+            term_stats.add(search_term, 'promo_codes')
+    term_stats.set_promo_code_terms(PromoCode(code, sorted(search_terms))
+                                    for code, search_terms in terms_by_code.items())
+    Logger.info(f"Run {run_id} found {len(terms_by_code)} promo codes")
+
+    await run_stage(run_id, Stage.PROMOS, {
+        code: {"promo_code": code, "search_terms": sorted(search_terms), "marketplace": marketplace.id}
+        for code, search_terms in terms_by_code.items()
+    }, budget)
+
+    promotions = {}
+    async for result in iter_stage_results(run_id, Stage.PROMOS):
+        add_job_term_stats(term_stats, result)
+        for promotion in result['promotions']:
+            promotions[f"{promotion['promotion_code']}/{promotion['product_url']}"] = promotion
+    Logger.info(f"Run {run_id} found {len(promotions)} items with promotions")
+
+    await run_stage(run_id, Stage.DETAILS, promotions, budget)
+
+    product_details_list = []
+    async for result in iter_stage_results(run_id, Stage.DETAILS):
+        product_details = ProductDetails.from_dict(result['product_details'])
+        term_stats.share_for_promo_code(product_details.promotion_code, 'page_loads')
+        product_details_list.append(product_details)
+
+    Logger.info(f"Finished distributed run: {run_id}")
+    processed_products = await process_products(product_details_list)
+    for product in processed_products.upserted:
+        term_stats.share_for_promo_code(product.promotion_code, 'deals')
+    try:
+        await update_search_term_stats(term_stats.take(), marketplace.id)
+    except Exception as e:
+        Logger.error('Error saving search term stats', e)
+    return processed_products
+
+
+async def main():
+    await connect_to_database()
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'coordinator':
+            run_id = sys.argv[2] if len(sys.argv) > 2 else None
+            await start_marketplace_scrapers(
+                lambda marketplace, budget: run_coordinator(get_run_id(marketplace, run_id), marketplace, budget))
+        else:
+            await run_worker(stages=sys.argv[2].split(',') if len(sys.argv) > 2 else None)
+    finally:
+        close_database_connection()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        Logger.critical('An error occurred', e)
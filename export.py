@@ -0,0 +1,166 @@
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import time
+from datetime import datetime
+
+from config import EXPORT_BATCH_SIZE, EXPORT_DIRECTORY, DEFAULT_MARKETPLACE
+from db import connect_to_database, get_products_cursor, get_marketplace_query
+from logger import Logger
+
+EXPORT_FORMATS = ['csv', 'jsonl', 'parquet']
+# Parquet needs the optional pyarrow, so it is only offered where pyarrow is installed
+AVAILABLE_EXPORT_FORMATS = [export_format for export_format in EXPORT_FORMATS
+                            if export_format != 'parquet' or importlib.util.find_spec('pyarrow') is not None]
+
+# Exported columns, in order. _id is exported as product_id.
+EXPORT_FIELDS = [
+    'product_id',
+    'marketplace',
+    'product_asin',
+    'product_title',
+    'product_url',
+    'product_image_url',
+    'product_price',
+    'product_price_value',
+    'product_sales',
+    'promotion_code',
+    'promotion_title',
+    'last_updated',
+]
+
+
+def build_export_query(promo_code: str = None, since: datetime = None, until: datetime = None,
+                       min_sales: int = None, marketplace_id: str = None) -> dict:
+    query = {}
+    if marketplace_id:
+        query.update(get_marketplace_query(marketplace_id))
+    if promo_code:
+        query['promotion_code'] = promo_code
+    if since or until:
+        query['last_updated'] = {}
+        if since:
+            query['last_updated']['$gte'] = since
+        if until:
+            query['last_updated']['$lt'] = until
+    if min_sales is not None:
+        query['product_sales'] = {'$gte': min_sales}
+    return query
+
+
+def to_export_row(doc: dict) -> dict:
+    row = {field: doc.get(field) for field in EXPORT_FIELDS}
+    row['product_id'] = doc['_id']
+    row['marketplace'] = doc.get('marketplace') or DEFAULT_MARKETPLACE
+    return row
+
+
+class CsvExportWriter:
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=EXPORT_FIELDS)
+        self.writer.writeheader()
+
+    def write_rows(self, rows: list[dict]):
+        for row in rows:
+            if row['last_updated'] is not None:
+                row['last_updated'] = row['last_updated'].isoformat()
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlExportWriter:
+    def __init__(self, path: str):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write_rows(self, rows: list[dict]):
+        self.file.write(''.join(json.dumps(row, default=str) + '\n' for row in rows))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExportWriter:
+    """Writes each batch as a row group, so only one batch is held in memory. Needs the optional pyarrow package."""
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError('Parquet export requires pyarrow: pip install pyarrow') from e
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ('product_id', pyarrow.string()),
+            ('marketplace', pyarrow.string()),
+            ('product_asin', pyarrow.string()),
+            ('product_title', pyarrow.string()),
+            ('product_url', pyarrow.string()),
+            ('product_image_url', pyarrow.string()),
+            ('product_price', pyarrow.string()),
+            ('product_price_value', pyarrow.float64()),
+            ('product_sales', pyarrow.int64()),
+            ('promotion_code', pyarrow.string()),
+            ('promotion_title', pyarrow.string()),
+            ('last_updated', pyarrow.timestamp('ms')),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows: list[dict]):
+        self.writer.write_table(self.pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+EXPORT_WRITERS = {
+    'csv': CsvExportWriter,
+    'jsonl': JsonlExportWriter,
+    'parquet': ParquetExportWriter,
+}
+
+
+def get_export_path(export_format: str) -> str:
+    os.makedirs(EXPORT_DIRECTORY, exist_ok=True)
+    return os.path.join(EXPORT_DIRECTORY, f"products-{time.strftime('%Y%m%d-%H%M%S')}.{export_format}")
+
+
+async def export_products(path: str, export_format: str, promo_code: str = None, since: datetime = None,
+                          until: datetime = None, min_sales: int = None, marketplace_id: str = None) -> int:
+    """
+    Stream the matching products into a file one cursor batch at a time, so memory use does not grow with the
+    collection. Returns the number of exported products.
+    """
+    if export_format not in EXPORT_WRITERS:
+        raise ValueError(f"Unknown export format: {export_format}")
+
+    await connect_to_database()
+    query = build_export_query(promo_code, since, until, min_sales, marketplace_id)
+    projection = {field: 1 for field in EXPORT_FIELDS if field != 'product_id'}
+    Logger.info(f"Exporting products to {path}", query)
+
+    start_time = time.time()
+    writer = EXPORT_WRITERS[export_format](path)
+    exported_count = 0
+    try:
+        rows = []
+        async for doc in get_products_cursor(query, projection, EXPORT_BATCH_SIZE):
+            rows.append(to_export_row(doc))
+            if len(rows) >= EXPORT_BATCH_SIZE:
+                # Written in a thread so a large export does not stall the bot's event loop
+                await asyncio.to_thread(writer.write_rows, rows)
+                exported_count += len(rows)
+                rows = []
+        if rows:
+            await asyncio.to_thread(writer.write_rows, rows)
+            exported_count += len(rows)
+    finally:
+        writer.close()
+
+    Logger.info(f"Exported {exported_count} products to {path} in {time.time() - start_time:.1f}s")
+    return exported_count
@@ -0,0 +1,75 @@
+import re
+
+from models import ProductDetails, Promotion
+
+ASIN_PATTERN = re.compile(r'/(?:dp|gp/product)/(\w+)')
+
+# Runs in the product page. Shared by the live details stage and the offline re-extraction of archived pages.
+PRODUCT_DETAILS_SCRIPT = r'''
+    () => {
+        const product_title = document.querySelector('#productTitle').innerText;
+        const product_url = window.location.href;
+        const product_img = document.querySelector('#landingImage').src;
+
+        // Get the ASIN (extracted from the product URL)
+        const asin = product_url ? product_url.match(/\/dp\/(\w+)/) ? product_url.match(/\/dp\/(\w+)/)[1] : null : null;
+
+        // Get the current price
+        const priceElement = document.querySelector('#corePriceDisplay_desktop_feature_div .reinventPricePriceToPayMargin');
+        const current_price = priceElement ? priceElement.textContent.trim() : null;
+
+        // Get sales in last month
+        const salesElement = document.querySelector('#social-proofing-faceout-title-tk_bought');
+        const sales_last_month_raw = salesElement ? salesElement.textContent.trim() : 'N/A';
+
+        // Function to convert sales string to number
+        const convertSales = (salesStr) => {
+            // Thousands separators differ between marketplaces, e.g. '1,000+' and '1.000+'
+            const match = salesStr.replace(/(\d)[.,](?=\d{3}\b)/g, '$1').match(/(\d+)\s*([KM]?)\+?/);
+            if (match) {
+                const number = parseInt(match[1]);
+                const unit = match[2];
+                if (unit === 'K') {
+                    return number * 1000;
+                } else if (unit === 'M') {
+                    return number * 1000000;
+                } else {
+                    return number;
+                }
+            }
+            return 0;
+        };
+
+        // Convert sales_last_month to number
+        const sales_last_month = convertSales(sales_last_month_raw);
+
+        return {
+            product_img,
+            product_title,
+            product_url,
+            asin,
+            current_price,
+            sales_last_month
+        };
+    }
+'''
+
+
+def build_product_details(promotion_link: Promotion, product: dict) -> ProductDetails:
+    return ProductDetails(
+        promotion_code=promotion_link.promotion_code,
+        promotion_title=promotion_link.promotion_title,
+        promotion_url=promotion_link.promotion_url,
+        product_url=promotion_link.product_url,
+        product_title=product['product_title'],
+        product_image_url=product['product_img'],
+        product_price=product['current_price'],
+        product_sales=product['sales_last_month'],
+        product_asin=product['asin'],
+        marketplace=promotion_link.marketplace,
+    )
+
+
+def get_asin_from_url(url: str) -> str | None:
+    match = ASIN_PATTERN.search(url or '')
+    return match.group(1) if match else None
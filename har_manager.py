@@ -0,0 +1,72 @@
+import glob
+import os
+
+from dotenv import load_dotenv
+
+from config import HAR_DIRECTORY
+from logger import Logger
+
+load_dotenv()
+
+HAR_MODE_OFF = 'off'
+HAR_MODE_RECORD = 'record'
+HAR_MODE_REPLAY = 'replay'
+
+
+class HarManager:
+    """
+    Records the network traffic of every browser context into one HAR file per context, grouped by stage, or serves
+    a recorded run back from those files with every other request aborted.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(HarManager, cls).__new__(cls)
+            cls._instance.mode = os.getenv('HAR_MODE', HAR_MODE_OFF).lower()
+            cls._instance.directory = None
+            cls._instance.stage = 'setup'
+            cls._instance.context_counts = {}
+        return cls._instance
+
+    def configure(self, mode: str, recording: str = None):
+        self.mode = mode
+        self.directory = None
+        if mode == HAR_MODE_REPLAY:
+            self.directory = self.get_recording_directory(recording or os.getenv('HAR_RECORDING'))
+
+    def get_recording_directory(self, recording: str = None) -> str:
+        if recording:
+            return os.path.join(HAR_DIRECTORY, recording)
+        recordings = sorted(glob.glob(os.path.join(HAR_DIRECTORY, '*')))
+        if not recordings:
+            raise FileNotFoundError(f"No HAR recordings found in {HAR_DIRECTORY}")
+        return recordings[-1]
+
+    def start_run(self, run_id: str):
+        if self.mode == HAR_MODE_RECORD:
+            self.directory = os.path.join(HAR_DIRECTORY, run_id)
+            os.makedirs(self.directory, exist_ok=True)
+            Logger.info(f"Recording network traffic into {self.directory}")
+        elif self.mode == HAR_MODE_REPLAY:
+            self.directory = self.directory or self.get_recording_directory(os.getenv('HAR_RECORDING'))
+            Logger.info(f"Replaying network traffic from {self.directory}")
+        self.context_counts = {}
+
+    def is_replaying(self) -> bool:
+        return self.mode == HAR_MODE_REPLAY
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+
+    async def attach(self, context):
+        if self.mode == HAR_MODE_RECORD and self.directory:
+            count = self.context_counts.get(self.stage, 0) + 1
+            self.context_counts[self.stage] = count
+            har_path = os.path.join(self.directory, f"{self.stage}-{count:04d}.har")
+            await context.route_from_har(har_path, update=True, update_content='embed', update_mode='full')
+        elif self.mode == HAR_MODE_REPLAY and self.directory:
+            # Routes registered later are tried first, so the catch-all abort goes in before the recordings
+            await context.route('**/*', lambda route: route.abort())
+            for har_path in sorted(glob.glob(os.path.join(self.directory, f"{self.stage}-*.har"))):
+                await context.route_from_har(har_path, not_found='fallback')
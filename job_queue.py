@@ -0,0 +1,177 @@
+import hashlib
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument, UpdateOne
+
+import db
+from config import JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS
+from logger import Logger
+
+JOB_PENDING = 'pending'
+JOB_LEASED = 'leased'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+def get_job_id(run_id: str, stage: str, key: str) -> str:
+    key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return f"{run_id}/{stage}/{key_hash}"
+
+
+async def enqueue_jobs(run_id: str, stage: str, jobs: dict[str, dict]) -> int:
+    """Enqueue one job per key. Keys already enqueued for this run and stage are left untouched."""
+    if not jobs:
+        return 0
+
+    current_time = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": get_job_id(run_id, stage, key)},
+            {"$setOnInsert": {
+                "run_id": run_id,
+                "stage": stage,
+                "key": key,
+                "payload": payload,
+                "status": JOB_PENDING,
+                "lease_expiry": None,
+                "worker_id": None,
+                "attempts": 0,
+                "result": None,
+                "error": None,
+                "created_at": current_time,
+                "updated_at": current_time
+            }},
+            upsert=True
+        )
+        for key, payload in jobs.items()
+    ]
+    result = await db.jobs_collection.bulk_write(operations, ordered=False)
+    Logger.info(f"Enqueued {result.upserted_count} {stage} jobs for run {run_id}")
+    return result.upserted_count
+
+
+async def claim_job(worker_id: str, stages: list[str]) -> dict | None:
+    """Atomically lease the oldest pending job, or a leased job whose lease has expired."""
+    current_time = datetime.utcnow()
+    return await db.jobs_collection.find_one_and_update(
+        {
+            "stage": {"$in": stages},
+            "attempts": {"$lt": JOB_MAX_ATTEMPTS},
+            "$or": [
+                {"status": JOB_PENDING},
+                {"status": JOB_LEASED, "lease_expiry": {"$lt": current_time}}
+            ]
+        },
+        {
+            "$set": {
+                "status": JOB_LEASED,
+                "worker_id": worker_id,
+                "lease_expiry": current_time + timedelta(seconds=JOB_LEASE_SECONDS),
+                "updated_at": current_time
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def extend_lease(job_id: str, worker_id: str) -> bool:
+    current_time = datetime.utcnow()
+    result = await db.jobs_collection.update_one(
+        {"_id": job_id, "worker_id": worker_id, "status": JOB_LEASED},
+        {"$set": {
+            "lease_expiry": current_time + timedelta(seconds=JOB_LEASE_SECONDS),
+            "updated_at": current_time
+        }}
+    )
+    return result.matched_count > 0
+
+
+async def complete_job(job_id: str, worker_id: str, result: dict) -> bool:
+    """Write the job result back. Returns False if the lease was lost to another worker."""
+    update_result = await db.jobs_collection.update_one(
+        {"_id": job_id, "worker_id": worker_id, "status": JOB_LEASED},
+        {"$set": {
+            "status": JOB_DONE,
+            "result": result,
+            "lease_expiry": None,
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    if update_result.matched_count == 0:
+        Logger.warn(f"Lease lost before completing job: {job_id}")
+        return False
+    return True
+
+
+async def fail_job(job: dict, worker_id: str, error: str) -> None:
+    status = JOB_FAILED if job['attempts'] >= JOB_MAX_ATTEMPTS else JOB_PENDING
+    await db.jobs_collection.update_one(
+        {"_id": job['_id'], "worker_id": worker_id, "status": JOB_LEASED},
+        {"$set": {
+            "status": status,
+            "error": error,
+            "lease_expiry": None,
+            "updated_at": datetime.utcnow()
+        }}
+    )
+    Logger.warn(f"Job {job['_id']} failed on attempt {job['attempts']}, marked as {status}")
+
+
+async def fail_exhausted_jobs(run_id: str) -> int:
+    """Mark expired leases that have no attempts left as failed so the stage can finish."""
+    result = await db.jobs_collection.update_many(
+        {
+            "run_id": run_id,
+            "status": JOB_LEASED,
+            "lease_expiry": {"$lt": datetime.utcnow()},
+            "attempts": {"$gte": JOB_MAX_ATTEMPTS}
+        },
+        {"$set": {"status": JOB_FAILED, "error": "Lease expired", "updated_at": datetime.utcnow()}}
+    )
+    if result.modified_count:
+        Logger.warn(f"Marked {result.modified_count} abandoned jobs as failed for run {run_id}")
+    return result.modified_count
+
+
+async def fail_pending_jobs(run_id: str, stage: str, error: str) -> int:
+    """
+    Fail the jobs of a stage that no worker is running, such as when the run is cancelled. Leased jobs are left to
+    finish and keep their results.
+    """
+    current_time = datetime.utcnow()
+    result = await db.jobs_collection.update_many(
+        {
+            "run_id": run_id,
+            "stage": stage,
+            "$or": [
+                {"status": JOB_PENDING},
+                {"status": JOB_LEASED, "lease_expiry": {"$lt": current_time}}
+            ]
+        },
+        {"$set": {"status": JOB_FAILED, "error": error, "lease_expiry": None, "updated_at": current_time}}
+    )
+    if result.modified_count:
+        Logger.warn(f"Failed {result.modified_count} {stage} jobs of run {run_id}: {error}")
+    return result.modified_count
+
+
+async def get_stage_progress(run_id: str, stage: str) -> dict[str, int]:
+    progress = {JOB_PENDING: 0, JOB_LEASED: 0, JOB_DONE: 0, JOB_FAILED: 0}
+    cursor = db.jobs_collection.aggregate([
+        {"$match": {"run_id": run_id, "stage": stage}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ])
+    async for doc in cursor:
+        progress[doc['_id']] = doc['count']
+    return progress
+
+
+async def iter_stage_results(run_id: str, stage: str):
+    cursor = db.jobs_collection.find(
+        {"run_id": run_id, "stage": stage, "status": JOB_DONE},
+        {"result": 1}
+    )
+    async for doc in cursor:
+        yield doc['result']
@@ -0,0 +1,124 @@
+import os
+import re
+import urllib.parse
+
+from dotenv import load_dotenv
+
+from config import DEFAULT_MARKETPLACE, ENABLED_MARKETPLACES, POST_CODE
+
+load_dotenv()
+
+
+class Marketplace:
+    """An Amazon storefront, with everything the scraper visits, reads or types that differs between storefronts."""
+
+    def __init__(self, id: str, name: str, domain: str, locale: str, timezone: str, post_code: str,
+                 latitude: float, longitude: float, promotion_title_pattern: str, promo_patterns: list[str],
+                 sales_text_pattern: str):
+        self.id = id
+        self.name = name
+        self.domain = domain
+        self.locale = locale
+        self.timezone = timezone
+        self.post_code = post_code
+        self.latitude = latitude
+        self.longitude = longitude
+        self.promotion_title_pattern = promotion_title_pattern
+        self.promo_patterns = promo_patterns
+        self.sales_text_pattern = sales_text_pattern
+
+    @property
+    def base_url(self) -> str:
+        return f"https://www.{self.domain}"
+
+    def get_search_url(self, search_term: str, page_num: int) -> str:
+        return f"{self.base_url}/s?k={urllib.parse.quote(search_term)}&page={page_num}"
+
+    def get_promotion_url(self, promo_code: str) -> str:
+        return f"{self.base_url}/promotion/psp/{promo_code}"
+
+    def parse_promotion_title(self, page_title: str) -> str | None:
+        """The promotion's title from its page title, None if the page is not a promotion page."""
+        match = re.match(self.promotion_title_pattern, page_title)
+        return match.group(1) if match else None
+
+    def is_supported_promotion(self, promotion_title: str) -> bool:
+        return any(re.match(pattern, promotion_title, re.IGNORECASE) for pattern in self.promo_patterns)
+
+    def get_profile_directory(self) -> str:
+        # The default marketplace keeps the profile directory used before there were several
+        if self.id == DEFAULT_MARKETPLACE:
+            return 'chrome_user_data'
+        return f"chrome_user_data_{self.id}"
+
+
+MARKETPLACES = {
+    'uk': Marketplace(
+        id='uk',
+        name='Amazon.co.uk',
+        domain='amazon.co.uk',
+        locale='en-GB',
+        timezone='Europe/London',
+        post_code=POST_CODE,
+        # Farnham
+        latitude=51.2150,
+        longitude=-0.7986,
+        promotion_title_pattern=r'^Amazon\.co\.uk: (.*) promotion$',
+        promo_patterns=[
+            r'^.*Get \d+ for the price of \d+.*$',
+            r'^.*Get any.*$',
+            r'^.*2 for.*$',
+            r'^.*Save £?\d+(\.\d{2})? on any .*$'
+        ],
+        sales_text_pattern='bought in past month'
+    ),
+    'de': Marketplace(
+        id='de',
+        name='Amazon.de',
+        domain='amazon.de',
+        locale='de-DE',
+        timezone='Europe/Berlin',
+        post_code='10115',
+        # Berlin
+        latitude=52.5200,
+        longitude=13.4050,
+        promotion_title_pattern=r'^Amazon\.de ?: (.*?)(?: Aktion| Promotion)?$',
+        promo_patterns=[
+            r'^.*Kaufe \d+,? (zahle|bezahle) \d+.*$',
+            r'^.*\d+ für .*$',
+            r'^.*Spare (\d+ ?%|\d+(,\d{2})? ?€) beim Kauf .*$'
+        ],
+        sales_text_pattern='im letzten Monat gekauft'
+    ),
+    'fr': Marketplace(
+        id='fr',
+        name='Amazon.fr',
+        domain='amazon.fr',
+        locale='fr-FR',
+        timezone='Europe/Paris',
+        post_code='75001',
+        # Paris
+        latitude=48.8566,
+        longitude=2.3522,
+        promotion_title_pattern=r'^Amazon\.fr ?: (.*?)(?: promotion)?$',
+        promo_patterns=[
+            r'^.*Achetez(-en)? \d+,? (payez|obtenez)(-en)? \d+.*$',
+            r'^.*\d+ pour .*$',
+            r'^.*Économisez (\d+ ?%|\d+(,\d{2})? ?€) .*$'
+        ],
+        sales_text_pattern='achetés? (au cours du|le) mois dernier'
+    ),
+}
+
+
+def get_marketplace(marketplace_id: str = None) -> Marketplace:
+    marketplace_id = marketplace_id or DEFAULT_MARKETPLACE
+    if marketplace_id not in MARKETPLACES:
+        raise ValueError(f"Unknown marketplace: {marketplace_id}")
+    return MARKETPLACES[marketplace_id]
+
+
+def get_enabled_marketplaces() -> list[Marketplace]:
+    marketplace_ids = os.getenv('MARKETPLACES', ','.join(ENABLED_MARKETPLACES))
+    return [get_marketplace(marketplace_id.strip()) for marketplace_id in marketplace_ids.split(',')
+            if marketplace_id.strip()]
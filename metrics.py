@@ -0,0 +1,93 @@
+import threading
+
+from logger import Logger
+
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS) if value <= bound), len(HISTOGRAM_BUCKETS))
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, quantile: float) -> float:
+        """Upper bound of the bucket holding the given quantile."""
+        if self.count == 0:
+            return 0.0
+        target = quantile * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return HISTOGRAM_BUCKETS[index] if index < len(HISTOGRAM_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total': round(self.total, 4),
+            'mean': round(self.total / self.count, 4) if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': round(self.max, 4)
+        }
+
+
+class Metrics:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Metrics, cls).__new__(cls)
+            cls._instance.counters = {}
+            cls._instance.gauges = {}
+            cls._instance.histograms = {}
+            cls._instance.lock = threading.Lock()
+        return cls._instance
+
+    def increment(self, name: str, value: float = 1):
+        """Increase a counter by the given value."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """Set a gauge to its current value."""
+        self.gauges[name] = value
+
+    def get_gauge(self, name: str, default: float = None):
+        """Get the current value of a gauge."""
+        return self.gauges.get(name, default)
+
+    def observe(self, name: str, value: float):
+        """Record a value, usually a latency in seconds, in a histogram. Safe to call from other threads."""
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def get_histogram_total(self, prefix: str) -> float:
+        """Sum of all values recorded in histograms whose name starts with the prefix."""
+        with self.lock:
+            return sum(histogram.total for name, histogram in self.histograms.items() if name.startswith(prefix))
+
+    def snapshot(self) -> dict:
+        """Get a copy of all metrics."""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+            }
+
+    def log_snapshot(self):
+        Logger.info('Current metrics', self.snapshot())
@@ -1,21 +1,85 @@
+import hashlib
 import json
 
+from config import DEFAULT_MARKETPLACE
+
+
+class Stage:
+    SEARCH = 'search'
+    CODES = 'codes'
+    PROMOS = 'promos'
+    DETAILS = 'details'
+    PROCESS = 'process'
+
+    SCRAPING = [SEARCH, CODES, PROMOS, DETAILS]
+
+
+class ProductLink:
+    """A product link from the search stage, with the search terms whose results contained it."""
+
+    def __init__(self, url: str, search_terms: list[str] = None):
+        self.url = url
+        self.search_terms = search_terms or []
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "search_terms": self.search_terms
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'ProductLink':
+        return ProductLink(url=data['url'], search_terms=data.get('search_terms', []))
+
+
+class PromoCode:
+    """A promo code from the codes stage, with the search terms that led to the products it was found on."""
+
+    def __init__(self, code: str, search_terms: list[str] = None):
+        self.code = code
+        self.search_terms = search_terms or []
+
+    def to_dict(self):
+        return {
+            "promo_code": self.code,
+            "search_terms": self.search_terms
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'PromoCode':
+        return PromoCode(code=data['promo_code'], search_terms=data.get('search_terms', []))
+
 
 class Promotion:
-    def __init__(self, promotion_code: str, promotion_title: str, promotion_url: str, product_url: str):
+    def __init__(self, promotion_code: str, promotion_title: str, promotion_url: str, product_url: str,
+                 marketplace: str = DEFAULT_MARKETPLACE):
         self.promotion_code = promotion_code
         self.promotion_title = promotion_title
         self.promotion_url = promotion_url
         self.product_url = product_url
+        self.marketplace = marketplace
 
-    def to_json(self):
-        json_object = {
+    def to_dict(self):
+        return {
             "promotion_code": self.promotion_code,
             "promotion_title": self.promotion_title,
             "promotion_url": self.promotion_url,
-            "product_url": self.product_url
+            "product_url": self.product_url,
+            "marketplace": self.marketplace
         }
-        return json.dumps(json_object, indent=2)
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Promotion':
+        return Promotion(
+            promotion_code=data['promotion_code'],
+            promotion_title=data['promotion_title'],
+            promotion_url=data['promotion_url'],
+            product_url=data['product_url'],
+            marketplace=data.get('marketplace', DEFAULT_MARKETPLACE)
+        )
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
 
     def __str__(self):
         return self.to_json()
@@ -26,7 +90,8 @@ class Promotion:
 
 class ProductDetails:
     def __init__(self, promotion_code: str, promotion_title: str, promotion_url: str, product_url: str,
-                 product_title: str, product_image_url: str, product_price: str, product_sales: int, product_asin: str):
+                 product_title: str, product_image_url: str, product_price: str, product_sales: int, product_asin: str,
+                 marketplace: str = DEFAULT_MARKETPLACE):
         self.id = f"{product_asin}/{promotion_code}"
         self.promotion_code = promotion_code
         self.promotion_title = promotion_title
@@ -37,9 +102,10 @@ class ProductDetails:
         self.product_price = product_price
         self.product_sales = product_sales
         self.product_asin = product_asin
+        self.marketplace = marketplace
 
-    def to_json(self):
-        json_object = {
+    def to_dict(self):
+        return {
             'id': self.id,
             "promotion_code": self.promotion_code,
             "promotion_title": self.promotion_title,
@@ -49,9 +115,38 @@ class ProductDetails:
             "product_image_url": self.product_image_url,
             "product_price": self.product_price,
             "product_sales": self.product_sales,
-            "product_asin": self.product_asin
+            "product_asin": self.product_asin,
+            "marketplace": self.marketplace
+        }
+
+    def get_content_hash(self):
+        # Only the fields a deal is judged on. URLs carry query strings that change between runs.
+        content = {
+            "promotion_code": self.promotion_code,
+            "promotion_title": self.promotion_title,
+            "product_title": self.product_title,
+            "product_price": self.product_price,
+            "product_sales": self.product_sales
         }
-        return json.dumps(json_object, indent=2)
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def from_dict(data: dict) -> 'ProductDetails':
+        return ProductDetails(
+            promotion_code=data['promotion_code'],
+            promotion_title=data['promotion_title'],
+            promotion_url=data['promotion_url'],
+            product_url=data['product_url'],
+            product_title=data['product_title'],
+            product_image_url=data['product_image_url'],
+            product_price=data['product_price'],
+            product_sales=data['product_sales'],
+            product_asin=data['product_asin'],
+            marketplace=data.get('marketplace', DEFAULT_MARKETPLACE)
+        )
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
 
     def __str__(self):
         return self.to_json()
@@ -63,5 +158,9 @@ class ProductDetails:
 class ProcessedProductDetails:
     def __init__(self):
         self.upserted = []
-        self.up_to_date = []
-        self.below_threshold = []
+        self.changed = []
+        self.up_to_date_count = 0
+        self.below_threshold_count = 0
+
+    def get_total_count(self):
+        return len(self.upserted) + len(self.changed) + self.up_to_date_count + self.below_threshold_count
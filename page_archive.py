@@ -0,0 +1,127 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+from config import ARCHIVE_DIRECTORY, ARCHIVE_PAGES, ARCHIVE_RETENTION_DAYS, DEFAULT_MARKETPLACE
+from logger import Logger
+from metrics import Metrics
+from models import Promotion
+from spool import Spool
+
+load_dotenv()
+
+
+def get_page_path(content_hash: str) -> str:
+    return os.path.join(ARCHIVE_DIRECTORY, 'pages', content_hash[:2], f"{content_hash}.html.gz")
+
+
+def get_manifest_path(run_id: str) -> str:
+    return os.path.join(ARCHIVE_DIRECTORY, 'runs', f"{run_id}.jsonl")
+
+
+def write_page(content_hash: str, html: str) -> bool:
+    """Store a gzipped page under its content hash. Returns False if the same page was already stored."""
+    path = get_page_path(content_hash)
+    if os.path.exists(path):
+        # Refreshed so that cleanup only removes pages no recent run has seen
+        os.utime(path)
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            file.write(gzip.compress(html.encode('utf-8')))
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return True
+
+
+def load_page(content_hash: str) -> str:
+    with gzip.open(get_page_path(content_hash), 'rt', encoding='utf-8') as file:
+        return file.read()
+
+
+def get_manifest(run_id: str) -> Spool:
+    """One line per archived product page of a run: the promotion it was scraped for, its URL and its content hash."""
+    return Spool(get_manifest_path(run_id))
+
+
+class PageArchive:
+    """
+    Keeps the raw HTML of every product page the details stage loads, so that extraction can be re-run offline
+    after a selector fix. Identical pages are stored once.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(PageArchive, cls).__new__(cls)
+            cls._instance.enabled = os.getenv('ARCHIVE_PAGES', str(ARCHIVE_PAGES)).lower() == 'true'
+            cls._instance.run_ids = {}
+            cls._instance.manifests = {}
+        return cls._instance
+
+    def start_run(self, run_id: str, marketplace_id: str = DEFAULT_MARKETPLACE):
+        """Each marketplace's concurrent run writes its own manifest."""
+        if not self.enabled or run_id == self.run_ids.get(marketplace_id):
+            return
+        self.run_ids[marketplace_id] = run_id
+        self.manifests[marketplace_id] = get_manifest(run_id)
+        Logger.info(f"Archiving product pages of run {run_id} into {ARCHIVE_DIRECTORY}")
+
+    async def archive_page(self, page) -> str | None:
+        """Store the page's HTML and return its content hash, without adding it to the run's manifest."""
+        if not self.manifests:
+            return None
+        try:
+            html = await page.content()
+            content_hash = hashlib.sha256(html.encode('utf-8')).hexdigest()
+            is_new = await asyncio.to_thread(write_page, content_hash, html)
+            Metrics().increment('archive.pages_stored' if is_new else 'archive.pages_deduplicated')
+            return content_hash
+        except Exception as e:
+            Logger.error(f"Error archiving page: {page.url}", e)
+            return None
+
+    def record(self, url: str, content_hash: str, promotion: Promotion):
+        manifest = self.manifests.get(promotion.marketplace)
+        if manifest is None or content_hash is None:
+            return
+        manifest.append({
+            'url': url,
+            'content_hash': content_hash,
+            'archived_at': time.time(),
+            'promotion': promotion.to_dict()
+        })
+        # Flushed per page so that a crashed run still leaves a usable manifest
+        manifest.flush()
+
+    async def store(self, page, promotion: Promotion):
+        self.record(page.url, await self.archive_page(page), promotion)
+
+
+def remove_files_older_than(directory: str, cutoff_time: float) -> int:
+    removed = 0
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            if os.path.getmtime(path) < cutoff_time:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def cleanup_old_archives():
+    cutoff_time = time.time() - ARCHIVE_RETENTION_DAYS * 24 * 60 * 60
+    remove_files_older_than(os.path.join(ARCHIVE_DIRECTORY, 'runs'), cutoff_time)
+    removed_pages = remove_files_older_than(os.path.join(ARCHIVE_DIRECTORY, 'pages'), cutoff_time)
+    if removed_pages:
+        Logger.info(f"Removed {removed_pages} archived pages older than {ARCHIVE_RETENTION_DAYS} days")
@@ -0,0 +1,104 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from config import PROFILE_DIRECTORY, PROFILE_TOP_N
+from logger import Logger
+from metrics import Metrics
+
+load_dotenv()
+
+
+class StageProfiler:
+    """
+    Opt-in profiling of scraper stages. Each stage gets a cProfile dump, a tracemalloc comparison with the previous
+    stage boundary and a line in the run summary splitting wall time into CPU, database and sleeping time.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(StageProfiler, cls).__new__(cls)
+            cls._instance.enabled = os.getenv('PROFILE_SCRAPER', 'false').lower() == 'true'
+            cls._instance.directory = None
+            cls._instance.snapshot = None
+            cls._instance.summary = []
+        return cls._instance
+
+    def set_enabled(self, enabled: bool):
+        Logger.info(f"Setting scraper profiling: {enabled}")
+        self.enabled = enabled
+
+    def start_run(self, run_id: str):
+        if not self.enabled:
+            return
+        self.directory = os.path.join(PROFILE_DIRECTORY, f"{run_id}-{time.strftime('%Y%m%d-%H%M%S')}")
+        os.makedirs(self.directory, exist_ok=True)
+        self.summary = []
+        tracemalloc.start()
+        self.snapshot = tracemalloc.take_snapshot()
+        Logger.info(f"Profiling run {run_id} into {self.directory}")
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.directory is None:
+            yield
+            return
+
+        metrics = Metrics()
+        profile = cProfile.Profile()
+        wall_start, cpu_start = time.time(), time.process_time()
+        database_start, sleep_start = metrics.get_histogram_total('db.'), metrics.counters.get('sleep_seconds', 0)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            wall_time = time.time() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            database_time = metrics.get_histogram_total('db.') - database_start
+            sleep_time = metrics.counters.get('sleep_seconds', 0) - sleep_start
+            self.write_stage(name, profile, wall_time, cpu_time, database_time, sleep_time)
+
+    def write_stage(self, name, profile, wall_time, cpu_time, database_time, sleep_time):
+        index = len(self.summary) + 1
+        profile.dump_stats(os.path.join(self.directory, f"{index}-{name}.prof"))
+
+        stats_output = io.StringIO()
+        pstats.Stats(profile, stream=stats_output).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+
+        snapshot = tracemalloc.take_snapshot()
+        memory_diff = snapshot.compare_to(self.snapshot, 'lineno')[:PROFILE_TOP_N]
+        self.snapshot = snapshot
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        with open(os.path.join(self.directory, f"{index}-{name}.memory.txt"), 'w') as file:
+            file.write(f"Current: {current_memory / 1024 / 1024:.2f} MiB, Peak: {peak_memory / 1024 / 1024:.2f} MiB\n\n")
+            file.write('\n'.join(str(stat) for stat in memory_diff))
+
+        # Concurrent tabs overlap, so the parts can add up to more than the wall time
+        waiting_time = max(wall_time - cpu_time - database_time - sleep_time, 0)
+        self.summary.append(
+            f"== {name} ==\n"
+            f"wall {wall_time:.1f}s | cpu {cpu_time:.1f}s | database {database_time:.1f}s | "
+            f"sleeping {sleep_time:.1f}s | other waiting (browser IPC, network) {waiting_time:.1f}s\n"
+            f"memory current {current_memory / 1024 / 1024:.2f} MiB, peak {peak_memory / 1024 / 1024:.2f} MiB\n"
+            f"{stats_output.getvalue()}"
+        )
+        Logger.info(f"Profiled stage '{name}': wall {wall_time:.1f}s, cpu {cpu_time:.1f}s, "
+                    f"database {database_time:.1f}s, sleeping {sleep_time:.1f}s")
+
+    def end_run(self):
+        if self.directory is None:
+            return
+        with open(os.path.join(self.directory, 'summary.txt'), 'w') as file:
+            file.write('\n'.join(self.summary))
+        tracemalloc.stop()
+        Logger.info(f"Profiling results written to {self.directory}")
+        self.directory = None
+        self.snapshot = None
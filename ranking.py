@@ -0,0 +1,55 @@
+import heapq
+import math
+import re
+
+from config import RANKING_DEFAULT_DISCOUNT
+from models import ProductDetails
+from utils import parse_price
+
+# An amount such as '£10', '£9.99' or '9,99 €', captured without the currency
+AMOUNT_PATTERN = r'(?:£ ?)?(\d+(?:[.,]\d{2})?)(?: ?€)?'
+
+
+def estimate_discount(promotion_title: str, price: float | None) -> float:
+    """
+    Estimate the fraction of the price a promotion saves, e.g. 1/3 for 'Get 3 for the price of 2'. Titles are matched
+    in the wording of every marketplace, with amounts in pounds or euros and either decimal separator.
+    """
+    title = promotion_title or ''
+
+    match = re.search(r'(?:Get (\d+) for the price of|Kaufe (\d+),? (?:be)?zahle|Achetez-en (\d+),? payez-en) (\d+)',
+                      title, re.IGNORECASE)
+    if match:
+        items, paid_items = int(next(group for group in match.groups()[:3] if group)), int(match.group(4))
+        return max(1 - paid_items / items, 0) if items else 0
+
+    match = re.search(r'(?:Save|Spare|Économisez) (\d+) ?%', title, re.IGNORECASE)
+    if match:
+        return int(match.group(1)) / 100
+
+    # Fixed amounts need the price to become a fraction
+    if price:
+        match = re.search(rf'(\d+) (?:for|für|pour) {AMOUNT_PATTERN}', title, re.IGNORECASE)
+        if match:
+            items, total = int(match.group(1)), parse_price(match.group(2))
+            return max(1 - total / (items * price), 0) if items else 0
+
+        match = re.search(rf'(?:Save|Spare|Économisez) {AMOUNT_PATTERN}(?: on any| beim Kauf von| sur)? (\d+)?',
+                          title, re.IGNORECASE)
+        if match:
+            items = int(match.group(2)) if match.group(2) else 1
+            return min(parse_price(match.group(1)) / (items * price), 1)
+
+    return RANKING_DEFAULT_DISCOUNT
+
+
+def score_deal(product: ProductDetails) -> float:
+    """Higher for products that sell more and save more per item. Sales are log scaled so they do not dominate."""
+    price = parse_price(product.product_price)
+    saving = (price or 0) * estimate_discount(product.promotion_title, price)
+    return math.log1p(product.product_sales or 0) * (1 + math.log1p(saving))
+
+
+def top_deals(products: list, k: int, key=score_deal) -> list:
+    """The k best deals, best first. heapq keeps only k candidates at a time instead of sorting every product."""
+    return heapq.nlargest(k, products, key=key)
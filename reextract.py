@@ -0,0 +1,93 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from config import REEXTRACT_CHUNK_SIZE
+from db import connect_to_database, process_products
+from extraction import PRODUCT_DETAILS_SCRIPT, build_product_details
+from logger import Logger
+from models import Promotion, ProductDetails, ProcessedProductDetails
+from page_archive import get_manifest, load_page
+from spool import product_details_spool
+
+
+async def extract_archived_pages(records: list[dict]) -> tuple[list[dict], list[str]]:
+    """Run the extraction script over archived pages in a browser that has no network access."""
+    from playwright.async_api import async_playwright
+
+    products, failed_urls = [], []
+    current_page = {}
+
+    async def serve_archived_page(route):
+        # Only the main document is served, so nothing the archived page references is fetched
+        if route.request.resource_type == 'document' and 'html' in current_page:
+            await route.fulfill(status=200, content_type='text/html; charset=utf-8', body=current_page.pop('html'))
+        else:
+            await route.abort()
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        try:
+            # Page scripts stay off so the DOM is exactly what was archived
+            context = await browser.new_context(java_script_enabled=False)
+            await context.route('**/*', serve_archived_page)
+            page = await context.new_page()
+            for record in records:
+                try:
+                    current_page['html'] = load_page(record['content_hash'])
+                    await page.goto(record['url'], wait_until='domcontentloaded')
+                    product = await page.evaluate(PRODUCT_DETAILS_SCRIPT)
+                    products.append(build_product_details(Promotion.from_dict(record['promotion']), product).to_dict())
+                except Exception:
+                    failed_urls.append(record['url'])
+                finally:
+                    current_page.clear()
+        finally:
+            await browser.close()
+    return products, failed_urls
+
+
+def extract_archived_pages_in_process(records: list[dict]) -> tuple[list[dict], list[str]]:
+    return asyncio.run(extract_archived_pages(records))
+
+
+async def reextract_run(run_id: str, workers: int = None, process: bool = True) -> ProcessedProductDetails | None:
+    """
+    Re-run the current product extraction over the pages archived by a run, one headless browser per CPU core,
+    and feed the results to process_products unless process is False.
+    """
+    manifest = get_manifest(run_id)
+    if not len(manifest):
+        raise FileNotFoundError(f"No archived pages found for run {run_id}")
+
+    start_time = time.time()
+    workers = workers or os.cpu_count()
+    output = product_details_spool(f"{run_id}-reextract")
+    output.reset()
+    Logger.info(f"Re-extracting {len(manifest)} archived pages of run {run_id} with {workers} workers")
+
+    failed_count = 0
+    loop = asyncio.get_running_loop()
+    # Spawned rather than forked so that the parent's event loop and database client threads must not be copied
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [loop.run_in_executor(executor, extract_archived_pages_in_process, chunk)
+                   for chunk in manifest.read_chunks(REEXTRACT_CHUNK_SIZE)]
+        for future in asyncio.as_completed(futures):
+            products, failed_urls = await future
+            for product in products:
+                product_details = ProductDetails.from_dict(product)
+                output.append(product_details, key=product_details.id)
+            failed_count += len(failed_urls)
+            for url in failed_urls:
+                Logger.warn(f"Could not re-extract archived page: {url}")
+
+    output.mark_complete()
+    Logger.info(f"Re-extracted {len(output)} products in {time.time() - start_time:.0f}s, {failed_count} pages failed")
+
+    if not process:
+        return None
+
+    await connect_to_database()
+    return await process_products(output)
@@ -0,0 +1,177 @@
+import time
+from datetime import datetime
+
+from config import RUN_BUDGET_RESERVE
+from logger import Logger
+from models import Stage
+
+
+def estimate_stage_costs(history: list[dict]) -> dict[str, dict]:
+    """Average seconds spent per stage and per item in each stage over past runs."""
+    costs = {}
+    for stage in Stage.SCRAPING:
+        stage_runs = [run['stages'][stage] for run in history if stage in run.get('stages', {})]
+        if not stage_runs:
+            continue
+        total_seconds = sum(stage_run['seconds'] for stage_run in stage_runs)
+        total_items = sum(stage_run['items'] for stage_run in stage_runs)
+        costs[stage] = {
+            'seconds': total_seconds / len(stage_runs),
+            'per_item': total_seconds / total_items if total_items else None
+        }
+    return costs
+
+
+class RunBudget:
+    """
+    Wall-clock budget for one scraper run. The remaining time is shared between the remaining stages in proportion
+    to how long each took in past runs, so a slow stage cannot starve the ones after it.
+    """
+
+    def __init__(self, budget_seconds: float = None, history: list[dict] = None):
+        self.budget_seconds = budget_seconds
+        self.started_at = time.time()
+        self.deadline = self.started_at + budget_seconds - RUN_BUDGET_RESERVE if budget_seconds else None
+        self.stage_costs = estimate_stage_costs(history or [])
+        self.current_stage = None
+        self.stage_started_at = None
+        self.stage_deadline = None
+        self.stage_items_total = 0
+        self.stage_items_done = 0
+        self.stats = {}
+        self.exhausted_stages = []
+        self.parent = None
+        self.children = {}
+        self._cancelled = False
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled or (self.parent is not None and self.parent.cancelled)
+
+    def set_history(self, history: list[dict]):
+        self.stage_costs = estimate_stage_costs(history)
+
+    def cancel(self):
+        """Stop the run at the next item boundary. Work already in progress is finished and kept."""
+        Logger.warn('Run cancellation requested')
+        self._cancelled = True
+
+    def create_child(self, name: str) -> 'RunBudget':
+        """
+        A budget with the same deadline for one of several runs sharing this budget at the same time, such as one
+        per marketplace. Each child tracks its own stages and is cancelled along with this budget.
+        """
+        child = RunBudget()
+        child.budget_seconds = self.budget_seconds
+        child.deadline = self.deadline
+        child.parent = self
+        self.children[name] = child
+        return child
+
+    def stage_weight(self, stage: str) -> float:
+        known_seconds = [cost['seconds'] for cost in self.stage_costs.values()]
+        default_seconds = sum(known_seconds) / len(known_seconds) if known_seconds else 1
+        return self.stage_costs.get(stage, {}).get('seconds') or default_seconds
+
+    def remaining(self) -> float | None:
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def has_time_for(self, seconds: float) -> bool:
+        if self.cancelled:
+            return False
+        return self.deadline is None or self.remaining() > seconds
+
+    def start_stage(self, stage: str, total_items: int):
+        self.current_stage = stage
+        self.stage_started_at = time.time()
+        self.stage_items_total = total_items
+        self.stage_items_done = 0
+
+        if self.deadline is None:
+            self.stage_deadline = None
+            Logger.info(f"Starting stage '{stage}' with {total_items} items and no time budget")
+            return
+
+        remaining_stages = Stage.SCRAPING[Stage.SCRAPING.index(stage):]
+        share = self.stage_weight(stage) / sum(self.stage_weight(s) for s in remaining_stages)
+        allotted = self.remaining() * share
+        self.stage_deadline = self.stage_started_at + allotted
+
+        per_item = self.stage_costs.get(stage, {}).get('per_item')
+        estimate = f"{per_item * total_items:.0f}s" if per_item else "unknown"
+        Logger.info(f"Starting stage '{stage}' with {total_items} items. Estimated {estimate}, allotted {allotted:.0f}s")
+
+    def advance(self, items: int = 1):
+        self.stage_items_done += items
+
+    def is_exhausted(self) -> bool:
+        if not self.cancelled and (self.stage_deadline is None or time.time() < self.stage_deadline):
+            return False
+        if self.current_stage is not None and self.current_stage not in self.exhausted_stages:
+            self.exhausted_stages.append(self.current_stage)
+            if not self.cancelled:
+                Logger.warn(
+                    f"Time budget for stage '{self.current_stage}' used up after "
+                    f"{self.stage_items_done}/{self.stage_items_total} items. Stopping the stage early.")
+        return True
+
+    def was_cut_short(self, stage: str) -> bool:
+        """Whether the stage stopped early because its budget was used up or the run was cancelled."""
+        return stage in self.exhausted_stages
+
+    def end_stage(self):
+        seconds = time.time() - self.stage_started_at
+        self.stats[self.current_stage] = {'items': self.stage_items_done, 'seconds': seconds}
+        Logger.info(f"Finished stage '{self.current_stage}': {self.stage_items_done} items in {seconds:.0f}s")
+        self.current_stage = None
+        self.stage_deadline = None
+
+    def estimate_remaining_seconds(self) -> float | None:
+        """Estimated time left for the current stage and the stages after it."""
+        if self.cancelled:
+            return 0
+        stages_left = Stage.SCRAPING
+        estimate = 0
+        if self.current_stage is not None:
+            stages_left = Stage.SCRAPING[Stage.SCRAPING.index(self.current_stage) + 1:]
+            elapsed = time.time() - self.stage_started_at
+            per_item = elapsed / self.stage_items_done if self.stage_items_done else \
+                self.stage_costs.get(self.current_stage, {}).get('per_item')
+            if per_item is None:
+                return None
+            estimate += per_item * (self.stage_items_total - self.stage_items_done)
+        elif self.stats:
+            finished_stages = [stage for stage in Stage.SCRAPING if stage in self.stats]
+            stages_left = Stage.SCRAPING[Stage.SCRAPING.index(finished_stages[-1]) + 1:]
+
+        for stage in stages_left:
+            if stage not in self.stage_costs:
+                return None
+            estimate += self.stage_costs[stage]['seconds']
+
+        remaining = self.remaining()
+        return min(estimate, remaining) if remaining is not None else estimate
+
+    def get_progress(self) -> dict:
+        return {
+            'stage': self.current_stage,
+            'items_done': self.stage_items_done,
+            'items_total': self.stage_items_total,
+            'finished_stages': list(self.stats.keys()),
+            'elapsed_seconds': time.time() - self.started_at,
+            'eta_seconds': self.estimate_remaining_seconds(),
+            'cancelled': self.cancelled,
+            'children': {name: child.get_progress() for name, child in self.children.items()}
+        }
+
+    def to_document(self) -> dict:
+        return {
+            'started_at': datetime.utcfromtimestamp(self.started_at),
+            'budget_seconds': self.budget_seconds,
+            'total_seconds': time.time() - self.started_at,
+            'exhausted_stages': self.exhausted_stages,
+            'cancelled': self.cancelled,
+            'stages': self.stats
+        }
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from logger import Logger
+from run_budget import RunBudget
+
+RUN_FULL = 'full run'
+RUN_SLICE = 'scheduled slice'
+
+
+class RunManager:
+    """
+    Allows a single active run per process. Triggers arriving while a run of the same kind is active join it instead,
+    and ones arriving during a run of another kind, such as a full run triggered during a scheduled slice, wait for it
+    to finish and then start their own.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(RunManager, cls).__new__(cls)
+            cls._instance.active_task = None
+            cls._instance.budget = None
+            cls._instance.trigger = None
+            cls._instance.kind = None
+            cls._instance.started_at = None
+        return cls._instance
+
+    def is_running(self) -> bool:
+        return self.active_task is not None and not self.active_task.done()
+
+    def is_running_other_kind(self, kind: str) -> bool:
+        return self.is_running() and self.kind != kind
+
+    async def run(self, trigger: str, run_function, budget_seconds: float = None, kind: str = RUN_FULL) -> bool:
+        """
+        Start run_function(budget) or join the active run of the same kind, and wait for it to finish.
+        Returns True if the trigger joined a run that was already active.
+        """
+        while self.is_running_other_kind(kind):
+            Logger.info(f"Run triggered by {trigger} waits for the active {self.kind} triggered by {self.trigger}")
+            # Waited for without raising, the active run's failure is not this trigger's
+            await asyncio.wait([self.active_task])
+
+        if self.is_running():
+            Logger.info(f"Run triggered by {trigger} joined the active run triggered by {self.trigger}")
+            await asyncio.shield(self.active_task)
+            return True
+
+        Logger.info(f"Starting a run triggered by {trigger}")
+        self.trigger = trigger
+        self.kind = kind
+        self.started_at = time.time()
+        self.budget = RunBudget(budget_seconds)
+        self.active_task = asyncio.create_task(run_function(self.budget))
+        self.active_task.add_done_callback(self.on_run_done)
+
+        # Shielded so that a cancelled caller, such as a timed out interaction, does not cancel the run itself
+        await asyncio.shield(self.active_task)
+        return False
+
+    def on_run_done(self, task: asyncio.Task):
+        if task.cancelled():
+            Logger.warn(f"Run triggered by {self.trigger} was cancelled")
+        elif task.exception() is not None:
+            Logger.critical(f"Run triggered by {self.trigger} failed", task.exception())
+        else:
+            Logger.info(f"Run triggered by {self.trigger} finished")
+
+    def cancel(self) -> bool:
+        if not self.is_running():
+            return False
+        self.budget.cancel()
+        return True
+
+    def get_status(self) -> dict | None:
+        if not self.is_running():
+            return None
+        return {
+            'trigger': self.trigger,
+            'kind': self.kind,
+            'started_at': self.started_at,
+            **self.budget.get_progress()
+        }
@@ -0,0 +1,211 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne, ReturnDocument
+
+import db
+from adaptive import set_max_concurrency
+from config import SCHEDULER_SLICE_SEARCHES, SCHEDULER_SLICE_PROMOS, SCHEDULER_SLICE_MAX_CONCURRENCY, \
+    SCHEDULER_SEARCH_INTERVAL, SCHEDULER_PROMO_REVISIT_INTERVAL, SCHEDULER_PROMO_MAX_AGE, SCHEDULER_RETRY_DELAY, \
+    SCHEDULER_PRIORITIZE_BY_YIELD, SCHEDULER_MAX_INTERVAL_FACTOR, DEFAULT_MARKETPLACE
+from logger import Logger
+from marketplace import Marketplace, get_marketplace
+from models import Stage, PromoCode, ProcessedProductDetails
+from run_budget import RunBudget
+from scraper import startScraper, start_marketplace_scrapers, get_run_id
+from spool import Spool, product_links_spool, promo_codes_spool, promotions_spool
+from term_stats import get_term_yield
+
+SCHEDULE_SEARCH = 'search'
+SCHEDULE_PROMO = 'promo'
+
+
+def get_schedule_id(kind: str, key: str, marketplace_id: str = DEFAULT_MARKETPLACE) -> str:
+    # Items of the default marketplace keep the ids they had before there were several
+    if marketplace_id == DEFAULT_MARKETPLACE:
+        return f"{kind}:{key}"
+    return f"{kind}:{marketplace_id}:{key}"
+
+
+async def sync_search_schedule(marketplace_id: str = DEFAULT_MARKETPLACE):
+    """
+    Give new search terms a first visit at a random time within one interval, so terms spread over the day, and drop
+    the schedule of removed terms.
+    """
+    search_terms = await db.get_all_searches(marketplace_id)
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": get_schedule_id(SCHEDULE_SEARCH, search_term, marketplace_id)},
+            {"$setOnInsert": {
+                "kind": SCHEDULE_SEARCH,
+                "key": search_term,
+                "marketplace": marketplace_id,
+                "interval": SCHEDULER_SEARCH_INTERVAL,
+                "next_due": now + timedelta(seconds=random.uniform(0, SCHEDULER_SEARCH_INTERVAL))
+            }},
+            upsert=True
+        )
+        for search_term in search_terms
+    ]
+    if operations:
+        await db.schedule_collection.bulk_write(operations, ordered=False)
+    await db.schedule_collection.delete_many({
+        "kind": SCHEDULE_SEARCH,
+        "key": {"$nin": search_terms},
+        **db.get_marketplace_query(marketplace_id)
+    })
+
+
+async def claim_due_items(kind: str, limit: int, marketplace_id: str = DEFAULT_MARKETPLACE) -> list[dict]:
+    """
+    Take up to limit due items, earliest first. A claimed item is pushed back by SCHEDULER_RETRY_DELAY until its slice
+    completes it, so items of a slice that fails or dies are retried later instead of waiting a whole interval.
+    """
+    now = datetime.utcnow()
+    items = []
+    for _ in range(limit):
+        item = await db.schedule_collection.find_one_and_update(
+            {"kind": kind, "next_due": {"$lte": now}, **db.get_marketplace_query(marketplace_id)},
+            {"$set": {"next_due": now + timedelta(seconds=SCHEDULER_RETRY_DELAY)}},
+            sort=[("next_due", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if item is None:
+            break
+        items.append(item)
+    return items
+
+
+async def get_search_intervals(search_terms: list[str],
+                               marketplace_id: str = DEFAULT_MARKETPLACE) -> dict[str, float]:
+    """
+    Stretch the interval of terms whose deals per page load are below the average of all terms, in proportion to how
+    far below they are, up to SCHEDULER_MAX_INTERVAL_FACTOR. Terms are never visited more often than the base interval.
+    """
+    term_yields = {doc['text']: get_term_yield(doc.get('stats'))
+                   for doc in await db.get_search_term_stats(marketplace_id)}
+    known_yields = [term_yield for term_yield in term_yields.values() if term_yield is not None]
+    average_yield = sum(known_yields) / len(known_yields) if known_yields else 0
+
+    intervals = {}
+    for search_term in search_terms:
+        term_yield = term_yields.get(search_term)
+        factor = 1
+        if term_yield is not None and average_yield > 0:
+            factor = average_yield / term_yield if term_yield > 0 else SCHEDULER_MAX_INTERVAL_FACTOR
+        intervals[search_term] = SCHEDULER_SEARCH_INTERVAL * min(max(factor, 1), SCHEDULER_MAX_INTERVAL_FACTOR)
+    return intervals
+
+
+def get_visited_keys(spool: Spool, name: str) -> set[str]:
+    """Keys a stage recorded in one of its spool's stores as visited."""
+    store = spool.get_store(name)
+    keys = {key for key, _ in store.items()}
+    store.close()
+    return keys
+
+
+async def complete_items(items: list[dict], intervals: dict[str, float] = None):
+    """Schedule each item's next visit one interval from now, using the given intervals by key where there is one."""
+    if not items:
+        return
+    now = datetime.utcnow()
+    operations = []
+    for item in items:
+        interval = (intervals or {}).get(item['key'], item['interval'])
+        operations.append(UpdateOne(
+            {"_id": item['_id']},
+            {"$set": {"next_due": now + timedelta(seconds=interval), "interval": interval, "last_run": now}}
+        ))
+    await db.schedule_collection.bulk_write(operations, ordered=False)
+
+
+async def schedule_promo_revisits(promo_codes: list[PromoCode], marketplace_id: str = DEFAULT_MARKETPLACE):
+    """Revisit promo codes found by a search on their own, until no search has found them for a while."""
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"_id": get_schedule_id(SCHEDULE_PROMO, promo_code.code, marketplace_id)},
+            {
+                "$setOnInsert": {
+                    "kind": SCHEDULE_PROMO,
+                    "key": promo_code.code,
+                    "marketplace": marketplace_id,
+                    "interval": SCHEDULER_PROMO_REVISIT_INTERVAL,
+                    "next_due": now + timedelta(seconds=SCHEDULER_PROMO_REVISIT_INTERVAL)
+                },
+                "$set": {"last_found": now},
+                "$addToSet": {"search_terms": {"$each": promo_code.search_terms}}
+            },
+            upsert=True
+        )
+        for promo_code in promo_codes
+    ]
+    if operations:
+        await db.schedule_collection.bulk_write(operations, ordered=False)
+
+    expired = await db.schedule_collection.delete_many({
+        "kind": SCHEDULE_PROMO,
+        "last_found": {"$lt": now - timedelta(seconds=SCHEDULER_PROMO_MAX_AGE)},
+        **db.get_marketplace_query(marketplace_id)
+    })
+    if expired.deleted_count:
+        Logger.info(f"Stopped revisiting {expired.deleted_count} promo codes no longer found by searches")
+
+
+async def run_slice(marketplace: Marketplace = None, budget: RunBudget = None) -> ProcessedProductDetails:
+    """
+    Run one slice of a marketplace's rolling schedule: the search terms and promo revisits that are due, at most
+    SCHEDULER_SLICE_SEARCHES and SCHEDULER_SLICE_PROMOS of them.
+    """
+    marketplace = marketplace or get_marketplace()
+    await db.connect_to_database()
+    await sync_search_schedule(marketplace.id)
+    search_items = await claim_due_items(SCHEDULE_SEARCH, SCHEDULER_SLICE_SEARCHES, marketplace.id)
+    promo_items = await claim_due_items(SCHEDULE_PROMO, SCHEDULER_SLICE_PROMOS, marketplace.id)
+    if not search_items and not promo_items:
+        Logger.info(f"No scheduled items of marketplace {marketplace.id} are due")
+        return ProcessedProductDetails()
+
+    run_id = get_run_id(marketplace, f"slice-{time.strftime('%Y%m%d-%H%M%S')}")
+    search_terms = [item['key'] for item in search_items]
+    revisit_promo_codes = [PromoCode(item['key'], item.get('search_terms', [])) for item in promo_items]
+    # Without due search terms the search stage would fall back to every saved search
+    stages = Stage.SCRAPING + [Stage.PROCESS] if search_terms else [Stage.PROMOS, Stage.DETAILS, Stage.PROCESS]
+    Logger.info(f"Running slice {run_id}: {len(search_terms)} search terms, {len(revisit_promo_codes)} promo revisits")
+
+    processed_data = await startScraper(run_id=run_id, budget=budget, stages=stages,
+                                        search_terms=search_terms or None,
+                                        revisit_promo_codes=revisit_promo_codes, marketplace=marketplace)
+
+    # Items the slice did not get to, because a stage failed or its budget ran out, keep the retry time set when they
+    # were claimed
+    visited_terms = get_visited_keys(product_links_spool(run_id), 'visited_terms')
+    visited_search_items = [item for item in search_items if item['key'] in visited_terms]
+    if visited_search_items:
+        visited_search_terms = [item['key'] for item in visited_search_items]
+        intervals = await get_search_intervals(visited_search_terms, marketplace.id) \
+            if SCHEDULER_PRIORITIZE_BY_YIELD else \
+            {search_term: SCHEDULER_SEARCH_INTERVAL for search_term in visited_search_terms}
+        await complete_items(visited_search_items, intervals)
+    visited_codes = get_visited_keys(promotions_spool(run_id), 'visited_codes')
+    await complete_items([item for item in promo_items if item['key'] in visited_codes])
+
+    found_promo_codes = promo_codes_spool(run_id)
+    if found_promo_codes.is_complete():
+        await schedule_promo_revisits(list(found_promo_codes), marketplace.id)
+    return processed_data
+
+
+async def run_slices(budget: RunBudget = None) -> dict[str, ProcessedProductDetails]:
+    """
+    Run a slice of every enabled marketplace at the same time, with every stage's concurrency capped. Returns the
+    processed products of each marketplace.
+    """
+    set_max_concurrency(SCHEDULER_SLICE_MAX_CONCURRENCY)
+    try:
+        return await start_marketplace_scrapers(run_slice, budget)
+    finally:
+        set_max_concurrency(None)
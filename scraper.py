@@ -1,25 +1,40 @@
+import asyncio
+import hashlib
 import time
-import urllib.parse
-import re
-from playwright.async_api import async_playwright
+from datetime import date, datetime, timedelta
 
-from config import DELAY_BETWEEN_SEARCHES, DELAY_BETWEEN_PAGES, MAX_PAGES_TO_SCRAPE, DELAY_BETWEEN_LINKS, POST_CODE, \
+from config import DELAY_BETWEEN_SEARCHES, DELAY_BETWEEN_PAGES, MAX_PAGES_TO_SCRAPE, DELAY_BETWEEN_LINKS, \
     SCRAPING_URL_BATCH_SIZE, BATCH_SIZE_DELAY, DELAY_BETWEEN_STEPS, \
-    MAX_SHOW_MORE_CLICKS, LIMITING_RESULTS, CAPTCHA_DETECTED_DELAY
-from db import get_all_searches, connect_to_database, process_products
+    MAX_SHOW_MORE_CLICKS, LIMITING_RESULTS, PRODUCT_DETAILS_CACHE_TTL, SEARCH_PREFILTER_ENABLED, \
+    SEARCH_PREFILTER_DROP_UNKNOWN_SALES, SEARCH_PREFILTER_REQUIRE_BADGE, DEFAULT_MARKETPLACE, \
+    PROMO_SNAPSHOT_ENABLED, PROMO_SNAPSHOT_PRODUCT_TTL, PROMO_SNAPSHOT_RECHECK_RATE
+from adaptive import get_controller, classify_error, BlockPageDetected, OUTCOME_SUCCESS
+from data_manager import DataManager
+from db import get_all_searches, get_all_searches_by_yield, connect_to_database, process_products, \
+    update_search_yields, get_promo_code_sales_scores, save_run_stats, get_recent_run_stats, update_search_term_stats, \
+    get_promo_snapshot, update_promo_snapshot
+from extraction import PRODUCT_DETAILS_SCRIPT, build_product_details, get_asin_from_url
+from har_manager import HarManager, HAR_MODE_OFF
 from logger import Logger
-from models import ProductDetails, Promotion, ProcessedProductDetails
-from utils import sleep_randomly, get_browser
-
-
-async def setup_amazon_uk():
-    async with async_playwright() as p:
-        Logger.info("Setting up Amazon UK")
-
-        browser, page = await get_browser(p)
-
-        # Navigate to Amazon UK
-        await page.goto('https://www.amazon.co.uk')
+from marketplace import Marketplace, get_marketplace, get_enabled_marketplaces
+from metrics import Metrics
+from models import ProductLink, PromoCode, ProductDetails, Promotion, ProcessedProductDetails, Stage
+from page_archive import PageArchive, cleanup_old_archives
+from profiling import StageProfiler
+from run_budget import RunBudget
+from spool import Spool, product_links_spool, promo_codes_spool, promotions_spool, product_details_spool, \
+    product_cache_spool, cleanup_old_spools
+from term_stats import get_term_stats
+from utils import sleep_randomly, open_browser, is_block_page, parse_sales
+
+
+async def setup_marketplace(marketplace: Marketplace = None):
+    marketplace = marketplace or get_marketplace()
+    async with open_browser(marketplace) as (browser, page):
+        Logger.info(f"Setting up {marketplace.name}")
+
+        # Navigate to the marketplace
+        await page.goto(marketplace.base_url)
 
         # Wait for and accept cookies
         try:
@@ -36,7 +51,7 @@ async def setup_amazon_uk():
         await postcode_input.wait_for(state='visible', timeout=5000)
 
         # Enter the postcode with a retry mechanism
-        await postcode_input.fill(POST_CODE)
+        await postcode_input.fill(marketplace.post_code)
         await sleep_randomly(2, 0)
 
         # Click the "Apply" button
@@ -48,86 +63,187 @@ async def setup_amazon_uk():
         Logger.info("Postcode set successfully")
         await sleep_randomly(4, 1)
 
-        Logger.info("Amazon UK setup completed")
+        Logger.info(f"{marketplace.name} setup completed")
 
 
-async def scraping_promo_products_from_search(search_term: str) -> list[str]:
-    async with async_playwright() as p:
-        Logger.info(f"Scraping promo products from Search = {search_term}")
-        browser, page = await get_browser(p)
+async def scrape_search_results_page(page, search_term: str, page_num: int,
+                                     marketplace: Marketplace = None) -> tuple[list[dict], bool]:
+    """
+    Load one search results page. Returns its result cards, each with its product link, ASIN, "bought in past month"
+    text and deal badges, and whether a next page exists.
+    """
+    marketplace = marketplace or get_marketplace()
+    Logger.info(f"Scraping page {page_num} for Search = '{search_term}' on {marketplace.name}")
 
-        all_product_links = []
-        try:
-            for page_num in range(1, MAX_PAGES_TO_SCRAPE + 1):
-                Logger.info(f"Scraping page {page_num} for Search = '{search_term}'")
+    await page.goto(marketplace.get_search_url(search_term, page_num))
 
-                encoded_search_term = urllib.parse.quote(search_term)
-                await page.goto(f"https://www.amazon.co.uk/s?k={encoded_search_term}&page={page_num}")
+    # Wait for the results to load
+    try:
+        await page.wait_for_selector('.s-main-slot')
+    except Exception as e:
+        if await is_block_page(page):
+            raise BlockPageDetected(f"Block page detected for Search = '{search_term}'") from e
+        raise e
 
-                # Wait for the results to load
-                await page.wait_for_selector('.s-main-slot')
+    result_cards = await page.evaluate('''
+        (salesTextPattern) => Array.from(document.querySelectorAll('div.s-result-item[data-asin]'))
+            .filter(card => card.dataset.asin)
+            .map(card => {
+                const link = card.querySelector('div.a-section a.a-link-normal.s-no-outline');
+                const texts = Array.from(card.querySelectorAll('span')).map(span => span.textContent.trim());
+                const badges = Array.from(card.querySelectorAll('.a-badge-text, .s-coupon-unclipped, .s-coupon-clipped'))
+                    .map(element => element.textContent.trim())
+                    .concat(texts.filter(text => /^(Save|Buy|Get) .*(any|for|voucher|coupon)/i.test(text)))
+                    .filter(text => /deal|coupon|voucher|save|buy|get|offer|promotion/i.test(text));
+                return {
+                    url: link ? link.href : null,
+                    asin: card.dataset.asin,
+                    sales_text: texts.find(text => new RegExp(salesTextPattern, 'i').test(text)) || null,
+                    badges: [...new Set(badges)]
+                };
+            })
+            .filter(card => card.url)
+    ''', marketplace.sales_text_pattern)
+    next_button = await page.query_selector(
+        ".s-pagination-item.s-pagination-next.s-pagination-button.s-pagination-separator")
+
+    Logger.info(f"Scraped page {page_num} for Search = '{search_term}'. Found {len(result_cards)} product links")
+    return result_cards, next_button is not None
+
+
+def passes_search_prefilter(card: dict, sales_cutoff: int) -> bool:
+    """Whether a search result can still pass the monthly sales cutoff and be worth opening."""
+    if not SEARCH_PREFILTER_ENABLED:
+        return True
+    sales = parse_sales(card['sales_text'])
+    if sales is None:
+        if SEARCH_PREFILTER_DROP_UNKNOWN_SALES:
+            return False
+    elif sales < sales_cutoff:
+        return False
+    return not SEARCH_PREFILTER_REQUIRE_BADGE or bool(card['badges'])
+
+
+async def scrape_search_terms(browser, search_terms: list[str], budget: RunBudget = None,
+                              marketplace: Marketplace = None) -> dict[str, list[str]]:
+    """
+    Fetch every results page of every search term in parallel tabs, paced by the search stage's controller.
+    A term's remaining pages are skipped once one of its pages is empty or has no next page.
+    Results that cannot pass the pre-filter are dropped, and terms whose pages all failed are left out of the result.
+    """
+    budget = budget or RunBudget()
+    marketplace = marketplace or get_marketplace()
+    controller = get_controller(Stage.SEARCH, DELAY_BETWEEN_PAGES, marketplace.id)
+    term_stats = get_term_stats(marketplace.id)
+    data_manager = DataManager()
+    await data_manager.refresh()
+    sales_cutoff = data_manager.get_monthly_sales_cutoff()
+    last_page = {search_term: MAX_PAGES_TO_SCRAPE for search_term in search_terms}
+    links_by_term = {search_term: [] for search_term in search_terms}
+    scraped_pages = {search_term: 0 for search_term in search_terms}
+    card_counts = {search_term: 0 for search_term in search_terms}
+    dropped_counts = {search_term: 0 for search_term in search_terms}
+
+    async def scrape_page(search_term: str, page_num: int):
+        async with controller.slot():
+            if budget.is_exhausted():
+                return
+            if page_num <= last_page[search_term]:
+                await controller.pace()
+            if page_num > last_page[search_term]:
+                Logger.info(f"Skipping page {page_num} for Search = '{search_term}', no more pages")
+                Metrics().increment('search.pages_skipped')
+                return
+
+            tab = await browser.new_page()
+            try:
+                result_cards, has_next_page = await scrape_search_results_page(tab, search_term, page_num, marketplace)
+                kept_cards = [card for card in result_cards if passes_search_prefilter(card, sales_cutoff)]
+                links_by_term[search_term].extend(card['url'] for card in kept_cards)
+                card_counts[search_term] += len(result_cards)
+                dropped_counts[search_term] += len(result_cards) - len(kept_cards)
+                scraped_pages[search_term] += 1
+                term_stats.add(search_term, 'page_loads')
+                budget.advance()
+                if not result_cards or not has_next_page:
+                    last_page[search_term] = min(last_page[search_term], page_num)
+                await controller.record(OUTCOME_SUCCESS)
+            except Exception as e:
+                Logger.error(f"Error scraping page {page_num} for Search = '{search_term}'", e)
+                await controller.record(classify_error(e))
+            finally:
+                await tab.close()
+
+    # Page-major order so that early pages reveal empty terms before their later pages are requested
+    await asyncio.gather(*[
+        scrape_page(search_term, page_num)
+        for page_num in range(1, MAX_PAGES_TO_SCRAPE + 1)
+        for search_term in search_terms
+    ])
+
+    results = {}
+    for search_term in search_terms:
+        if scraped_pages[search_term] == 0:
+            continue
+        results[search_term] = list(dict.fromkeys(links_by_term[search_term]))[:LIMITING_RESULTS]
+        term_stats.add(search_term, 'links', len(results[search_term]))
+        drop_rate = dropped_counts[search_term] / card_counts[search_term] if card_counts[search_term] else 0
+        Logger.info(
+            f"Finished scraping promo products from Search = {search_term}. "
+            f"Found {len(results[search_term])} product links, pre-filter dropped "
+            f"{dropped_counts[search_term]}/{card_counts[search_term]} results ({drop_rate:.0%})")
 
-                # Extract product links only for products with promotions
-                product_links = await page.eval_on_selector_all(
-                    'div.s-result-item div.a-section a.a-link-normal.s-no-outline',
-                    "elements => elements.map(el => el.href)"
-                )
-                all_product_links.extend(product_links)
-                Logger.info(
-                    f"Scraped page {page_num} for Search = '{search_term}'. Found {len(product_links)} product links")
-
-                try:
-                    await page.locator(
-                        ".s-pagination-item.s-pagination-next.s-pagination-button.s-pagination-separator").wait_for(
-                        timeout=5000)
-                except:
-                    Logger.info(f"No more pages found for Search = '{search_term}'")
-                    break
+    Metrics().increment('search.results_seen', sum(card_counts.values()))
+    Metrics().increment('search.results_dropped', sum(dropped_counts.values()))
+    return results
 
-                await sleep_randomly(DELAY_BETWEEN_PAGES)
-        except Exception as e:
-            Logger.error(f"Error scraping search term: {search_term}", e)
-            raise e
 
-        all_product_links = list(set(all_product_links))
-        all_product_links = all_product_links[:LIMITING_RESULTS]
+async def scraping_promo_products_from_search(search_term: str, marketplace: Marketplace = None) -> list[str]:
+    async with open_browser(marketplace) as (browser, page):
+        Logger.info(f"Scraping promo products from Search = {search_term}")
+        links_by_term = await scrape_search_terms(browser, [search_term], marketplace=marketplace)
 
-        Logger.info(
-            f"Finished scraping promo products from Search = {search_term}. Found {len(all_product_links)} product links")
-        return all_product_links
+    if search_term not in links_by_term:
+        raise Exception(f"Error scraping search term: {search_term}")
+    return links_by_term[search_term]
 
 
-async def scraping_promo_products_from_searches() -> list[str]:
+async def scraping_promo_products_from_searches(output: Spool, budget: RunBudget = None,
+                                                search_terms: list[str] = None,
+                                                marketplace: Marketplace = None) -> Spool:
     Logger.info('Started Scraping all promo products from searches')
-    all_product_links = []
-    search_items = await get_all_searches()
-
+    budget = budget or RunBudget()
+    marketplace = marketplace or get_marketplace()
+    output.reset()
+    search_items = search_terms or await get_all_searches_by_yield(marketplace.id)
+    budget.start_stage(Stage.SEARCH, len(search_items) * MAX_PAGES_TO_SCRAPE)
+
+    async with open_browser(marketplace) as (browser, page):
+        links_by_term = await scrape_search_terms(browser, search_items, budget, marketplace)
+
+    await update_search_yields(links_by_term, marketplace.id)
+    budget.end_stage()
+
+    # Terms skipped once the budget ran out are left out, so the scheduler only moves on the terms actually searched
+    visited_terms = output.get_store('visited_terms')
+    visited_terms.reset()
+    for search_term, product_links in links_by_term.items():
+        visited_terms.insert(search_term, len(product_links))
+    visited_terms.close()
+
+    # Keep the highest yielding terms' links first so later stages visit them before the budget runs out
+    terms_by_link = output.get_store('terms_by_link')
+    terms_by_link.reset()
     for search_term in search_items:
-        try:
-            all_product_links.extend(await scraping_promo_products_from_search(search_term))
-            await sleep_randomly(DELAY_BETWEEN_SEARCHES)
-        except:
-            await sleep_randomly(CAPTCHA_DETECTED_DELAY, 5)
-
-    all_product_links = list(set(all_product_links))
-    Logger.info(f'Finished Scraping all promo products from searches. Found {len(all_product_links)} product links')
-    return all_product_links
-
-
-def check_promo_regex(text):
-    patterns = [
-        r'^.*Get \d+ for the price of \d+.*$',
-        r'^.*Get any.*$',
-        r'^.*2 for.*$',
-        r'^.*Save £?\d+(\.\d{2})? on any .*$'
-    ]
-
-    # Check each pattern
-    for pattern in patterns:
-        if re.match(pattern, text, re.IGNORECASE):
-            return True
+        for product_link in links_by_term.get(search_term, []):
+            terms_by_link.extend(product_link, [search_term])
+    for product_link, link_search_terms in terms_by_link.items():
+        output.append(ProductLink(product_link, link_search_terms))
+    terms_by_link.close()
 
-    return False
+    finish_stage_output(output, budget, Stage.SEARCH)
+    Logger.info(f'Finished Scraping all promo products from searches. Found {len(output)} product links')
+    return output
 
 
 async def scrape_promo_codes_from_product_url(page, link: str) -> set[str]:
@@ -153,92 +269,223 @@ async def scrape_promo_codes_from_product_url(page, link: str) -> set[str]:
     return set()
 
 
-async def scrape_promo_codes_from_urls_in_batch(product_links: list[str]) -> set[str]:
+async def cache_product_details(page, product_cache: Spool):
+    """Read the details of the product page the codes stage has open, so the details stage does not load it again."""
+    try:
+        product = await page.evaluate(PRODUCT_DETAILS_SCRIPT)
+    except Exception as e:
+        Logger.warn(f"Could not read product details from: {page.url}", e)
+        return
+    if not product['asin']:
+        return
+    product_cache.append({
+        'asin': product['asin'],
+        'scraped_at': time.time(),
+        'content_hash': await PageArchive().archive_page(page),
+        'product': product
+    }, key=product['asin'])
+
+
+def get_cached_product(product_cache: Spool | None, asin: str | None) -> dict | None:
+    """Look a product up in the cache on disk. Entries older than PRODUCT_DETAILS_CACHE_TTL are ignored."""
+    if product_cache is None or asin is None:
+        return None
+    entry = product_cache.get(asin)
+    if entry is None or entry['scraped_at'] < time.time() - PRODUCT_DETAILS_CACHE_TTL:
+        return None
+    return entry
+
+
+async def scrape_promo_codes_from_urls_in_batch(product_links: Spool, output: Spool, budget: RunBudget = None,
+                                                product_cache: Spool = None, marketplace: Marketplace = None) -> Spool:
     Logger.info(f"Scraping promo codes from urls in batch")
-    promo_codes = set()
+    budget = budget or RunBudget()
+    marketplace = marketplace or get_marketplace()
+    term_stats = get_term_stats(marketplace.id)
+    budget.start_stage(Stage.CODES, len(product_links))
+    output.reset()
+    if product_cache is not None:
+        product_cache.reset()
+    terms_by_code = output.get_store('terms_by_code')
+    terms_by_code.reset()
     total_batches = (len(product_links) - 1) // SCRAPING_URL_BATCH_SIZE + 1
-    for i in range(0, len(product_links), SCRAPING_URL_BATCH_SIZE):
-        Logger.info(f"Starting batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
-        batch = product_links[i:i + SCRAPING_URL_BATCH_SIZE]
+    for batch_index, batch in enumerate(product_links.read_chunks(SCRAPING_URL_BATCH_SIZE)):
+        if budget.is_exhausted():
+            break
+        Logger.info(f"Starting batch {batch_index + 1} of {total_batches}")
 
-        async with async_playwright() as p:
-            browser, page = await get_browser(p)
+        async with open_browser(marketplace) as (browser, page):
             for link in batch:
-                promo_codes.update(await scrape_promo_codes_from_product_url(page, link))
+                if budget.is_exhausted():
+                    break
+                promo_codes = await scrape_promo_codes_from_product_url(page, link.url)
+                if link.search_terms:
+                    term_stats.share(link.search_terms, 'page_loads')
+                for promo_code in promo_codes:
+                    terms_by_code.extend(promo_code, link.search_terms)
+                # Only products with a promotion can reach the details stage
+                if promo_codes and product_cache is not None:
+                    await cache_product_details(page, product_cache)
+                budget.advance()
                 await sleep_randomly(DELAY_BETWEEN_LINKS)
 
-        Logger.info(f"Completed batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
-        await sleep_randomly(BATCH_SIZE_DELAY, 3)
-
-    Logger.info(f"Finished scraping promo codes from urls in batch. Found {len(promo_codes)} promo codes", promo_codes)
-    return promo_codes
-
-
-async def scrape_links_from_promo_code(promo_code: str) -> list[Promotion]:
-    async with async_playwright() as p:
+        Logger.info(f"Completed batch {batch_index + 1} of {total_batches}")
+        if not budget.is_exhausted():
+            await sleep_randomly(BATCH_SIZE_DELAY, 3)
+
+    # Written once the stage is over, a code's search terms are only known after every link has been visited
+    for promo_code, search_terms in terms_by_code.items():
+        output.append(PromoCode(promo_code, search_terms))
+        for search_term in search_terms:
+            term_stats.add(search_term, 'promo_codes')
+    terms_by_code.close()
+    if product_cache is not None:
+        product_cache.mark_complete()
+
+    budget.end_stage()
+    finish_stage_output(output, budget, Stage.CODES)
+    Logger.info(f"Finished scraping promo codes from urls in batch. Found {len(output)} promo codes")
+    return output
+
+
+async def expand_promo_listing(page, known_asins: set[str] = None,
+                               max_clicks: int = MAX_SHOW_MORE_CLICKS) -> tuple[bool, int]:
+    """
+    Click "Show More" up to max_clicks times. Returns whether the whole listing was loaded, and the number of clicks.
+    With known_asins, stops as soon as the products loaded last are all known, taking the rest of the listing to be
+    known too, and returns True.
+    """
+    loaded_count = 0
+    clicks = 0
+    for index in range(max_clicks):
+        if known_asins:
+            product_urls = await get_promo_listing_urls(page)
+            loaded_asins = [get_asin_from_url(url) for url in product_urls[loaded_count:] if url]
+            loaded_count = len(product_urls)
+            if loaded_asins and all(asin in known_asins for asin in loaded_asins):
+                Logger.info(f'Only known products loaded after {index} "Show More" clicks, stopping early')
+                Metrics().increment('promos.early_stops')
+                return True, clicks
+        show_more_button = await page.query_selector('#showMore.showMoreBtn')
+        if show_more_button is None or not await show_more_button.is_visible():
+            return True, clicks
+        try:
+            await show_more_button.scroll_into_view_if_needed(timeout=10000)
+            await show_more_button.click(timeout=10000)
+            Logger.info('Clicked "Show More" button')
+            Metrics().increment('promos.show_more_clicks')
+            clicks += 1
+            await sleep_randomly(7, 1, 'Waiting for more results')
+        except Exception as e:
+            Logger.error(f"Error clicking 'Show More' button", e)
+            return False, clicks
+
+    show_more_button = await page.query_selector('#showMore.showMoreBtn')
+    return show_more_button is None or not await show_more_button.is_visible(), clicks
+
+
+async def get_promo_listing_urls(page) -> list[str]:
+    return await page.evaluate('''
+           () => {
+               const productCards = Array.from(document.querySelectorAll('#productInfoList > li.productGrid'));
+               return productCards.map(card => {
+                   const titleElement = card.querySelector('div.productTitleBox a');
+                   return titleElement ? titleElement.href : null;
+               });
+           }
+       ''')
+
+
+def get_known_asins(snapshot: dict | None) -> set[str]:
+    """ASINs of a promotion's snapshot that were processed recently enough to skip the details stage."""
+    if not snapshot:
+        return set()
+    known_since = datetime.utcnow() - timedelta(seconds=PROMO_SNAPSHOT_PRODUCT_TTL)
+    return {asin for asin, processed_at in snapshot.get('asins', {}).items() if processed_at >= known_since}
+
+
+def is_due_for_recheck(asin: str, run_date: date) -> bool:
+    """
+    Whether a known product is in the day's PROMO_SNAPSHOT_RECHECK_RATE share of products detailed again. The share is
+    sampled from a hash of the ASIN and the date, so a replayed run picks the same products.
+    """
+    sample = int(hashlib.sha1(f"{asin}:{run_date.isoformat()}".encode('utf-8')).hexdigest(), 16) % 1000
+    return sample < PROMO_SNAPSHOT_RECHECK_RATE * 1000
+
+
+async def scrape_links_from_promo_code(promo_code: str, search_terms: list[str] = None,
+                                       marketplace: Marketplace = None) -> tuple[list[Promotion], int, int]:
+    """
+    Collect the products of a promotion, returned with the number of keyword searches run for it and the number of
+    "Show More" clicks spent on its unfiltered listing. A promotion small enough to be listed in full without a search
+    is read from its unfiltered listing. Otherwise only the given search terms are searched, all saved searches when
+    None. The unfiltered listing is only expanded when the promotion is new or was listed in full last time, so a
+    promotion known to be too large goes straight to its keyword searches.
+    Products already known from the promotion's snapshot are left out, so only new products reach the details stage,
+    apart from a PROMO_SNAPSHOT_RECHECK_RATE share of them that is detailed again to catch price and sales changes.
+    """
+    marketplace = marketplace or get_marketplace()
+    term_stats = get_term_stats(marketplace.id)
+    snapshot = await get_promo_snapshot(promo_code, marketplace.id) if PROMO_SNAPSHOT_ENABLED else None
+    known_asins = get_known_asins(snapshot)
+    # Stopping the unfiltered listing early only skips the keyword searches safely if it was once listed in full
+    listing_known_asins = known_asins if snapshot and snapshot.get('listed_in_full') else None
+    # A promotion too large to list in full last time is only checked for having shrunk to its first page
+    listing_max_clicks = MAX_SHOW_MORE_CLICKS if not snapshot or snapshot.get('listed_in_full') else 0
+    async with open_browser(marketplace) as (browser, page):
         Logger.info(f"Scraping product urls from promo code: {promo_code}")
-        browser, page = await get_browser(p)
 
-        url = f'https://www.amazon.co.uk/promotion/psp/{promo_code}'
+        url = marketplace.get_promotion_url(promo_code)
         await page.goto(url)
+        if search_terms:
+            term_stats.share(search_terms, 'page_loads')
 
         all_promotion_products: list[Promotion] = []
 
         try:
-            page_title = await page.title()
-            if page_title.startswith("Amazon.co.uk: ") and page_title.endswith(" promotion"):
-                promotion_title = page_title[len("Amazon.co.uk: "):-len(" promotion")]
-            else:
-                promotion_title = "Unknown Promotion"
+            promotion_title = marketplace.parse_promotion_title(await page.title()) or "Unknown Promotion"
         except Exception as e:
             Logger.warn(f"Could not find or process page title:", e)
             promotion_title = "Unknown Promotion"
 
-        if check_promo_regex(promotion_title):
+        if marketplace.is_supported_promotion(promotion_title):
             Logger.info(f"Promotion title: {promotion_title} matches the regex")
         else:
             Logger.warn(f"Promotion title: {promotion_title} does not match the regex. Skipping...")
             await sleep_randomly(20, 3, 'Not a valid promotion')
-            return all_promotion_products
+            return all_promotion_products, 0, 0
 
         await sleep_randomly(5, 0.5, 'Waiting for page to load')
 
-        search_list = await get_all_searches()
-
-        for search in search_list:
+        listing_complete, listing_clicks = await expand_promo_listing(page, listing_known_asins, listing_max_clicks)
+        Metrics().increment('promos.unfiltered_show_more_clicks', listing_clicks)
+        for product_url in await get_promo_listing_urls(page):
+            all_promotion_products.append(Promotion(promo_code, promotion_title, url, product_url, marketplace.id))
+
+        # An empty listing may just mean the page lists nothing until searched, so it does not count as complete
+        listed_in_full = listing_complete and bool(all_promotion_products)
+        if listed_in_full:
+            Logger.info(f"Promo code {promo_code} listed in full with {len(all_promotion_products)} products, "
+                        f"skipping keyword searches")
+            search_terms = []
+        elif not search_terms:
+            search_terms = await get_all_searches(marketplace.id)
+        Metrics().increment('promos.keyword_searches', len(search_terms))
+
+        for search in search_terms:
             try:
                 Logger.info(f"Searching = '{search}' with promo code: {promo_code}")
+                term_stats.add(search, 'page_loads')
 
                 # Input search term
                 await page.fill('#keywordSearchInputText', search)
                 await page.click('#keywordSearchBtn', timeout=60000)
                 await sleep_randomly(7, 1, 'Waiting for search results')
-                for index in range(MAX_SHOW_MORE_CLICKS):
-                    try:
-                        show_more_button = await page.query_selector('#showMore.showMoreBtn')
-                        if show_more_button:
-                            await show_more_button.scroll_into_view_if_needed(timeout=10000)
-                            await show_more_button.click(timeout=10000)
-                            Logger.info('Clicked "Show More" button')
-                            await sleep_randomly(7, 1, 'Waiting for more results')
-                        else:
-                            raise Exception("Show More button not found")
-                    except:
-                        Logger.error(f"Error clicking 'Show More' button")
-                        break
-
-                product_urls = await page.evaluate('''
-                       () => {
-                           const productCards = Array.from(document.querySelectorAll('#productInfoList > li.productGrid'));
-                           return productCards.map(card => {
-                               const titleElement = card.querySelector('div.productTitleBox a');
-                               return titleElement ? titleElement.href : null;
-                           });
-                       }
-                   ''')
-
-                for product_url in product_urls:
-                    all_promotion_products.append(Promotion(promo_code, promotion_title, url, product_url))
+                await expand_promo_listing(page, known_asins)
+
+                for product_url in await get_promo_listing_urls(page):
+                    all_promotion_products.append(
+                        Promotion(promo_code, promotion_title, url, product_url, marketplace.id))
 
                 Logger.info(
                     f'Fetched {len(all_promotion_products)} products for search term: {search} and promo code: {promo_code}')
@@ -248,21 +495,59 @@ async def scrape_links_from_promo_code(promo_code: str) -> list[Promotion]:
                 Logger.info(
                     f"Finished Scraping product urls for promo code: {promo_code}. Found {len(all_promotion_products)} products")
 
-        return all_promotion_products
-
-
-async def scrape_links_from_promo_codes(promo_codes: set[str]) -> list[Promotion]:
+        if PROMO_SNAPSHOT_ENABLED:
+            await update_promo_snapshot(promo_code, marketplace.id, listed_in_full)
+        run_date = datetime.utcnow().date()
+        skipped_asins = {asin for asin in known_asins if not is_due_for_recheck(asin, run_date)}
+        new_promotion_products = [promotion for promotion in all_promotion_products
+                                  if get_asin_from_url(promotion.product_url) not in skipped_asins]
+        known_count = len(all_promotion_products) - len(new_promotion_products)
+        if known_count:
+            Logger.info(f"Skipping {known_count} known products of promo code {promo_code}, "
+                        f"{len(new_promotion_products)} new")
+            Metrics().increment('promos.known_products_skipped', known_count)
+        return new_promotion_products, len(search_terms), listing_clicks
+
+
+async def scrape_links_from_promo_codes(promo_codes: Spool | list[PromoCode], output: Spool,
+                                        budget: RunBudget = None, marketplace: Marketplace = None) -> Spool:
     Logger.info('scraping product links from all promo codes')
-
-    promotions_list: list[Promotion] = []
-    for coupon_index, promo_code in enumerate(promo_codes):
+    budget = budget or RunBudget()
+    marketplace = marketplace or get_marketplace()
+    output.reset()
+
+    # Visit promotions with the best selling products first
+    promo_codes = {promo_code.code: promo_code for promo_code in promo_codes}
+    get_term_stats(marketplace.id).set_promo_code_terms(promo_codes.values())
+    promo_code_scores = await get_promo_code_sales_scores(list(promo_codes), marketplace.id)
+    sorted_promo_codes = sorted(promo_codes, key=lambda code: promo_code_scores[code], reverse=True)
+    budget.start_stage(Stage.PROMOS, len(sorted_promo_codes))
+
+    metrics = Metrics()
+    saved_search_count = len(await get_all_searches(marketplace.id))
+    # Counted here rather than from the shared metrics, which other marketplaces' runs add to at the same time
+    keyword_searches = 0
+    listing_clicks = 0
+    visited_promo_codes = 0
+    visited_codes = output.get_store('visited_codes')
+    visited_codes.reset()
+
+    for coupon_index, promo_code in enumerate(sorted_promo_codes):
+        if budget.is_exhausted():
+            break
+        visited_promo_codes += 1
         max_attempts = 3
         for attempt in range(max_attempts):
             try:
                 Logger.info(
                     f"Attempting coupon {coupon_index + 1}/{len(promo_codes)}, attempt {attempt + 1}/{max_attempts}")
-                promo_results = await scrape_links_from_promo_code(promo_code)
-                promotions_list.extend(promo_results)
+                promo_results, promo_keyword_searches, promo_listing_clicks = await scrape_links_from_promo_code(
+                    promo_code, promo_codes[promo_code].search_terms, marketplace)
+                keyword_searches += promo_keyword_searches
+                listing_clicks += promo_listing_clicks
+                for promotion in promo_results:
+                    output.append(promotion, key=f"{promotion.promotion_code}/{promotion.product_url}")
+                visited_codes.insert(promo_code, len(promo_results))
                 await sleep_randomly(DELAY_BETWEEN_SEARCHES)
                 break
             except Exception as e:
@@ -276,10 +561,20 @@ async def scrape_links_from_promo_codes(promo_codes: set[str]) -> list[Promotion
                     Logger.info(
                         f"Retrying coupon {coupon_index + 1}/{len(promo_codes)}, attempt {attempt + 2}/{max_attempts} for promo code {promo_code}...")
                     await sleep_randomly(20, 5, 'Retrying coupon')
-    Logger.info(
-        f'finished scraping product links from all promo codes. found {len(promotions_list)} items with promotions',
-        promotions_list)
-    return promotions_list
+        budget.advance()
+    visited_codes.close()
+
+    # Compared with searching every saved term for every promo code, as this stage did before tracking provenance.
+    # That never expanded the unfiltered listing, so each click on it is counted as one page load against the savings
+    keyword_searches_avoided = max(saved_search_count * visited_promo_codes - keyword_searches - listing_clicks, 0)
+    metrics.increment('promos.keyword_searches_avoided', keyword_searches_avoided)
+    Logger.info(f"Ran {keyword_searches} keyword searches and {listing_clicks} unfiltered listing expansions for "
+                f"{visited_promo_codes} promo codes, avoided {keyword_searches_avoided} keyword searches")
+
+    budget.end_stage()
+    finish_stage_output(output, budget, Stage.PROMOS)
+    Logger.info(f'finished scraping product links from all promo codes. found {len(output)} items with promotions')
+    return output
 
 
 async def scrape_product_details_from_url(page, promotion_link: Promotion) -> ProductDetails:
@@ -288,131 +583,257 @@ async def scrape_product_details_from_url(page, promotion_link: Promotion) -> Pr
         Logger.info(f"Scraping product details : {product_link}")
         await page.goto(product_link)
 
-        product = await page.evaluate('''
-            () => {
-                const product_title = document.querySelector('#productTitle').innerText;
-                const product_url = window.location.href;
-                const product_img = document.querySelector('#landingImage').src;
-
-                // Get the ASIN (extracted from the product URL)
-                const asin = product_url ? product_url.match(/\/dp\/(\\w+)/) ? product_url.match(/\/dp\/(\\w+)/)[1] : null : null;
-
-                // Get the current price
-                const priceElement = document.querySelector('#corePriceDisplay_desktop_feature_div .reinventPricePriceToPayMargin');
-                const current_price = priceElement ? priceElement.textContent.trim() : null;
-
-                // Get sales in last month
-                const salesElement = document.querySelector('#social-proofing-faceout-title-tk_bought');
-                const sales_last_month_raw = salesElement ? salesElement.textContent.trim() : 'N/A';
-
-                // Function to convert sales string to number
-                const convertSales = (salesStr) => {
-                    const match = salesStr.match(/(\d+)([KM]?)\+/);
-                    if (match) {
-                        const number = parseInt(match[1]);
-                        const unit = match[2];
-                        if (unit === 'K') {
-                            return number * 1000;
-                        } else if (unit === 'M') {
-                            return number * 1000000;
-                        } else {
-                            return number;
-                        }
-                    }
-                    return 0;
-                };
-
-                // Convert sales_last_month to number
-                const sales_last_month = convertSales(sales_last_month_raw);
+        # Archived before extracting, so pages the current selectors fail on can be re-extracted after a fix
+        await PageArchive().store(page, promotion_link)
+        product = await page.evaluate(PRODUCT_DETAILS_SCRIPT)
 
-                return {
-                    product_img,
-                    product_title,
-                    product_url,
-                    asin,
-                    current_price,
-                    sales_last_month
-                };
-            }
-        ''')
-
-        return ProductDetails(
-            promotion_code=promotion_link.promotion_code,
-            promotion_title=promotion_link.promotion_title,
-            promotion_url=promotion_link.promotion_url,
-            product_url=promotion_link.product_url,
-            product_title=product['product_title'],
-            product_image_url=product['product_img'],
-            product_price=product['current_price'],
-            product_sales=product['sales_last_month'],
-            product_asin=product['asin'],
-        )
+        return build_product_details(promotion_link, product)
     except Exception as e:
-        Logger.error(f"Error scraping product - {product_link}, Most Likely Captcha is detected!", e)
+        Logger.error(f"Error scraping product - {product_link}", e)
+        if await is_block_page(page):
+            raise BlockPageDetected(f"Block page detected while scraping product: {product_link}") from e
         raise e
     finally:
         Logger.info(f"Finished scraping product details : {product_link}")
 
 
-async def scrape_product_details_from_urls_in_batch(product_links: list[Promotion]) -> list[ProductDetails]:
+async def scrape_product_details_from_urls_in_batch(product_links: Spool, output: Spool, budget: RunBudget = None,
+                                                    product_cache: Spool = None,
+                                                    marketplace: Marketplace = None) -> Spool:
     Logger.info(f"Scraping product details from urls in batch")
-    product_details_list: list[ProductDetails] = []
+    budget = budget or RunBudget()
+    marketplace = marketplace or get_marketplace()
+    budget.start_stage(Stage.DETAILS, len(product_links))
+    output.reset()
+    controller = get_controller(Stage.DETAILS, DELAY_BETWEEN_LINKS, marketplace.id)
+    term_stats = get_term_stats(marketplace.id)
+    cache_hits = 0
 
     total_batches = (len(product_links) - 1) // SCRAPING_URL_BATCH_SIZE + 1
-    for i in range(0, len(product_links), SCRAPING_URL_BATCH_SIZE):
-        Logger.info(f"Starting batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
-        batch = product_links[i:i + SCRAPING_URL_BATCH_SIZE]
-
-        async with async_playwright() as p:
-            browser, page = await get_browser(p)
-            for link in batch:
-                try:
-                    product_details_list.append(await scrape_product_details_from_url(page, link))
-                    await sleep_randomly(DELAY_BETWEEN_LINKS)
-                except:
-                    await sleep_randomly(CAPTCHA_DETECTED_DELAY, 3)
-                    pass
-
-        Logger.info(f"Completed batch {i // SCRAPING_URL_BATCH_SIZE + 1} of {total_batches}")
-        await sleep_randomly(BATCH_SIZE_DELAY, 3)
-
-    Logger.info(f"Finished Scraping product details from urls in batch. Found {len(product_details_list)} promo codes",
-                product_details_list)
-    return product_details_list
+    for batch_index, batch in enumerate(product_links.read_chunks(SCRAPING_URL_BATCH_SIZE)):
+        if budget.is_exhausted():
+            break
+
+        # Products already read during the codes stage are built from the cache instead of loading their page again
+        links_to_scrape = []
+        for link in batch:
+            cached_product = get_cached_product(product_cache, get_asin_from_url(link.product_url))
+            if cached_product is None:
+                links_to_scrape.append(link)
+                continue
+            output.append(build_product_details(link, cached_product['product']))
+            PageArchive().record(cached_product['product']['product_url'], cached_product['content_hash'], link)
+            cache_hits += 1
+            budget.advance()
+        if not links_to_scrape:
+            continue
+        batch = links_to_scrape
+        Logger.info(f"Starting batch {batch_index + 1} of {total_batches}")
+
+        async with open_browser(marketplace) as (browser, page):
+
+            async def scrape_link(link: Promotion):
+                async with controller.slot():
+                    if budget.is_exhausted():
+                        return
+                    await controller.pace()
+                    link_page = await browser.new_page()
+                    term_stats.share_for_promo_code(link.promotion_code, 'page_loads')
+                    try:
+                        output.append(await scrape_product_details_from_url(link_page, link))
+                        await controller.record(OUTCOME_SUCCESS)
+                    except Exception as e:
+                        await controller.record(classify_error(e))
+                    finally:
+                        budget.advance()
+                        await link_page.close()
+
+            await asyncio.gather(*[scrape_link(link) for link in batch])
+
+        Logger.info(f"Completed batch {batch_index + 1} of {total_batches}")
+        if not budget.is_exhausted():
+            await sleep_randomly(BATCH_SIZE_DELAY, 3)
+
+    Metrics().increment('details.cache_hits', cache_hits)
+    budget.end_stage()
+    finish_stage_output(output, budget, Stage.DETAILS)
+    Logger.info(f"Finished Scraping product details from urls in batch. Found {len(output)} products, "
+                f"{cache_hits} of them from the codes stage without loading their page")
+    return output
+
+
+async def sleep_between_steps(budget: RunBudget):
+    if budget.has_time_for(DELAY_BETWEEN_STEPS):
+        await sleep_randomly(DELAY_BETWEEN_STEPS)
+    else:
+        Logger.warn('Skipping delay between steps, the run budget is nearly used up')
 
 
-async def startScraper() -> ProcessedProductDetails:
+def merge_promo_codes(promo_codes, extra_promo_codes: list[PromoCode]) -> list[PromoCode]:
+    """Add promo codes to revisit to the ones found by this run, joining the search terms of codes found in both."""
+    merged = {promo_code.code: promo_code for promo_code in promo_codes}
+    for promo_code in extra_promo_codes:
+        if promo_code.code in merged:
+            search_terms = merged[promo_code.code].search_terms
+            search_terms.extend(term for term in promo_code.search_terms if term not in search_terms)
+        else:
+            merged[promo_code.code] = promo_code
+    return list(merged.values())
+
+
+def finish_stage_output(output: Spool, budget: RunBudget, stage: str):
+    """
+    Mark a stage's spool complete, unless the run budget or a cancellation cut the stage short. Its partial results
+    still reach the later stages of this run, but resuming the run runs the stage again.
+    """
+    if budget.was_cut_short(stage):
+        output.close()
+        Logger.warn(f"Stage '{stage}' was cut short, a resumed run will run it again")
+    else:
+        output.mark_complete()
+
+
+def should_run_stage(stage: str, stages: list[str], spool: Spool) -> bool:
+    if stage not in stages:
+        return False
+    if spool.is_complete():
+        Logger.info(f"Reusing results of a completed stage from {spool.path}")
+        return False
+    return True
+
+
+def has_later_stage(stage: str, stages: list[str]) -> bool:
+    return any(later_stage in stages for later_stage in Stage.SCRAPING[Stage.SCRAPING.index(stage) + 1:])
+
+
+def get_run_id(marketplace: Marketplace, run_id: str = None) -> str:
+    """Runs of the other marketplaces get a suffix so that concurrent runs never share spools."""
+    run_id = run_id or time.strftime('%Y%m%d-%H%M%S')
+    return run_id if marketplace.id == DEFAULT_MARKETPLACE else f"{run_id}-{marketplace.id}"
+
+
+async def startScraper(budget_seconds: float = None, run_id: str = None, budget: RunBudget = None,
+                       stages: list[str] = None, search_terms: list[str] = None,
+                       revisit_promo_codes: list[PromoCode] = None,
+                       marketplace: Marketplace = None) -> ProcessedProductDetails:
+    """
+    Run the full pipeline of one marketplace, or only the given stages reading their input from the run's spools.
+    Passing the run_id of an interrupted run resumes it after its last completed stage.
+    A budget created by the caller can be used to follow progress and cancel the run.
+    Promo codes to revisit are visited by the promos stage along with the ones this run finds.
+    """
     Logger.info('Starting the Scraper')
     start_time = time.time()
+    marketplace = marketplace or get_marketplace()
+    run_id = run_id or get_run_id(marketplace)
+    stages = stages or Stage.SCRAPING + [Stage.PROCESS]
+    Logger.info(f"Run id: {run_id}, marketplace: {marketplace.id}, stages: {stages}")
 
     await connect_to_database()
+    budget = budget or RunBudget(budget_seconds)
+    budget.set_history(await get_recent_run_stats(marketplace_id=marketplace.id))
+    cleanup_old_spools()
+    cleanup_old_archives()
+
+    profiler = StageProfiler()
+    profiler.start_run(run_id)
+    har_manager = HarManager()
+    har_manager.start_run(run_id)
+    PageArchive().start_run(run_id, marketplace.id)
+    term_stats = get_term_stats(marketplace.id)
+    term_stats.start_run()
+    filtered_products = ProcessedProductDetails()
 
     try:
-        # await setup_amazon_uk()
+        # await setup_marketplace(marketplace)
         # await sleep_randomly(DELAY_BETWEEN_STEPS)
 
-        product_links = await scraping_promo_products_from_searches()
-        await sleep_randomly(DELAY_BETWEEN_STEPS)
-
-        promo_codes = await scrape_promo_codes_from_urls_in_batch(product_links)
-        await sleep_randomly(DELAY_BETWEEN_STEPS)
-
-        promotions_list = await scrape_links_from_promo_codes(promo_codes)
-        await sleep_randomly(DELAY_BETWEEN_STEPS)
-
-        product_details_list = await scrape_product_details_from_urls_in_batch(promotions_list)
-
-        filtered_products = await process_products(product_details_list)
+        product_links = product_links_spool(run_id)
+        if should_run_stage(Stage.SEARCH, stages, product_links):
+            har_manager.set_stage(Stage.SEARCH)
+            with profiler.stage(Stage.SEARCH):
+                await scraping_promo_products_from_searches(product_links, budget, search_terms, marketplace)
+            if has_later_stage(Stage.SEARCH, stages):
+                await sleep_between_steps(budget)
+
+        promo_codes = promo_codes_spool(run_id)
+        product_cache = product_cache_spool(run_id)
+        if should_run_stage(Stage.CODES, stages, promo_codes):
+            har_manager.set_stage(Stage.CODES)
+            with profiler.stage(Stage.CODES):
+                await scrape_promo_codes_from_urls_in_batch(product_links, promo_codes, budget, product_cache,
+                                                            marketplace)
+            if has_later_stage(Stage.CODES, stages):
+                await sleep_between_steps(budget)
+
+        promotions_list = promotions_spool(run_id)
+        if should_run_stage(Stage.PROMOS, stages, promotions_list):
+            har_manager.set_stage(Stage.PROMOS)
+            with profiler.stage(Stage.PROMOS):
+                promo_code_inputs = merge_promo_codes(promo_codes, revisit_promo_codes) if revisit_promo_codes \
+                    else promo_codes
+                await scrape_links_from_promo_codes(promo_code_inputs, promotions_list, budget, marketplace)
+            if has_later_stage(Stage.PROMOS, stages):
+                await sleep_between_steps(budget)
+
+        product_details_list = product_details_spool(run_id)
+        if should_run_stage(Stage.DETAILS, stages, product_details_list):
+            har_manager.set_stage(Stage.DETAILS)
+            with profiler.stage(Stage.DETAILS):
+                await scrape_product_details_from_urls_in_batch(promotions_list, product_details_list, budget,
+                                                                product_cache, marketplace)
+
+        if Stage.PROCESS in stages:
+            with profiler.stage(Stage.PROCESS):
+                filtered_products = await process_products(product_details_list)
+            for product in filtered_products.upserted:
+                term_stats.share_for_promo_code(product.promotion_code, 'deals')
 
     except Exception as e:
         Logger.critical(f"FAILED!! FAILED!! FAILED!! FAILED!! FAILED!! FAILED!! FAILED!! FAILED!!", e)
         filtered_products = ProcessedProductDetails()
 
+    profiler.end_run()
+
+    try:
+        await save_run_stats({**budget.to_document(), 'marketplace': marketplace.id})
+        await update_search_term_stats(term_stats.take(), marketplace.id)
+    except Exception as e:
+        Logger.error('Error saving run stats', e)
+
     end_time = time.time()
     total_time = end_time - start_time
     hours, remainder = divmod(total_time, 3600)
     minutes, seconds = divmod(remainder, 60)
     Logger.info(f"Scraper finished execution in {int(hours)} hours, {int(minutes)} minutes, and {int(seconds)} seconds")
+    Metrics().log_snapshot()
 
     Logger.info('Ending the Scraper')
     return filtered_products
+
+
+async def start_marketplace_scrapers(run_function, budget: RunBudget = None,
+                                     marketplaces: list[Marketplace] = None) -> dict[str, ProcessedProductDetails]:
+    """
+    Run run_function(marketplace, budget) for every enabled marketplace at the same time in this process. Each
+    marketplace has its own browser profile, controllers and run, and a child of the given budget so that cancelling
+    it stops them all. Profiling and HAR recording follow one run at a time, so with either on they run in turn.
+    """
+    marketplaces = marketplaces or get_enabled_marketplaces()
+    budget = budget or RunBudget()
+    if len(marketplaces) == 1:
+        return {marketplaces[0].id: await run_function(marketplaces[0], budget)}
+
+    async def run_marketplace(marketplace: Marketplace) -> ProcessedProductDetails:
+        try:
+            return await run_function(marketplace, budget.create_child(marketplace.id))
+        except Exception as e:
+            Logger.critical(f"Run of marketplace {marketplace.id} failed", e)
+            return ProcessedProductDetails()
+
+    if StageProfiler().enabled or HarManager().mode != HAR_MODE_OFF:
+        Logger.warn('Profiling or HAR recording is on, running marketplaces one at a time')
+        results = [await run_marketplace(marketplace) for marketplace in marketplaces]
+    else:
+        results = await asyncio.gather(*[run_marketplace(marketplace) for marketplace in marketplaces])
+    return {marketplace.id: result for marketplace, result in zip(marketplaces, results)}
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+from config import SPOOL_DIRECTORY, SPOOL_BUFFER_SIZE, SPOOL_RETENTION_DAYS, SPOOL_STORE_CACHE_KB
+from logger import Logger
+from models import Stage, ProductLink, PromoCode, Promotion, ProductDetails
+from utils import chunked
+
+
+class KeyValueStore:
+    """
+    SQLite table of JSON values by key, for state that would otherwise grow in memory with the size of a run. SQLite
+    keeps at most SPOOL_STORE_CACHE_KB of it in memory and the rest on disk. Keys are iterated in insertion order.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute(f"PRAGMA cache_size = -{SPOOL_STORE_CACHE_KB}")
+            # Scratch data of a single run, which is rebuilt if lost
+            self._connection.execute("PRAGMA synchronous = OFF")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS items (key BLOB PRIMARY KEY, value TEXT)")
+        return self._connection
+
+    def reset(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def insert(self, key, value) -> bool:
+        """Store a value unless the key is already stored. Returns whether it was stored."""
+        cursor = self.connection.execute("INSERT OR IGNORE INTO items (key, value) VALUES (?, ?)",
+                                         (key, json.dumps(value)))
+        return cursor.rowcount == 1
+
+    def get(self, key):
+        if self._connection is None and not os.path.exists(self.path):
+            return None
+        row = self.connection.execute("SELECT value FROM items WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def extend(self, key, values: list):
+        """Add the values missing from the list stored under a key, creating it if needed."""
+        current = self.get(key)
+        if current is None:
+            self.connection.execute("INSERT INTO items (key, value) VALUES (?, ?)", (key, json.dumps(list(values))))
+            return
+        missing = [value for value in values if value not in current]
+        if missing:
+            self.connection.execute("UPDATE items SET value = ? WHERE key = ?", (json.dumps(current + missing), key))
+
+    def items(self):
+        self.commit()
+        for key, value in self.connection.execute("SELECT key, value FROM items ORDER BY rowid"):
+            yield key, json.loads(value)
+
+    def commit(self):
+        if self._connection is not None:
+            self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+
+class Spool:
+    """
+    Append-only JSONL file holding one stage's results for a run. At most SPOOL_BUFFER_SIZE items are held in memory
+    before being flushed, and reads are streamed back from disk. Keys of keyed items are kept in a KeyValueStore next
+    to the file, with the offset of their line, so deduplication and lookups by key do not grow memory either.
+    """
+
+    def __init__(self, path: str, encode=None, decode=None):
+        self.path = path
+        self.done_path = f"{path}.done"
+        self.encode = encode or (lambda item: item)
+        self.decode = decode or (lambda item: item)
+        self.keys = KeyValueStore(f"{path}.keys.sqlite")
+        self._buffer = []
+        self._count = None
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def reset(self):
+        """Discard anything written by an earlier, unfinished attempt at this stage."""
+        self._buffer = []
+        self._count = 0
+        self._size = 0
+        self.keys.reset()
+        open(self.path, 'w').close()
+        if os.path.exists(self.done_path):
+            os.remove(self.done_path)
+
+    def get_store(self, name: str) -> KeyValueStore:
+        """A KeyValueStore kept alongside this spool, for a stage's own keyed state."""
+        return KeyValueStore(f"{self.path}.{name}.sqlite")
+
+    @staticmethod
+    def get_key_digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def append(self, item, key: str = None) -> bool:
+        """Append an item. Items with a key that was already appended are skipped."""
+        if key is not None and not self.keys.insert(self.get_key_digest(key), self._size):
+            return False
+
+        line = json.dumps(self.encode(item))
+        self._buffer.append(line)
+        self._size += len(line.encode('utf-8')) + 1
+        self._count = len(self) + 1
+        if len(self._buffer) >= SPOOL_BUFFER_SIZE:
+            self.flush()
+        return True
+
+    def get(self, key: str):
+        """The item appended with a key, read from its line on disk, or None."""
+        offset = self.keys.get(self.get_key_digest(key))
+        if offset is None:
+            return None
+        self.flush()
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            return self.decode(json.loads(file.readline()))
+
+    def flush(self):
+        self.keys.commit()
+        if not self._buffer:
+            return
+        with open(self.path, 'a', encoding='utf-8', newline='\n') as file:
+            file.write('\n'.join(self._buffer) + '\n')
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self.keys.close()
+
+    def mark_complete(self):
+        self.close()
+        open(self.done_path, 'w').close()
+        Logger.info(f"Spool complete: {self.path} ({len(self)} items)")
+
+    def is_complete(self) -> bool:
+        return os.path.exists(self.done_path)
+
+    def __len__(self):
+        if self._count is None:
+            self._count = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    self._count = sum(1 for _ in file)
+        return self._count
+
+    def __iter__(self):
+        self.flush()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield self.decode(json.loads(line))
+
+    def read_chunks(self, size: int):
+        yield from chunked(self, size)
+
+
+def get_spool_path(run_id: str, stage: str) -> str:
+    return os.path.join(SPOOL_DIRECTORY, run_id, f"{stage}.jsonl")
+
+
+def product_links_spool(run_id: str) -> Spool:
+    return Spool(get_spool_path(run_id, Stage.SEARCH),
+                 encode=lambda link: link.to_dict(),
+                 decode=ProductLink.from_dict)
+
+
+def promo_codes_spool(run_id: str) -> Spool:
+    return Spool(get_spool_path(run_id, Stage.CODES),
+                 encode=lambda promo_code: promo_code.to_dict(),
+                 decode=PromoCode.from_dict)
+
+
+def promotions_spool(run_id: str) -> Spool:
+    return Spool(get_spool_path(run_id, Stage.PROMOS),
+                 encode=lambda promotion: promotion.to_dict(),
+                 decode=Promotion.from_dict)
+
+
+def product_details_spool(run_id: str) -> Spool:
+    return Spool(get_spool_path(run_id, Stage.DETAILS),
+                 encode=lambda product: product.to_dict(),
+                 decode=ProductDetails.from_dict)
+
+
+def product_cache_spool(run_id: str) -> Spool:
+    """Product details read during the codes stage, keyed by ASIN, so the details stage can skip those pages."""
+    return Spool(get_spool_path(run_id, 'product_cache'))
+
+
+def cleanup_old_spools():
+    if not os.path.isdir(SPOOL_DIRECTORY):
+        return
+    cutoff_time = time.time() - SPOOL_RETENTION_DAYS * 24 * 60 * 60
+    for run_id in os.listdir(SPOOL_DIRECTORY):
+        run_directory = os.path.join(SPOOL_DIRECTORY, run_id)
+        if os.path.isdir(run_directory) and os.path.getmtime(run_directory) < cutoff_time:
+            shutil.rmtree(run_directory, ignore_errors=True)
+            Logger.info(f"Removed old spool directory: {run_directory}")
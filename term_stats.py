@@ -0,0 +1,65 @@
+from config import SCHEDULER_YIELD_MIN_PAGE_LOADS, DEFAULT_MARKETPLACE
+from logger import Logger
+
+TERM_STAT_FIELDS = ['links', 'promo_codes', 'deals', 'page_loads']
+
+
+class SearchTermStats:
+    """
+    Per search term counters of the current run, added to each term's totals in Searches when the run ends.
+    Links and promo codes count in full for every term that found them. Page loads and deals are shared between the
+    terms they came from, so that each term's cost per deal adds up to the run's actual cost.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.terms_by_promo_code = {}
+
+    def start_run(self):
+        self.stats = {}
+        self.terms_by_promo_code = {}
+
+    def add(self, search_term: str, field: str, amount: float = 1):
+        term_stats = self.stats.setdefault(search_term, {stat_field: 0 for stat_field in TERM_STAT_FIELDS})
+        term_stats[field] += amount
+
+    def share(self, search_terms: list[str], field: str, amount: float = 1):
+        for search_term in search_terms:
+            self.add(search_term, field, amount / len(search_terms))
+
+    def set_promo_code_terms(self, promo_codes):
+        self.terms_by_promo_code = {promo_code.code: promo_code.search_terms for promo_code in promo_codes}
+
+    def share_for_promo_code(self, promo_code: str, field: str, amount: float = 1):
+        search_terms = self.terms_by_promo_code.get(promo_code)
+        if search_terms:
+            self.share(search_terms, field, amount)
+
+    def take(self) -> dict[str, dict]:
+        stats, self.stats = self.stats, {}
+        Logger.info(f"Collected yield stats for {len(stats)} search terms")
+        return stats
+
+
+_term_stats: dict[str, SearchTermStats] = {}
+
+
+def get_term_stats(marketplace_id: str = DEFAULT_MARKETPLACE) -> SearchTermStats:
+    """The counters of a marketplace's current run. Each marketplace has its own search terms and runs concurrently."""
+    if marketplace_id not in _term_stats:
+        _term_stats[marketplace_id] = SearchTermStats()
+    return _term_stats[marketplace_id]
+
+
+def get_term_yield(term_stats: dict | None) -> float | None:
+    """Deals per page load, None until the term has had enough page loads to judge."""
+    if not term_stats or term_stats.get('page_loads', 0) < SCHEDULER_YIELD_MIN_PAGE_LOADS:
+        return None
+    return term_stats.get('deals', 0) / term_stats['page_loads']
+
+
+def get_cost_per_deal(term_stats: dict | None) -> float | None:
+    """Page loads spent per deal found, None if the term has not found a deal yet."""
+    if not term_stats or not term_stats.get('deals'):
+        return None
+    return term_stats.get('page_loads', 0) / term_stats['deals']
@@ -0,0 +1,108 @@
+"""
+Tests for the AIMD controller that sets each stage's concurrency and request delay from its recent outcomes.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('colorama')
+pytest.importorskip('pytz')
+pytest.importorskip('playwright')
+
+from adaptive import AdaptiveController, BlockPageDetected, classify_error, OUTCOME_SUCCESS, OUTCOME_TIMEOUT, \
+    OUTCOME_BLOCKED, OUTCOME_ERROR  # noqa: E402
+from config import ADAPTIVE_MIN_CONCURRENCY, ADAPTIVE_MAX_CONCURRENCY, ADAPTIVE_RECOVERY_SUCCESSES, \
+    ADAPTIVE_WINDOW_SIZE, ADAPTIVE_FAILURE_THRESHOLD, ADAPTIVE_DELAY_STEP, ADAPTIVE_MAX_DELAY_FACTOR  # noqa: E402
+
+BASE_DELAY = 10
+
+
+async def record(controller: AdaptiveController, outcome: str, times: int = 1):
+    for _ in range(times):
+        await controller.record(outcome)
+
+
+def test_classify_error():
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+    assert classify_error(BlockPageDetected()) == OUTCOME_BLOCKED
+    assert classify_error(PlaywrightTimeoutError('timed out')) == OUTCOME_TIMEOUT
+    assert classify_error(ValueError()) == OUTCOME_ERROR
+
+
+def test_concurrency_grows_by_one_after_each_streak_of_successes():
+    async def scenario():
+        controller = AdaptiveController('uk.test', BASE_DELAY)
+        assert controller.concurrency_limit == ADAPTIVE_MIN_CONCURRENCY
+
+        await record(controller, OUTCOME_SUCCESS, ADAPTIVE_RECOVERY_SUCCESSES - 1)
+        assert controller.concurrency_limit == ADAPTIVE_MIN_CONCURRENCY
+        await record(controller, OUTCOME_SUCCESS)
+        assert controller.concurrency_limit == ADAPTIVE_MIN_CONCURRENCY + 1
+
+        await record(controller, OUTCOME_SUCCESS, ADAPTIVE_RECOVERY_SUCCESSES * ADAPTIVE_MAX_CONCURRENCY)
+        assert controller.concurrency_limit == ADAPTIVE_MAX_CONCURRENCY
+        assert controller.delay == BASE_DELAY
+
+    asyncio.run(scenario())
+
+
+def test_rising_failure_rate_halves_concurrency_and_doubles_the_delay():
+    async def scenario():
+        controller = AdaptiveController('uk.test', BASE_DELAY)
+        await record(controller, OUTCOME_SUCCESS, ADAPTIVE_RECOVERY_SUCCESSES * ADAPTIVE_MAX_CONCURRENCY)
+        assert controller.concurrency_limit == ADAPTIVE_MAX_CONCURRENCY
+
+        # The window is full of successes, so backing off takes the threshold's share of failures
+        failures_to_back_off = int(ADAPTIVE_WINDOW_SIZE * ADAPTIVE_FAILURE_THRESHOLD)
+        await record(controller, OUTCOME_TIMEOUT, failures_to_back_off - 1)
+        assert controller.concurrency_limit == ADAPTIVE_MAX_CONCURRENCY
+        await record(controller, OUTCOME_TIMEOUT)
+        assert controller.concurrency_limit == max(ADAPTIVE_MIN_CONCURRENCY, ADAPTIVE_MAX_CONCURRENCY // 2)
+        assert controller.delay == BASE_DELAY * 2
+        assert controller.failure_rate() == 0
+
+        # Recovery takes the delay back one step at a time
+        await record(controller, OUTCOME_SUCCESS, ADAPTIVE_RECOVERY_SUCCESSES)
+        assert controller.delay == pytest.approx(BASE_DELAY * (2 - ADAPTIVE_DELAY_STEP))
+
+    asyncio.run(scenario())
+
+
+def test_a_block_page_backs_off_at_once_with_a_cooldown_and_the_delay_is_capped():
+    async def scenario():
+        controller = AdaptiveController('uk.test', BASE_DELAY)
+        await record(controller, OUTCOME_BLOCKED)
+        assert controller.delay == BASE_DELAY * 2
+        assert controller.next_request_at > 0
+
+        await record(controller, OUTCOME_BLOCKED, 10)
+        assert controller.delay == BASE_DELAY * ADAPTIVE_MAX_DELAY_FACTOR
+        assert controller.concurrency_limit == ADAPTIVE_MIN_CONCURRENCY
+
+    asyncio.run(scenario())
+
+
+def test_slots_never_exceed_the_concurrency_limit():
+    async def scenario():
+        controller = AdaptiveController('uk.test', BASE_DELAY)
+        controller.concurrency_limit = 2
+        running = []
+        peak = 0
+
+        async def work():
+            nonlocal peak
+            async with controller.slot():
+                running.append(1)
+                peak = max(peak, len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+
+        await asyncio.gather(*[work() for _ in range(6)])
+        assert peak == 2
+
+        controller.set_max_concurrency(1)
+        assert controller.concurrency_limit == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,87 @@
+"""
+Tests for how DataManager persists the bot's settings to database.json.
+"""
+import asyncio
+import json
+import os
+
+import pytest
+
+pytest.importorskip('colorama')
+
+import data_manager  # noqa: E402
+from data_manager import DataManager, FileSettingsStore  # noqa: E402
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    """A fresh DataManager reading and writing database.json in an empty directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(data_manager, 'DATA_MANAGER_SAVE_DELAY', 0.05)
+    DataManager._instance = None
+    yield DataManager()
+    DataManager._instance = None
+
+
+def test_write_replaces_the_file_and_leaves_no_temporary_files(tmp_path):
+    store = FileSettingsStore(str(tmp_path / 'database.json'))
+    store.write({'channels': [1], 'monthly_sales_cutoff': 100})
+    store.write({'channels': [1, 2], 'monthly_sales_cutoff': 200})
+
+    assert store.load() == {'channels': [1, 2], 'monthly_sales_cutoff': 200}
+    assert os.listdir(tmp_path) == ['database.json']
+
+
+def test_a_failed_write_keeps_the_previous_file(tmp_path, monkeypatch):
+    store = FileSettingsStore(str(tmp_path / 'database.json'))
+    store.write({'channels': [1], 'monthly_sales_cutoff': 100})
+
+    def fail_midway(data, file, **kwargs):
+        file.write('{"channels": [')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(data_manager.json, 'dump', fail_midway)
+    with pytest.raises(OSError):
+        store.write({'channels': [1, 2], 'monthly_sales_cutoff': 200})
+
+    assert store.load() == {'channels': [1], 'monthly_sales_cutoff': 100}
+    assert os.listdir(tmp_path) == ['database.json']
+
+
+def test_rapid_changes_are_merged_into_one_write(manager, monkeypatch):
+    writes = []
+    monkeypatch.setattr(manager.file_store, 'write', writes.append)
+
+    async def scenario():
+        manager.add_notification_channel(1)
+        manager.add_notification_channel(2)
+        manager.set_monthly_sales_cutoff(500)
+        manager.remove_notification_channel(1)
+        assert writes == []
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert len(writes) == 1
+    assert writes[0]['channels'] == [2]
+    assert writes[0]['monthly_sales_cutoff'] == 500
+    assert manager.pending_channels == {}
+    assert manager.pending_cutoff is None
+
+
+def test_flush_writes_pending_changes_at_once_and_they_are_loaded_again(manager):
+    async def scenario():
+        manager.add_notification_channel(1)
+        manager.set_channel_top_k(1, 5)
+        manager.set_channel_marketplaces(1, ['uk', 'de'])
+        await manager.flush()
+
+    asyncio.run(scenario())
+    with open('database.json') as file:
+        assert json.load(file) == {'channels': [1], 'monthly_sales_cutoff': 100, 'channel_top_k': {'1': 5},
+                                   'channel_marketplaces': {'1': ['uk', 'de']}}
+
+    DataManager._instance = None
+    reloaded = DataManager()
+    assert reloaded.get_notification_channels() == [1]
+    assert reloaded.get_channel_top_k(1) == 5
+    assert reloaded.data['channel_marketplaces'] == {'1': ['uk', 'de']}
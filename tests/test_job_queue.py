@@ -0,0 +1,297 @@
+"""
+Tests for the Mongo-backed job queue and the distributed coordinator. They run against a local mongod, at
+TEST_MONGO_URI or mongodb://localhost:27017, and are skipped when none is reachable.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('colorama')
+pymongo = pytest.importorskip('pymongo')
+motor_asyncio = pytest.importorskip('motor.motor_asyncio')
+
+TEST_MONGO_URI = os.getenv('TEST_MONGO_URI', 'mongodb://localhost:27017')
+TEST_DATABASE = 'PromoBotTest'
+
+
+def is_mongod_available() -> bool:
+    try:
+        client = pymongo.MongoClient(TEST_MONGO_URI, serverSelectionTimeoutMS=500)
+        client.server_info()
+        client.close()
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not is_mongod_available(), reason=f'No mongod reachable at {TEST_MONGO_URI}')
+
+import db  # noqa: E402
+from config import JOB_MAX_ATTEMPTS  # noqa: E402
+from job_queue import enqueue_jobs, claim_job, complete_job, fail_exhausted_jobs, iter_stage_results, \
+    JOB_DONE, JOB_FAILED, JOB_LEASED  # noqa: E402
+from models import Stage, Promotion, ProductDetails, ProcessedProductDetails  # noqa: E402
+
+RUN_ID = 'test-run'
+
+
+def run_with_jobs_collection(scenario):
+    """Run a scenario on a fresh event loop with db.jobs_collection pointed at an empty test collection."""
+
+    async def run():
+        client = motor_asyncio.AsyncIOMotorClient(TEST_MONGO_URI)
+        db.jobs_collection = client[TEST_DATABASE]['Jobs']
+        await db.jobs_collection.delete_many({})
+        try:
+            return await scenario()
+        finally:
+            await db.jobs_collection.delete_many({})
+            db.jobs_collection = None
+            client.close()
+
+    return asyncio.run(run())
+
+
+async def expire_lease(job_id: str):
+    await db.jobs_collection.update_one({"_id": job_id},
+                                        {"$set": {"lease_expiry": datetime.utcnow() - timedelta(seconds=1)}})
+
+
+def test_only_one_of_two_workers_claims_a_job():
+    async def scenario():
+        await enqueue_jobs(RUN_ID, Stage.SEARCH, {'air fryer': {"search_term": 'air fryer'}})
+        claims = await asyncio.gather(claim_job('worker-a', [Stage.SEARCH]), claim_job('worker-b', [Stage.SEARCH]))
+        claimed = [job for job in claims if job is not None]
+        assert len(claimed) == 1
+        assert claimed[0]['status'] == JOB_LEASED
+        assert claimed[0]['attempts'] == 1
+
+    run_with_jobs_collection(scenario)
+
+
+def test_expired_lease_is_reclaimed_with_attempts_incremented():
+    async def scenario():
+        await enqueue_jobs(RUN_ID, Stage.SEARCH, {'air fryer': {"search_term": 'air fryer'}})
+        first = await claim_job('worker-a', [Stage.SEARCH])
+        assert await claim_job('worker-b', [Stage.SEARCH]) is None
+
+        await expire_lease(first['_id'])
+        second = await claim_job('worker-b', [Stage.SEARCH])
+        assert second['_id'] == first['_id']
+        assert second['worker_id'] == 'worker-b'
+        assert second['attempts'] == 2
+        # The first worker lost its lease and can no longer complete the job
+        assert not await complete_job(first['_id'], 'worker-a', {"product_links": []})
+
+    run_with_jobs_collection(scenario)
+
+
+def test_complete_job_writes_the_result_back():
+    async def scenario():
+        await enqueue_jobs(RUN_ID, Stage.SEARCH, {'air fryer': {"search_term": 'air fryer'}})
+        job = await claim_job('worker-a', [Stage.SEARCH])
+        result = {"search_term": 'air fryer', "product_links": ['https://www.amazon.co.uk/dp/B000000001']}
+        assert await complete_job(job['_id'], 'worker-a', result)
+
+        stored = await db.jobs_collection.find_one({"_id": job['_id']})
+        assert stored['status'] == JOB_DONE
+        assert stored['lease_expiry'] is None
+        assert [result async for result in iter_stage_results(RUN_ID, Stage.SEARCH)] == [result]
+
+    run_with_jobs_collection(scenario)
+
+
+def test_fail_exhausted_jobs_only_fails_expired_leases_without_attempts_left():
+    async def scenario():
+        await enqueue_jobs(RUN_ID, Stage.SEARCH, {
+            'exhausted': {"search_term": 'exhausted'},
+            'retryable': {"search_term": 'retryable'},
+            'running': {"search_term": 'running'}
+        })
+        jobs = {}
+        for _ in range(3):
+            job = await claim_job('worker-a', [Stage.SEARCH])
+            jobs[job['key']] = job
+        await db.jobs_collection.update_one({"_id": jobs['exhausted']['_id']},
+                                            {"$set": {"attempts": JOB_MAX_ATTEMPTS}})
+        await db.jobs_collection.update_one({"_id": jobs['running']['_id']},
+                                            {"$set": {"attempts": JOB_MAX_ATTEMPTS}})
+        await expire_lease(jobs['exhausted']['_id'])
+        await expire_lease(jobs['retryable']['_id'])
+
+        assert await fail_exhausted_jobs(RUN_ID) == 1
+        statuses = {job['key']: job['status'] async for job in db.jobs_collection.find({"run_id": RUN_ID})}
+        assert statuses == {'exhausted': JOB_FAILED, 'retryable': JOB_LEASED, 'running': JOB_LEASED}
+
+    run_with_jobs_collection(scenario)
+
+
+def patch_coordinator(monkeypatch):
+    """Import the coordinator with fast polling and without the Searches, Runs and Products collections."""
+    pytest.importorskip('playwright')
+    import distributed
+
+    async def short_sleep(*args, **kwargs):
+        await asyncio.sleep(0.01)
+
+    async def get_all_searches(marketplace_id):
+        return ['air fryer', 'kettle']
+
+    async def get_recent_run_stats(*args, **kwargs):
+        return []
+
+    async def process_products(product_list):
+        processed = ProcessedProductDetails()
+        processed.upserted = list(product_list)
+        return processed
+
+    async def update_search_stats(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(distributed, 'sleep_randomly', short_sleep)
+    monkeypatch.setattr(distributed, 'update_search_yields', update_search_stats)
+    monkeypatch.setattr(distributed, 'update_search_term_stats', update_search_stats)
+    monkeypatch.setattr(distributed, 'get_all_searches', get_all_searches)
+    monkeypatch.setattr(distributed, 'get_recent_run_stats', get_recent_run_stats)
+    monkeypatch.setattr(distributed, 'process_products', process_products)
+    return distributed
+
+
+async def count_jobs(stage: str, status: str = None) -> int:
+    query = {"run_id": RUN_ID, "stage": stage}
+    if status is not None:
+        query["status"] = status
+    return await db.jobs_collection.count_documents(query)
+
+
+async def wait_for_jobs(stage: str):
+    for _ in range(500):
+        if await count_jobs(stage):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"No {stage} jobs were enqueued")
+
+
+def test_coordinator_advances_only_after_every_job_of_a_stage_is_done(monkeypatch):
+    distributed = patch_coordinator(monkeypatch)
+
+    promotion = Promotion('CODE1', 'Save 20%', 'https://www.amazon.co.uk/promotion/psp/CODE1',
+                          'https://www.amazon.co.uk/dp/B000000001')
+    product_details = ProductDetails(promotion.promotion_code, promotion.promotion_title, promotion.promotion_url,
+                                     promotion.product_url, 'Air Fryer', None, '£49.99', 500, 'B000000001')
+    stage_results = {
+        Stage.SEARCH: lambda job: {"search_term": job['payload']['search_term'],
+                                   "product_links": [promotion.product_url]},
+        Stage.CODES: lambda job: {"promo_codes": ['CODE1'], "search_terms": job['payload']['search_terms']},
+        Stage.PROMOS: lambda job: {"promotions": [promotion.to_dict()]},
+        Stage.DETAILS: lambda job: {"product_details": product_details.to_dict()},
+    }
+
+    async def scenario():
+        coordinator = asyncio.create_task(distributed.run_coordinator(RUN_ID))
+        try:
+            for index, stage in enumerate(Stage.SCRAPING):
+                await wait_for_jobs(stage)
+                jobs = []
+                while (job := await claim_job('worker-a', [stage])) is not None:
+                    jobs.append(job)
+                assert jobs
+
+                for job in jobs[:-1]:
+                    await complete_job(job['_id'], 'worker-a', stage_results[stage](job))
+                await asyncio.sleep(0.2)
+                # One job of the stage is still leased, so nothing after it may have started
+                for later_stage in Stage.SCRAPING[index + 1:]:
+                    assert await count_jobs(later_stage) == 0
+                assert not coordinator.done()
+
+                await complete_job(jobs[-1]['_id'], 'worker-a', stage_results[stage](jobs[-1]))
+
+            processed = await asyncio.wait_for(coordinator, timeout=5)
+            assert [product.id for product in processed.upserted] == [product_details.id]
+        finally:
+            coordinator.cancel()
+
+    run_with_jobs_collection(scenario)
+
+
+def test_cancelled_coordinator_fails_pending_jobs_and_stops(monkeypatch):
+    distributed = patch_coordinator(monkeypatch)
+    from run_budget import RunBudget
+
+    async def scenario():
+        budget = RunBudget()
+        coordinator = asyncio.create_task(distributed.run_coordinator(RUN_ID, budget=budget))
+        try:
+            await wait_for_jobs(Stage.SEARCH)
+            running_job = await claim_job('worker-a', [Stage.SEARCH])
+            budget.cancel()
+            for _ in range(500):
+                if await count_jobs(Stage.SEARCH, JOB_FAILED):
+                    break
+                await asyncio.sleep(0.01)
+            assert await count_jobs(Stage.SEARCH, JOB_FAILED) == 1
+            # The job already running is waited for and kept
+            assert not coordinator.done()
+            await complete_job(running_job['_id'], 'worker-a',
+                               {"search_term": running_job['payload']['search_term'], "product_links": []})
+
+            processed = await asyncio.wait_for(coordinator, timeout=5)
+            assert processed.upserted == []
+            assert await count_jobs(Stage.CODES) == 0
+        finally:
+            coordinator.cancel()
+
+    run_with_jobs_collection(scenario)
+
+
+def test_coordinator_records_search_term_stats_of_worker_results(monkeypatch):
+    distributed = patch_coordinator(monkeypatch)
+    saved = {}
+
+    async def update_search_yields(links_by_term, marketplace_id):
+        saved['links_by_term'] = links_by_term
+
+    async def update_search_term_stats(stats_by_term, marketplace_id):
+        saved['term_stats'] = stats_by_term
+
+    monkeypatch.setattr(distributed, 'update_search_yields', update_search_yields)
+    monkeypatch.setattr(distributed, 'update_search_term_stats', update_search_term_stats)
+
+    promotion = Promotion('CODE1', 'Save 20%', 'https://www.amazon.co.uk/promotion/psp/CODE1',
+                          'https://www.amazon.co.uk/dp/B000000001')
+    product_details = ProductDetails(promotion.promotion_code, promotion.promotion_title, promotion.promotion_url,
+                                     promotion.product_url, 'Air Fryer', None, '£49.99', 500, 'B000000001')
+
+    def search_result(job):
+        search_term = job['payload']['search_term']
+        links = [promotion.product_url] if search_term == 'air fryer' else []
+        return {"search_term": search_term, "product_links": links,
+                "term_stats": {search_term: {"links": len(links), "page_loads": 2}}}
+
+    stage_results = {
+        Stage.SEARCH: search_result,
+        Stage.CODES: lambda job: {"promo_codes": ['CODE1'], "search_terms": job['payload']['search_terms'],
+                                  "term_stats": {"air fryer": {"page_loads": 1}}},
+        Stage.PROMOS: lambda job: {"promotions": [promotion.to_dict()], "term_stats": {}},
+        Stage.DETAILS: lambda job: {"product_details": product_details.to_dict()},
+    }
+
+    async def scenario():
+        coordinator = asyncio.create_task(distributed.run_coordinator(RUN_ID))
+        try:
+            for stage in Stage.SCRAPING:
+                await wait_for_jobs(stage)
+                while (job := await claim_job('worker-a', [stage])) is not None:
+                    await complete_job(job['_id'], 'worker-a', stage_results[stage](job))
+            await asyncio.wait_for(coordinator, timeout=5)
+        finally:
+            coordinator.cancel()
+
+    run_with_jobs_collection(scenario)
+    assert saved['links_by_term'] == {'air fryer': [promotion.product_url], 'kettle': []}
+    assert saved['term_stats']['air fryer'] == {'links': 1, 'promo_codes': 1, 'deals': 1, 'page_loads': 4}
+    assert saved['term_stats']['kettle'] == {'links': 0, 'promo_codes': 0, 'deals': 0, 'page_loads': 2}
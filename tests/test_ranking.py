@@ -0,0 +1,51 @@
+"""
+Tests for the ranking that picks the deals a channel gets as full embeds.
+"""
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('colorama')
+pytest.importorskip('pytz')
+
+from config import RANKING_DEFAULT_DISCOUNT  # noqa: E402
+from models import ProductDetails  # noqa: E402
+from ranking import estimate_discount, score_deal, top_deals  # noqa: E402
+
+
+def create_product(asin: str, price: str, sales: int, promotion_title: str = 'Save 20%') -> ProductDetails:
+    return ProductDetails('CODE1', promotion_title, 'https://www.amazon.co.uk/promotion/psp/CODE1',
+                          f'https://www.amazon.co.uk/dp/{asin}', 'Air Fryer', None, price, sales, asin)
+
+
+@pytest.mark.parametrize('promotion_title, price, discount', [
+    ('Get 3 for the price of 2', None, 1 / 3),
+    ('Kaufe 3, zahle 2', None, 1 / 3),
+    ('Save 20%', None, 0.2),
+    ('Économisez 15 %', None, 0.15),
+    ('2 for £10', 8.0, 0.375),
+    ('2 für 9,99 €', 10.0, 0.5005),
+    ('Save £5 on any 2', 10.0, 0.25),
+    ('Save £5 on any 2', None, RANKING_DEFAULT_DISCOUNT),
+    ('Buy now', None, RANKING_DEFAULT_DISCOUNT),
+])
+def test_estimate_discount(promotion_title, price, discount):
+    assert estimate_discount(promotion_title, price) == pytest.approx(discount)
+
+
+def test_deals_that_sell_more_and_save_more_score_higher():
+    assert score_deal(create_product('B000000001', '£50.00', 1000)) > \
+           score_deal(create_product('B000000002', '£50.00', 100))
+    assert score_deal(create_product('B000000001', '£50.00', 100, 'Save 40%')) > \
+           score_deal(create_product('B000000002', '£50.00', 100, 'Save 10%'))
+    assert score_deal(create_product('B000000001', None, 0)) == 0
+
+
+def test_top_deals_keeps_the_k_best_best_first():
+    products = [create_product(f'B00000000{index}', '£20.00', sales)
+                for index, sales in enumerate([300, 50, 1000, 0, 700])]
+
+    assert [product.product_sales for product in top_deals(products, 3)] == [1000, 700, 300]
+    assert len(top_deals(products, 10)) == len(products)
+    assert top_deals(products, 0) == []
+    assert [product.product_sales for product in top_deals(products, 2, key=lambda product: -product.product_sales)] \
+           == [0, 50]
@@ -0,0 +1,100 @@
+"""
+Tests for the run budget, which shares a run's time between its stages by their cost in past runs.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('colorama')
+
+import run_budget  # noqa: E402
+from config import RUN_BUDGET_RESERVE  # noqa: E402
+from models import Stage  # noqa: E402
+from run_budget import RunBudget, estimate_stage_costs  # noqa: E402
+
+HISTORY = [
+    {'stages': {Stage.SEARCH: {'items': 10, 'seconds': 50}, Stage.CODES: {'items': 100, 'seconds': 200}}},
+    {'stages': {Stage.SEARCH: {'items': 30, 'seconds': 150}, Stage.CODES: {'items': 100, 'seconds': 400}}},
+]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A clock that only moves when a test advances it."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(run_budget, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_estimate_stage_costs_averages_past_runs():
+    costs = estimate_stage_costs(HISTORY)
+    assert costs[Stage.SEARCH] == {'seconds': 100, 'per_item': 5}
+    assert costs[Stage.CODES] == {'seconds': 300, 'per_item': 3}
+    assert Stage.PROMOS not in costs
+
+
+def test_stages_get_a_share_of_the_remaining_time_by_their_past_cost(clock):
+    budget = RunBudget(800 + RUN_BUDGET_RESERVE, HISTORY)
+
+    # Stages without history are weighted as the average known stage: 100 + 300 + 200 + 200
+    budget.start_stage(Stage.SEARCH, 40)
+    assert budget.stage_deadline - clock.now == pytest.approx(100)
+
+    clock.now += 50
+    budget.end_stage()
+    budget.start_stage(Stage.CODES, 200)
+    # Time left over by a fast stage goes to the stages after it
+    assert budget.stage_deadline - clock.now == pytest.approx(750 * 300 / 700)
+
+
+def test_a_stage_is_exhausted_once_its_share_is_used_up(clock):
+    budget = RunBudget(800 + RUN_BUDGET_RESERVE, HISTORY)
+    budget.start_stage(Stage.SEARCH, 40)
+    assert not budget.is_exhausted()
+
+    clock.now += 101
+    assert budget.is_exhausted()
+    budget.end_stage()
+    assert budget.was_cut_short(Stage.SEARCH)
+    assert budget.to_document()['exhausted_stages'] == [Stage.SEARCH]
+
+    budget.start_stage(Stage.CODES, 200)
+    assert not budget.is_exhausted()
+    budget.end_stage()
+    assert not budget.was_cut_short(Stage.CODES)
+
+
+def test_without_a_time_budget_only_cancellation_exhausts_a_stage(clock):
+    budget = RunBudget()
+    budget.start_stage(Stage.SEARCH, 40)
+    clock.now += 10 ** 6
+    assert not budget.is_exhausted()
+
+    budget.cancel()
+    assert budget.is_exhausted()
+    assert budget.was_cut_short(Stage.SEARCH)
+    assert not budget.has_time_for(0)
+
+
+def test_cancelling_a_budget_cancels_its_children(clock):
+    budget = RunBudget(800 + RUN_BUDGET_RESERVE)
+    child = budget.create_child('de')
+    assert child.deadline == budget.deadline
+
+    child.start_stage(Stage.SEARCH, 10)
+    assert not child.is_exhausted()
+    budget.cancel()
+    assert child.cancelled
+    assert child.is_exhausted()
+    assert budget.get_progress()['children']['de']['cancelled']
+
+
+def test_remaining_time_is_estimated_from_progress_and_past_stages(clock):
+    budget = RunBudget(10000 + RUN_BUDGET_RESERVE, HISTORY + [{'stages': {
+        Stage.PROMOS: {'items': 10, 'seconds': 60}, Stage.DETAILS: {'items': 10, 'seconds': 40}}}])
+    budget.start_stage(Stage.CODES, 100)
+    clock.now += 30
+    budget.advance(10)
+
+    # 90 codes left at 3s each, then the promos and details stages
+    assert budget.estimate_remaining_seconds() == pytest.approx(270 + 60 + 40)
@@ -0,0 +1,167 @@
+"""
+Tests for the scraper's pure steps: the search result pre-filter, the parallel search stage, the sample of known
+products detailed again and how a stage's spool is finished. No browser is started.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('colorama')
+pytest.importorskip('pytz')
+pytest.importorskip('playwright')
+pytest.importorskip('motor')
+
+import scraper  # noqa: E402
+from config import PROMO_SNAPSHOT_PRODUCT_TTL, PROMO_SNAPSHOT_RECHECK_RATE  # noqa: E402
+from models import Stage, PromoCode  # noqa: E402
+from run_budget import RunBudget  # noqa: E402
+from spool import Spool  # noqa: E402
+
+
+def create_card(asin: str, sales_text: str = None, badges: list[str] = None) -> dict:
+    return {"url": f"https://www.amazon.co.uk/dp/{asin}", "sales_text": sales_text, "badges": badges or []}
+
+
+@pytest.mark.parametrize('card, drop_unknown_sales, require_badge, passes', [
+    (create_card('B000000001', '1K+ bought in past month'), False, False, True),
+    (create_card('B000000001', '50+ bought in past month'), False, False, False),
+    (create_card('B000000001'), False, False, True),
+    (create_card('B000000001'), True, False, False),
+    (create_card('B000000001', '1K+ bought in past month'), False, True, False),
+    (create_card('B000000001', '1K+ bought in past month', ['Save 20%']), False, True, True),
+])
+def test_search_prefilter(monkeypatch, card, drop_unknown_sales, require_badge, passes):
+    monkeypatch.setattr(scraper, 'SEARCH_PREFILTER_DROP_UNKNOWN_SALES', drop_unknown_sales)
+    monkeypatch.setattr(scraper, 'SEARCH_PREFILTER_REQUIRE_BADGE', require_badge)
+    assert scraper.passes_search_prefilter(card, 100) == passes
+
+
+def test_disabled_search_prefilter_keeps_every_result(monkeypatch):
+    monkeypatch.setattr(scraper, 'SEARCH_PREFILTER_ENABLED', False)
+    assert scraper.passes_search_prefilter(create_card('B000000001', '50+ bought in past month'), 100)
+
+
+class FakeController:
+    """Runs one request at a time without pacing, so page order is the same on every run."""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(1)
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.semaphore:
+            yield
+
+    async def pace(self):
+        pass
+
+    async def record(self, outcome):
+        pass
+
+
+class FakeBrowser:
+    async def new_page(self):
+        return self
+
+    async def close(self):
+        pass
+
+
+def patch_search_stage(monkeypatch, pages: dict):
+    """Serve search result pages from a dict of (search term, page) to (cards, has next page)."""
+    requested = []
+
+    async def scrape_search_results_page(page, search_term, page_num, marketplace=None):
+        requested.append((search_term, page_num))
+        return pages.get((search_term, page_num), ([], False))
+
+    monkeypatch.setattr(scraper, 'scrape_search_results_page', scrape_search_results_page)
+    controller = FakeController()
+    monkeypatch.setattr(scraper, 'get_controller', lambda *args, **kwargs: controller)
+    monkeypatch.setattr(scraper, 'MAX_PAGES_TO_SCRAPE', 3)
+    return requested
+
+
+def test_search_stage_stops_a_term_after_its_last_page(monkeypatch):
+    requested = patch_search_stage(monkeypatch, {
+        ('air fryer', 1): ([create_card('B000000001', '1K+ bought in past month')], True),
+        ('air fryer', 2): ([create_card('B000000002', '50+ bought in past month')], True),
+        ('air fryer', 3): ([create_card('B000000001'), create_card('B000000003')], False),
+        ('kettle', 1): ([create_card('B000000004')], False),
+    })
+
+    links_by_term = asyncio.run(scraper.scrape_search_terms(FakeBrowser(), ['air fryer', 'kettle']))
+
+    assert links_by_term == {
+        'air fryer': ['https://www.amazon.co.uk/dp/B000000001', 'https://www.amazon.co.uk/dp/B000000003'],
+        'kettle': ['https://www.amazon.co.uk/dp/B000000004'],
+    }
+    # Kettle's first page had no next page, so its later pages were never loaded
+    assert sorted(requested) == [('air fryer', 1), ('air fryer', 2), ('air fryer', 3), ('kettle', 1)]
+
+
+def test_search_stage_leaves_out_terms_skipped_once_the_budget_is_used_up(monkeypatch):
+    patch_search_stage(monkeypatch, {('air fryer', 1): ([create_card('B000000001')], False)})
+    budget = RunBudget()
+    budget.start_stage(Stage.SEARCH, 6)
+    budget.cancel()
+
+    assert asyncio.run(scraper.scrape_search_terms(FakeBrowser(), ['air fryer', 'kettle'], budget)) == {}
+    assert budget.was_cut_short(Stage.SEARCH)
+
+
+def test_the_recheck_sample_is_deterministic_and_close_to_the_rate():
+    asins = [f"B{index:09d}" for index in range(2000)]
+    first = [asin for asin in asins if scraper.is_due_for_recheck(asin, date(2026, 1, 1))]
+    again = [asin for asin in asins if scraper.is_due_for_recheck(asin, date(2026, 1, 1))]
+    next_day = [asin for asin in asins if scraper.is_due_for_recheck(asin, date(2026, 1, 2))]
+
+    assert first == again
+    assert first != next_day
+    assert len(first) == pytest.approx(len(asins) * PROMO_SNAPSHOT_RECHECK_RATE, rel=0.25)
+
+
+def test_known_asins_are_the_ones_processed_within_the_ttl():
+    now = datetime.utcnow()
+    snapshot = {'asins': {
+        'B000000001': now,
+        'B000000002': now - timedelta(seconds=PROMO_SNAPSHOT_PRODUCT_TTL + 60),
+    }}
+    assert scraper.get_known_asins(snapshot) == {'B000000001'}
+    assert scraper.get_known_asins(None) == set()
+
+
+def test_merge_promo_codes_joins_the_search_terms_of_codes_found_twice():
+    merged = scraper.merge_promo_codes([PromoCode('CODE1', ['air fryer'])],
+                                       [PromoCode('CODE1', ['kettle', 'air fryer']), PromoCode('CODE2', ['toaster'])])
+    assert [(promo_code.code, promo_code.search_terms) for promo_code in merged] == [
+        ('CODE1', ['air fryer', 'kettle']), ('CODE2', ['toaster'])]
+
+
+def test_a_stage_cut_short_is_not_marked_complete(tmp_path):
+    budget = RunBudget()
+    finished = Spool(str(tmp_path / 'run' / 'search.jsonl'))
+    finished.reset()
+    finished.append({"url": 'https://www.amazon.co.uk/dp/B000000001'})
+    budget.start_stage(Stage.SEARCH, 1)
+    budget.end_stage()
+    scraper.finish_stage_output(finished, budget, Stage.SEARCH)
+    assert finished.is_complete()
+
+    cut_short = Spool(str(tmp_path / 'run' / 'codes.jsonl'))
+    cut_short.reset()
+    cut_short.append({"code": 'CODE1'})
+    budget.start_stage(Stage.CODES, 2)
+    budget.cancel()
+    assert budget.is_exhausted()
+    budget.end_stage()
+    scraper.finish_stage_output(cut_short, budget, Stage.CODES)
+
+    # Its partial results are kept for the rest of the run, but a resumed run runs the stage again
+    assert not cut_short.is_complete()
+    assert list(Spool(cut_short.path)) == [{"code": 'CODE1'}]
+    assert scraper.should_run_stage(Stage.CODES, Stage.SCRAPING, Spool(cut_short.path))
+    assert not scraper.should_run_stage(Stage.SEARCH, Stage.SCRAPING, Spool(finished.path))
@@ -0,0 +1,97 @@
+"""
+Tests for the JSONL spools that carry a run's results between stages, and the SQLite stores kept next to them.
+"""
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('colorama')
+pytest.importorskip('pytz')
+
+import spool as spool_module  # noqa: E402
+from models import ProductLink  # noqa: E402
+from spool import Spool, KeyValueStore  # noqa: E402
+
+
+def create_links_spool(tmp_path) -> Spool:
+    return Spool(str(tmp_path / 'run' / 'search.jsonl'), encode=lambda link: link.to_dict(),
+                 decode=ProductLink.from_dict)
+
+
+def test_append_skips_items_with_a_key_already_appended(tmp_path):
+    output = create_links_spool(tmp_path)
+    output.reset()
+    assert output.append(ProductLink('https://www.amazon.co.uk/dp/B000000001', ['air fryer']), key='B000000001')
+    assert not output.append(ProductLink('https://www.amazon.co.uk/dp/B000000001', ['kettle']), key='B000000001')
+    assert output.append(ProductLink('https://www.amazon.co.uk/dp/B000000002', ['kettle']), key='B000000002')
+
+    assert len(output) == 2
+    assert [link.search_terms for link in output] == [['air fryer'], ['kettle']]
+    assert output.get('B000000001').search_terms == ['air fryer']
+    assert output.get('B000000003') is None
+
+
+def test_items_are_flushed_to_disk_once_the_buffer_is_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(spool_module, 'SPOOL_BUFFER_SIZE', 2)
+    output = create_links_spool(tmp_path)
+    output.reset()
+    for index in range(5):
+        output.append(ProductLink(f'https://www.amazon.co.uk/dp/B00000000{index}'))
+
+    # Only the last, partial buffer is still in memory
+    assert len(output._buffer) == 1
+    with open(output.path, encoding='utf-8') as file:
+        assert len(file.readlines()) == 4
+    assert [chunk_size for chunk_size in map(len, output.read_chunks(2))] == [2, 2, 1]
+
+
+def test_a_completed_spool_is_read_back_by_a_resumed_run(tmp_path):
+    output = create_links_spool(tmp_path)
+    output.reset()
+    output.append(ProductLink('https://www.amazon.co.uk/dp/B000000001', ['air fryer']), key='B000000001')
+    output.mark_complete()
+
+    resumed = create_links_spool(tmp_path)
+    assert resumed.is_complete()
+    assert len(resumed) == 1
+    assert [link.url for link in resumed] == ['https://www.amazon.co.uk/dp/B000000001']
+    assert resumed.get('B000000001').search_terms == ['air fryer']
+    # Keys stay deduplicated across the restart
+    assert not resumed.append(ProductLink('https://www.amazon.co.uk/dp/B000000001'), key='B000000001')
+
+
+def test_a_closed_spool_is_not_complete_and_reset_discards_it(tmp_path):
+    output = create_links_spool(tmp_path)
+    output.reset()
+    output.append(ProductLink('https://www.amazon.co.uk/dp/B000000001'), key='B000000001')
+    output.close()
+
+    resumed = create_links_spool(tmp_path)
+    assert not resumed.is_complete()
+    assert len(resumed) == 1
+
+    resumed.reset()
+    assert len(resumed) == 0
+    assert list(resumed) == []
+    assert resumed.get('B000000001') is None
+    assert resumed.append(ProductLink('https://www.amazon.co.uk/dp/B000000001'), key='B000000001')
+
+
+def test_key_value_store_extends_lists_without_duplicates_in_insertion_order(tmp_path):
+    store = KeyValueStore(str(tmp_path / 'run' / 'terms.sqlite'))
+    store.extend('https://www.amazon.co.uk/dp/B000000002', ['kettle'])
+    store.extend('https://www.amazon.co.uk/dp/B000000001', ['air fryer'])
+    store.extend('https://www.amazon.co.uk/dp/B000000002', ['kettle', 'toaster'])
+
+    assert list(store.items()) == [
+        ('https://www.amazon.co.uk/dp/B000000002', ['kettle', 'toaster']),
+        ('https://www.amazon.co.uk/dp/B000000001', ['air fryer'])
+    ]
+    assert store.insert('B000000003', 3)
+    assert not store.insert('B000000003', 4)
+    assert store.get('B000000003') == 3
+    store.close()
+
+    reopened = KeyValueStore(store.path)
+    assert reopened.get('B000000003') == 3
+    reopened.reset()
+    assert reopened.get('B000000003') is None
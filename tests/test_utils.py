@@ -0,0 +1,43 @@
+"""
+Tests for the parsers of the prices and sales figures shown by every marketplace.
+"""
+import pytest
+
+pytest.importorskip('dotenv')
+pytest.importorskip('colorama')
+pytest.importorskip('pytz')
+
+from utils import parse_price, parse_sales, chunked  # noqa: E402
+
+
+@pytest.mark.parametrize('price, expected', [
+    ('£9.99', 9.99),
+    ('£1,234.56', 1234.56),
+    ('1.234,56 €', 1234.56),
+    ('12,99 €', 12.99),
+    ('£1,000', 1000),
+    ('N/A', None),
+    ('', None),
+    (None, None),
+])
+def test_parse_price(price, expected):
+    assert parse_price(price) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('50+ bought in past month', 50),
+    ('1K+ bought in past month', 1000),
+    ('1,000+ bought in past month', 1000),
+    ('1.000+ Mal im letzten Monat gekauft', 1000),
+    ('1,5K+ achetés au cours du mois dernier', 1500),
+    ('2M+', 2000000),
+    ('N/A', None),
+    (None, None),
+])
+def test_parse_sales(text, expected):
+    assert parse_sales(text) == expected
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
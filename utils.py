@@ -3,11 +3,18 @@ import pytz
 import asyncio
 import random
 import inspect
+import re
 
+from contextlib import asynccontextmanager
 from datetime import datetime
 from dotenv import load_dotenv
-from itertools import cycle
+from itertools import cycle, islice
+
+from config import HAR_REPLAY_SKIP_DELAYS
+from har_manager import HarManager
 from logger import Logger
+from marketplace import Marketplace, get_marketplace
+from metrics import Metrics
 
 load_dotenv()
 
@@ -17,6 +24,16 @@ def get_current_time():
     return datetime.now(uk_tz).strftime('%d %B %Y, %I:%M:%S %p %Z')
 
 
+def format_duration(seconds: float) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+
 async def sleep_randomly(base_sleep: float, randomness: float = 1, message: str = None):
     delay = base_sleep + random.uniform(-randomness, randomness)
     delay = max(delay, 0)
@@ -27,15 +44,66 @@ async def sleep_randomly(base_sleep: float, randomness: float = 1, message: str
     project_root = Logger.get_project_root()
     relative_file_name = os.path.relpath(file_name, project_root)
     relative_file_name = f"./{relative_file_name.replace(os.sep, '/')}"
+    if HarManager().is_replaying() and HAR_REPLAY_SKIP_DELAYS:
+        return
     if message == None:
         Logger.debug(f'Sleeping for {delay:.2f} seconds - {relative_file_name}:{line_number})')
     else:
         Logger.debug(f'Sleeping for {delay:.2f} seconds - {message} - {relative_file_name}:{line_number})')
+    Metrics().increment('sleep_seconds', delay)
     await asyncio.sleep(delay)
 
     del current_frame, caller_frame
 
 
+def parse_price(price: str | None) -> float | None:
+    """Parse a displayed price such as '£1,234.56' or '1.234,56 €' into a number."""
+    if not price:
+        return None
+    match = re.search(r'\d[\d.,]*', price)
+    if not match:
+        return None
+
+    number = match.group(0).rstrip('.,')
+    if ',' in number and '.' in number:
+        if number.rfind(',') > number.rfind('.'):
+            number = number.replace('.', '').replace(',', '.')
+        else:
+            number = number.replace(',', '')
+    elif ',' in number:
+        decimals = number.split(',')[-1]
+        number = number.replace(',', '.') if len(decimals) == 2 else number.replace(',', '')
+
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+
+def parse_sales(text: str | None) -> int | None:
+    """Parse a sales figure such as '1K+ bought in past month' or '1.000+ Mal im letzten Monat gekauft'."""
+    match = re.search(r'(\d+(?:[.,]\d+)?)\s*([KM]?)\+?', text or '', re.IGNORECASE)
+    if not match:
+        return None
+    number_text = match.group(1)
+    # '1,000+' and '1.000+' use a thousands separator, '1,5K+' a decimal comma
+    separator = ',' if ',' in number_text else '.'
+    if separator in number_text and len(number_text.split(separator)[1]) == 3:
+        number_text = number_text.replace(separator, '')
+    number = float(number_text.replace(',', '.'))
+    multiplier = {'K': 1000, 'M': 1000000}.get(match.group(2).upper(), 1)
+    return int(number * multiplier)
+
+
+def chunked(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.107 Safari/537.36",
@@ -51,13 +119,15 @@ USER_AGENTS = [
 user_agent_cycle = cycle(USER_AGENTS)
 
 
-async def get_browser(p):
-    user_data_dir = os.path.abspath("chrome_user_data")
+async def get_browser(p, marketplace: Marketplace = None):
+    marketplace = marketplace or get_marketplace()
+    # A profile per marketplace, so that marketplaces can run at the same time and keep their own cookies and postcode
+    user_data_dir = os.path.abspath(marketplace.get_profile_directory())
     os.makedirs(user_data_dir, exist_ok=True)
 
-    # Randomize geolocation within Farnham, UK area
-    latitude = 51.2150 + random.uniform(-0.1, 0.1)
-    longitude = -0.7986 + random.uniform(-0.1, 0.1)
+    # Randomize geolocation around the marketplace's location
+    latitude = marketplace.latitude + random.uniform(-0.1, 0.1)
+    longitude = marketplace.longitude + random.uniform(-0.1, 0.1)
 
     browser = await p.chromium.launch_persistent_context(
         user_data_dir=user_data_dir,
@@ -79,12 +149,37 @@ async def get_browser(p):
         accept_downloads=True,
         permissions=['geolocation'],
         geolocation={'latitude': latitude, 'longitude': longitude},
-        locale='en-GB',
-        timezone_id='Europe/London',
+        locale=marketplace.locale,
+        timezone_id=marketplace.timezone,
     )
+    await HarManager().attach(browser)
     pages = browser.pages
     if pages:
         page = pages[0]
     else:
         page = await browser.new_page()
     return browser, page
+
+
+@asynccontextmanager
+async def open_browser(marketplace: Marketplace = None):
+    """Launch the browser and close it on exit, which also flushes any HAR recording of its traffic."""
+    # Imported here so that modules only needing the helpers above do not pay for loading Playwright
+    from playwright.async_api import async_playwright
+
+    async with async_playwright() as p:
+        browser, page = await get_browser(p, marketplace)
+        try:
+            yield browser, page
+        finally:
+            await browser.close()
+
+
+async def is_block_page(page) -> bool:
+    try:
+        if await page.query_selector('form[action*="validateCaptcha"], input#captchacharacters'):
+            return True
+        return 'Robot Check' in await page.title()
+    except Exception as e:
+        Logger.warn('Could not check page for captcha', e)
+        return False